@@ -3,11 +3,12 @@ import argparse
 import time
 from pathlib import Path 
 import uuid
+import hashlib
 import traceback,os,sys
 import csv
 import requests
-import math as m
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from getpass import getpass
 
 import src.utils as utils
@@ -31,19 +32,42 @@ def sanity_check(payload,keyarray):
             return False
     return True
 
-def download_from_link(url,params,headers,output_filename,n_chunk=1): ### download by chunks
+def download_from_link(url,params,headers,output_filename,n_chunk=1,resume=False): ### download by chunks
     current_dir=Path(__file__).parent
+    headers=dict(headers)
+    offset=0
+    ## validator (ETag or Last-Modified) of the object the partial file was started from
+    validator_file=Path(str(output_filename)+'.validator')
+    if resume and Path(output_filename).exists() and validator_file.exists():
+        offset=Path(output_filename).stat().st_size
+        headers['Range']='bytes={}-'.format(offset)
+        ## the server answers 200 with the whole object if it changed since
+        headers['If-Range']=validator_file.read_text().strip()
+    elif resume and Path(output_filename).exists():
+        print("No validator saved for {} , downloading again".format(output_filename))
     r = requests.get(url, params=params,headers=headers,stream=True)
-    if r.status_code != 200:
+    if r.status_code == 416: ### nothing left to download
+        validator_file.unlink(missing_ok=True)
+        return output_filename
+    if r.status_code not in [200,206]:
         if r.status_code == 404:
             raise Exception("File doesn't exist")
         raise Exception("Download error")
+    mode='wb'
+    if r.status_code == 206:
+        mode='ab'
+        print("Resuming from {} bytes".format(offset))
+    elif offset>0:
+        print("The file changed on the server , downloading again")
+    validator=r.headers.get('ETag') or r.headers.get('Last-Modified')
+    if validator and r.status_code == 200:
+        validator_file.write_text(validator)
     block_size = 1024
-    file_size = int(r.headers.get('Content-Length', None))
-    print("File size : {}".format(file_size))
-    num_bars = m.ceil(file_size / (n_chunk * block_size))
+    file_size = r.headers.get('Content-Length', None) ### streamed responses (zip) have no length
+    file_size = int(file_size) if file_size is not None else 0
+    print("File size : {}".format(file_size if file_size else "unknown"))
     bt=time.time()
-    with open(output_filename, 'wb') as f:
+    with open(output_filename, mode) as f:
         for i, chunk in enumerate(r.iter_content(chunk_size=n_chunk * block_size)):
             f.write(chunk)
             et=time.time()-bt
@@ -51,6 +75,7 @@ def download_from_link(url,params,headers,output_filename,n_chunk=1): ### downlo
             print("\rDownloading {:.1f}mb/{:.1f}mb of {} ({:.1f}kb/s)".format((i+1)/block_size,file_size/(block_size**2),Path(output_filename).name,trspeed),end='\r')
             #time.sleep(0.1)
     print()
+    validator_file.unlink(missing_ok=True)
     return output_filename
 
 ## decorator
@@ -247,9 +272,107 @@ def download_file(payload):
     }
     uri=payload["command_args"].host+'/api/v1/storage'
     headers={"Content-Type":"application/json","Authorization":token}
-    download_from_link(uri,params,headers,out_filename)
+    download_from_link(uri,params,headers,out_filename,resume=payload['command_args'].resume)
     return 200, out_filename 
 
+def file_sha256(filename,block_size=8*1024*1024):
+    h=hashlib.sha256()
+    with open(filename,'rb') as f:
+        for block in iter(lambda: f.read(block_size),b''):
+            h.update(block)
+    return h.hexdigest()
+
+def read_part(filename,session,part_number):
+    with open(filename,'rb') as f:
+        f.seek((part_number-1)*session['part_size'])
+        return f.read(session['part_size'])
+
+@token_required
+def upload_file(payload): ### resumable , parallel upload through an upload session
+    token=payload['access_token']
+    args=payload['command_args']
+    filename=Path(args.input_file)
+    output_filename=args.output_filename or filename.name
+    size=filename.stat().st_size
+    uri=args.host+'/api/v1/storage/upload_sessions'
+    headers={"Content-Type":"application/json","Authorization":token}
+    ## the session of an interrupted upload is kept next to the file
+    state_file=Path(str(filename)+'.atx-upload')
+    state={'bucket_name':args.bucket_name,'output_filename':output_filename,'size':size,
+           'mtime':filename.stat().st_mtime,'host':args.host}
+    if args.dedup:
+        ## nothing is sent when the server already stores the same content
+        params={'bucket_name':args.bucket_name,'output_filename':output_filename,'size':size,'sha256':file_sha256(filename)}
+        r=requests.post(args.host+'/api/v1/storage/upload/dedup',data=json.dumps(params),headers=headers)
+        if r.status_code==200 and r.json()['deduplicated']:
+            print("Same content found at {} , copied on the server".format(r.json()['source']))
+            return 200, r.json()['key']
+    session=None
+    if state_file.exists():
+        previous=json.load(open(state_file,'r'))
+        if all(previous.get(k)==v for k,v in state.items()):
+            r=requests.get(uri+'/'+previous['session_id'],headers=headers)
+            if r.status_code==200 and r.json()['status']=='open':
+                session=r.json()
+                print("Resuming upload session {} ({} of {} parts left)".format(session['session_id'],len(session['missing_parts']),session['part_count']))
+    if session is None:
+        params={'bucket_name':args.bucket_name,'output_filename':output_filename,'size':size}
+        if args.part_size is not None:
+            params['part_size']=args.part_size*1024*1024
+        r=requests.post(uri,data=json.dumps(params),headers=headers)
+        if r.status_code!=200:
+            return error_message("Error in creating the upload session : {}".format(r.text),r.status_code)
+        session=r.json()
+        state['session_id']=session['session_id']
+        json.dump(state,open(state_file,'w'))
+    part_uri=uri+'/{}/parts/{{}}'.format(session['session_id'])
+    part_headers={"Content-Type":"application/octet-stream","Authorization":token}
+    def send_part(part_number):
+        data=read_part(filename,session,part_number)
+        for attempt in range(args.retries):
+            try:
+                r=requests.put(part_uri.format(part_number),data=data,headers=part_headers)
+                if r.status_code==200:
+                    return len(data)
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(2**attempt)
+        raise Exception("Part {} failed after {} attempts".format(part_number,args.retries))
+    missing=session['missing_parts']
+    sent=0
+    failed=[]
+    bt=time.time()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures={pool.submit(send_part,n):n for n in missing}
+        for i,future in enumerate(as_completed(futures)):
+            try:
+                sent+=future.result()
+            except Exception as e:
+                print("\n{}".format(str(e)))
+                failed.append(futures[future])
+            et=time.time()-bt
+            print("\rUploading part {}/{} of {} ({:.1f}mb/s)".format(i+1,len(missing),filename.name,sent/(1024**2)/max(et,1e-6)),end='\r')
+    print()
+    if failed:
+        return error_message("Parts {} failed , run the same command again to resume".format(sorted(failed)),500)
+    r=requests.post(uri+'/{}/complete'.format(session['session_id']),headers=headers)
+    if r.status_code!=200:
+        return error_message("Error in completing the upload : {}".format(r.text),r.status_code)
+    state_file.unlink()
+    return 200, r.json()['key']
+
+@token_required
+def backfill_thumbnails(payload):
+    token=payload['access_token']
+    runs=payload['command_args'].runs
+    uri=payload["command_args"].host+'/api/v1/storage/thumbnails/backfill'
+    headers={"Content-Type":"application/json","Authorization":token}
+    res=requests.post(uri,data=json.dumps({'runs':runs}),headers=headers)
+    if res.status_code==200:
+        return 200, res.json()
+    else:
+        return error_message("Error in generating thumbnails", res.status_code)
+
 @token_required
 def download_directory(payload):
     token=payload['access_token']
@@ -413,8 +536,20 @@ def get_args():
     parser_download_file.add_argument('bucket_name',type=str,help='S3 bucket name')
     parser_download_file.add_argument('-f','--object-name',type=str,required=True,help='Object name to download')
     parser_download_file.add_argument('-o','--output',type=str,default=None,help='output filename')
+    parser_download_file.add_argument('--resume',default=False,help='Resume a partially downloaded output file',action='store_true')
     parser_download_file.set_defaults(func=download_file)
 
+    ## upload file
+    parser_upload_file=subparsers.add_parser('upload_file',help='Resumable parallel upload of a file to S3 (admin)')
+    parser_upload_file.add_argument('bucket_name',type=str,help='S3 bucket name')
+    parser_upload_file.add_argument('input_file',type=str,help='File to upload')
+    parser_upload_file.add_argument('-o','--output-filename',type=str,default=None,help='Object name (defaults to the file name)')
+    parser_upload_file.add_argument('-w','--workers',type=int,default=4,help='Parts uploaded in parallel')
+    parser_upload_file.add_argument('--part-size',type=int,default=None,help='Part size in MB (server default otherwise)')
+    parser_upload_file.add_argument('--retries',type=int,default=4,help='Attempts per part')
+    parser_upload_file.add_argument('--dedup',default=False,help='Copy an already stored file with the same sha256 instead of uploading',action='store_true')
+    parser_upload_file.set_defaults(func=upload_file)
+
     ## download directory
     parser_download_directory=subparsers.add_parser('download_directory',help='download directory from S3 (admin)')
     parser_download_directory.add_argument('bucket_name',type=str,help='S3 bucket name')
@@ -429,6 +564,11 @@ def get_args():
     parser_generate_s3_dataset.add_argument('-o','--output',type=str,default='output.yml',help='output filename')
     parser_generate_s3_dataset.set_defaults(func=generate_s3_dataset)
 
+    ## regenerate homepage thumbnails
+    parser_backfill_thumbnails=subparsers.add_parser('backfill_thumbnails',help='Regenerate the homepage thumbnails of all runs (admin)')
+    parser_backfill_thumbnails.add_argument('-r','--runs',nargs='+',default=None,help='Only these run ids')
+    parser_backfill_thumbnails.set_defaults(func=backfill_thumbnails)
+
 ## UTILITIES
     parser_make_dataset_from_csv=subparsers.add_parser('make_dataset_from_csv',help='Make a dataset (admin)')
     parser_make_dataset_from_csv.add_argument('input_file',type=str,help='Input file (csv)')
@@ -16,6 +16,7 @@ from src.dataset import DatasetAPI
 from src.genes import GeneAPI
 from src.tasks import TaskAPI
 from src.rundb import MariaDB
+from src.cache import ObjectCache
 
 ## arguments
 
@@ -53,6 +54,7 @@ app.config['APP_VERSION']=version
 app.config['SUBMODULES']={}
 app.config['SUBMODULES']['Auth']=Auth(app)
 app.config['SUBMODULES']['Database']=Database(auth=app.config['SUBMODULES']['Auth'])
+app.config['SUBMODULES']['ObjectCache']=ObjectCache(auth=app.config['SUBMODULES']['Auth'])
 app.config['SUBMODULES']['DatasetAPI']=DatasetAPI(  auth=app.config['SUBMODULES']['Auth'],
                                                     datastore=app.config['SUBMODULES']['Database'])
 app.config['SUBMODULES']['GeneAPI']=GeneAPI(auth=app.config['SUBMODULES']['Auth'],
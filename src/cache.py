@@ -0,0 +1,538 @@
+##################################################################################
+### Module : cache.py
+### Description : Local object cache for S3 objects , shared by Storage & Gene APIs
+###
+###   Objects are stored under TEMP_DIRECTORY/<bucket>/<key> and tracked in a
+###   sqlite manifest so that freshness is decided by the S3 ETag and the total
+###   size is bounded by CACHE_MAX_BYTES. Keys with empty , '.' or '..' segments
+###   are rejected , so two S3 keys never map to the same local file.
+###   The manifest and the lock files live in CACHE_STATE_DIRECTORY , outside of
+###   the served tree. Hits only update counters in memory , they are written to
+###   the manifest (WAL journal) at most every CACHE_FLUSH_SECONDS.
+###   HEAD results (including "doesn't exist") are kept in the same manifest for
+###   CACHE_METADATA_TTL seconds so cache hits need no network round trip.
+###   Downloads are single-flight across worker processes : one file lock per
+###   object , data written to a temporary file and renamed into place. Lock
+###   files are removed with the entries they guard (when no one holds them).
+###   Derived files (tiles , renditions ...) are kept under .derived , keyed by
+###   the source ETag , and share the same quota and eviction.
+###   Access listeners (e.g. the run prefetcher) are told about every getObject.
+###
+### Copyrighted reserved by AtlasXomics
+##################################################################################
+
+from flask import Response
+import os
+import json
+import time
+import uuid
+import shutil
+import atexit
+import threading
+import fcntl
+import hashlib
+import sqlite3
+import datetime
+import traceback
+from pathlib import Path
+from contextlib import contextmanager
+## aws
+import boto3
+from botocore.exceptions import ClientError
+
+from . import utils
+
+def pathParts(key,what):
+    ## '' , '.' and '..' segments are rejected rather than dropped : 'a//b' , 'a/./b' and 'a/b'
+    ## are distinct S3 keys and must never share a cache file
+    parts=str(key).split('/')
+    if any(p in ('','.','..') for p in parts):
+        raise ValueError("Invalid {} : {}".format(what,key))
+    return parts
+
+class ObjectCache:
+    def __init__(self,auth,**kwargs):
+        self.auth=auth
+        self.tempDirectory=Path(self.auth.app.config['TEMP_DIRECTORY'])
+        ## never inside TEMP_DIRECTORY , which is served as is
+        self.stateDirectory=Path(self.auth.app.config.get('CACHE_STATE_DIRECTORY') or str(self.tempDirectory)+'_state')
+        self.manifest_path=self.stateDirectory.joinpath('object_cache.sqlite')
+        self.lockDirectory=self.stateDirectory.joinpath('locks')
+        self.derivedDirectory=self.tempDirectory.joinpath('.derived')
+        self.max_bytes=int(self.auth.app.config.get('CACHE_MAX_BYTES',50*1024**3))
+        self.policy=self.auth.app.config.get('CACHE_EVICTION_POLICY','lru').lower()
+        self.metadata_ttl=float(self.auth.app.config.get('CACHE_METADATA_TTL',300))
+        self.negative_ttl=float(self.auth.app.config.get('CACHE_NEGATIVE_TTL',30))
+        self.flush_seconds=float(self.auth.app.config.get('CACHE_FLUSH_SECONDS',5))
+        self.aws_s3=boto3.client('s3')
+        self.listeners=[]
+        ## path -> (last access , hits) and stat name -> increment , not yet in the manifest
+        self.pending_touches={}
+        self.pending_stats={}
+        self.pending_lock=threading.Lock()
+        self.flushed_at=time.time()
+        self.initialize()
+        self.initEndpoints()
+
+    def initialize(self):
+        self.tempDirectory.mkdir(parents=True,exist_ok=True)
+        self.lockDirectory.mkdir(parents=True,exist_ok=True)
+        self._moveLegacyManifest()
+        with self._connect() as conn:
+            ## persistent on the database file , readers no longer wait for the hit counters
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                path TEXT PRIMARY KEY,
+                                bucket TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                etag TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                last_modified TEXT,
+                                created_at REAL NOT NULL,
+                                last_access REAL NOT NULL,
+                                hits INTEGER NOT NULL DEFAULT 0)""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS object_meta (
+                                bucket TEXT NOT NULL,
+                                key TEXT NOT NULL,
+                                exist INTEGER NOT NULL,
+                                etag TEXT,
+                                size INTEGER,
+                                last_modified TEXT,
+                                expires_at REAL NOT NULL,
+                                PRIMARY KEY (bucket,key))""")
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            ## name of the derived file , NULL for plain S3 objects
+            columns=[r[1] for r in conn.execute("PRAGMA table_info(entries)").fetchall()]
+            if 'derived' not in columns:
+                conn.execute("ALTER TABLE entries ADD COLUMN derived TEXT")
+            conn.execute("DELETE FROM object_meta WHERE expires_at<?",(time.time(),))
+            ## drop entries whose files were removed behind our back
+            rows=conn.execute("SELECT path FROM entries").fetchall()
+            missing=[(r[0],) for r in rows if not Path(r[0]).exists()]
+            conn.executemany("DELETE FROM entries WHERE path=?",missing)
+        atexit.register(self.flush)
+
+    def _moveLegacyManifest(self):
+        ## the manifest used to be TEMP_DIRECTORY/.object_cache.sqlite , where it could be downloaded
+        legacy=self.tempDirectory.joinpath('.object_cache.sqlite')
+        if not legacy.exists():
+            return
+        if not self.manifest_path.exists():
+            shutil.move(str(legacy),str(self.manifest_path))
+        else:
+            legacy.unlink()
+        shutil.rmtree(self.tempDirectory.joinpath('.locks'),ignore_errors=True)
+
+##### Endpoints
+
+    def initEndpoints(self):
+        @self.auth.app.route('/api/v1/cache/stats',methods=['GET'])
+        @self.auth.admin_required
+        def _getCacheStats():
+            sc=200
+            res=None
+            try:
+                res=self.getStats()
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
+        @self.auth.app.route('/api/v1/cache',methods=['DELETE'])
+        @self.auth.admin_required
+        def _clearCache():
+            sc=200
+            res=None
+            try:
+                res=self.clear()
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
+###### actual methods
+
+    def getLocalPath(self,bucket_name,key):
+        ## TEMP_DIRECTORY/<bucket>/<key> , the same key in two buckets never shares a file ;
+        ## never escape the cache root (bucket names can't start with '.' , so no clash with .derived)
+        if not bucket_name or '/' in str(bucket_name) or str(bucket_name).startswith('.'):
+            raise Exception("Invalid bucket name : {}".format(bucket_name))
+        return self.tempDirectory.joinpath(str(bucket_name),*pathParts(key,'object key'))
+
+    def headObject(self,bucket_name,key,use_cache=True):
+        """Returns size, ETag and LastModified of the object , served from the metadata cache when fresh."""
+        if use_cache:
+            meta=self.getMetadata(bucket_name,key)
+            if meta is not None:
+                self._incrementStat('metadata_hits')
+                return meta
+            self._incrementStat('metadata_misses')
+        try:
+            obj=self.aws_s3.head_object(Bucket=bucket_name,Key=key)
+            meta={'exists':True,
+                  'etag':obj['ETag'].strip('"'),
+                  'size':obj['ContentLength'],
+                  'last_modified':obj['LastModified']}
+        except ClientError as e:
+            ## only a missing object is cached as such , throttling or denied access are raised
+            if e.response.get('Error',{}).get('Code') not in ('404','NoSuchKey','NotFound'):
+                raise
+            meta={'exists':False,'etag':None,'size':None,'last_modified':None}
+        self.putMetadata(bucket_name,key,meta)
+        return meta
+
+    def getMetadata(self,bucket_name,key):
+        with self._connect() as conn:
+            row=conn.execute("SELECT exist,etag,size,last_modified FROM object_meta WHERE bucket=? AND key=? AND expires_at>?",
+                             (bucket_name,key,time.time())).fetchone()
+        if row is None: return None
+        last_modified=row[3]
+        if last_modified is not None:
+            last_modified=datetime.datetime.fromisoformat(last_modified)
+        return {'exists':bool(row[0]),'etag':row[1],'size':row[2],'last_modified':last_modified}
+
+    def putMetadata(self,bucket_name,key,meta):
+        ttl=self.metadata_ttl if meta['exists'] else self.negative_ttl
+        last_modified=meta['last_modified']
+        if isinstance(last_modified,datetime.datetime):
+            last_modified=last_modified.isoformat()
+        with self._connect() as conn:
+            conn.execute("""INSERT OR REPLACE INTO object_meta (bucket,key,exist,etag,size,last_modified,expires_at)
+                            VALUES (?,?,?,?,?,?,?)""",
+                         (bucket_name,key,int(meta['exists']),meta['etag'],meta['size'],last_modified,time.time()+ttl))
+
+    def getObject(self,bucket_name,key):
+        """Returns the cached copy of s3://bucket_name/key , downloading it when the
+        local copy is missing or its ETag differs from S3. Returns None if the object doesn't exist."""
+        meta=self.headObject(bucket_name,key)
+        if not meta['exists']:
+            return None
+        self._notify(bucket_name,key)
+        path=self.getLocalPath(bucket_name,key)
+        if self._isFresh(path,bucket_name,key,meta):
+            self._touch(path)
+            self._incrementStat('hits')
+            return self._result(path,meta)
+        with self.lockObject(bucket_name,key):
+            ## another worker may have finished the same download while we waited
+            if self._isFresh(path,bucket_name,key,meta):
+                self._touch(path)
+                self._incrementStat('hits')
+                return self._result(path,meta)
+            self._incrementStat('misses')
+            self.download(bucket_name,key,path,meta['size'])
+            self._putEntry(path,bucket_name,key,meta)
+        self.evict(keep=path)
+        return self._result(path,meta)
+
+    def openObject(self,bucket_name,key,retries=3):
+        """getObject with the cached copy already open as obj['file'] , which the caller closes.
+        The open file stays readable if the entry is evicted afterwards. Returns None if the object doesn't exist."""
+        for _ in range(retries):
+            try:
+                obj=self.getObject(bucket_name,key)
+                if obj is None:
+                    return None
+                obj['file']=open(obj['path'],'rb')
+                return obj
+            except FileNotFoundError:
+                ## evicted by another request between the download and the open , fetched again
+                continue
+        raise Exception("s3://{}/{} was evicted before it could be read".format(bucket_name,key))
+
+    def isCached(self,bucket_name,key,meta):
+        """Whether the object at meta's ETag is already in the cache , without counting a hit."""
+        return self._isFresh(self.getLocalPath(bucket_name,key),bucket_name,key,meta)
+
+    def addAccessListener(self,listener):
+        ## listener(bucket_name,key) must return quickly , it runs on the request thread
+        self.listeners.append(listener)
+
+    def download(self,bucket_name,key,path,size=None):
+        ## readers never see a partially written file , and only whole objects are cached :
+        ## Range requests are answered from the complete local copy , never from a ranged GET
+        path.parent.mkdir(parents=True,exist_ok=True)
+        part_path=path.parent.joinpath(".{}.{}.part".format(path.name,uuid.uuid4().hex))
+        try:
+            with open(part_path,'wb') as f:
+                self.aws_s3.download_fileobj(bucket_name,key,f)
+            if size is not None and part_path.stat().st_size!=size:
+                raise Exception("Incomplete download of s3://{}/{} : {} of {} bytes".format(bucket_name,key,part_path.stat().st_size,size))
+            os.replace(part_path,path)
+        finally:
+            if part_path.exists():
+                part_path.unlink()
+
+    def lockPath(self,bucket_name,key,name=None):
+        ## every lock of an object starts with the object's digest , so they can be removed together
+        digest=hashlib.sha1("{}/{}".format(bucket_name,key).encode('utf-8')).hexdigest()
+        if name is not None:
+            digest+='.'+hashlib.sha1(str(name).encode('utf-8')).hexdigest()[:16]
+        return self.lockDirectory.joinpath(digest+'.lock')
+
+    @contextmanager
+    def lockObject(self,bucket_name,key,name=None):
+        """Exclusive lock per object (or per name derived from it) shared by threads and worker processes."""
+        path=self.lockPath(bucket_name,key,name)
+        while True:
+            lf=open(path,'a')
+            fcntl.flock(lf.fileno(),fcntl.LOCK_EX)
+            ## the file may have been removed while we waited , then the lock is taken again on a new one
+            try:
+                if os.fstat(lf.fileno()).st_ino==os.stat(path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            fcntl.flock(lf.fileno(),fcntl.LOCK_UN)
+            lf.close()
+        try:
+            yield
+        finally:
+            fcntl.flock(lf.fileno(),fcntl.LOCK_UN)
+            lf.close()
+
+    def removeLocks(self,bucket_name,key):
+        """Removes the lock files of an object that nobody holds."""
+        digest=hashlib.sha1("{}/{}".format(bucket_name,key).encode('utf-8')).hexdigest()
+        for path in self.lockDirectory.glob(digest+'*.lock'):
+            with open(path,'a') as lf:
+                try:
+                    fcntl.flock(lf.fileno(),fcntl.LOCK_EX|fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                try:
+                    if os.fstat(lf.fileno()).st_ino==os.stat(path).st_ino:
+                        path.unlink()
+                except FileNotFoundError:
+                    pass
+                finally:
+                    fcntl.flock(lf.fileno(),fcntl.LOCK_UN)
+
+    def derivedPath(self,bucket_name,key,etag,name):
+        digest=hashlib.sha1("{}/{}".format(bucket_name,key).encode('utf-8')).hexdigest()
+        return self.derivedDirectory.joinpath(digest[:2],digest,etag,*pathParts(name,'derived name'))
+
+    def getDerived(self,bucket_name,key,etag,name):
+        """Returns the path of a file derived from the object at the given ETag , or None."""
+        path=self.derivedPath(bucket_name,key,etag,name)
+        entry=self.getEntry(path)
+        if entry is None or not path.exists():
+            self._incrementStat('derived_misses')
+            return None
+        self._touch(path)
+        self._incrementStat('derived_hits')
+        return path
+
+    def putDerived(self,bucket_name,key,etag,name,data):
+        """Stores bytes (or the content of a readable file object) derived from the object at the given ETag and returns their path."""
+        return self.putDerivedFiles(bucket_name,key,etag,[(name,data)])[0]
+
+    def putDerivedFiles(self,bucket_name,key,etag,files,keep_dirs=None):
+        ## files : list of (name , bytes or readable) , registered in one transaction
+        ## keep_dirs : directories the eviction must leave alone , besides the new files
+        now=time.time()
+        paths=[]
+        rows=[]
+        for name,data in files:
+            path=self.derivedPath(bucket_name,key,etag,name)
+            path.parent.mkdir(parents=True,exist_ok=True)
+            part_path=path.parent.joinpath(".{}.{}.part".format(path.name,uuid.uuid4().hex))
+            with open(part_path,'wb') as f:
+                if hasattr(data,'read'):
+                    shutil.copyfileobj(data,f,1024*1024)
+                else:
+                    f.write(data)
+            size=part_path.stat().st_size
+            os.replace(part_path,path)
+            paths.append(path)
+            rows.append((str(path),bucket_name,key,etag,size,None,now,now,name))
+        with self._connect() as conn:
+            conn.executemany("""INSERT OR REPLACE INTO entries
+                                (path,bucket,key,etag,size,last_modified,created_at,last_access,hits,derived)
+                                VALUES (?,?,?,?,?,?,?,?,0,?)""",rows)
+        self.evict(keep=paths,keep_dirs=keep_dirs)
+        return paths
+
+    def getEntry(self,path):
+        with self._connect() as conn:
+            row=conn.execute("SELECT path,bucket,key,etag,size,last_modified,created_at,last_access,hits FROM entries WHERE path=?",(str(path),)).fetchone()
+        if row is None: return None
+        return dict(zip(['path','bucket','key','etag','size','last_modified','created_at','last_access','hits'],row))
+
+    def invalidate(self,bucket_name,key):
+        ## called after our own writes so the next lookup goes back to S3
+        try:
+            path=self.getLocalPath(bucket_name,key)
+        except ValueError:
+            ## a key that can't be cached has no entry , only its HEAD result
+            path=None
+        with self._connect() as conn:
+            conn.execute("DELETE FROM object_meta WHERE bucket=? AND key=?",(bucket_name,key))
+            rows=[]
+            if path is not None:
+                rows=conn.execute("SELECT path,bucket,key FROM entries WHERE path=? AND bucket=?",(str(path),bucket_name)).fetchall()
+            rows+=conn.execute("SELECT path,bucket,key FROM entries WHERE bucket=? AND key=? AND derived IS NOT NULL",(bucket_name,key)).fetchall()
+            self._removeEntries(conn,rows)
+        self.removeLocks(bucket_name,key)
+
+    def invalidatePrefix(self,bucket_name,prefix):
+        pattern=prefix.replace('\\','\\\\').replace('%','\\%').replace('_','\\_')+'%'
+        with self._connect() as conn:
+            conn.execute("DELETE FROM object_meta WHERE bucket=? AND key LIKE ? ESCAPE '\\'",(bucket_name,pattern))
+            rows=conn.execute("SELECT path,bucket,key FROM entries WHERE bucket=? AND key LIKE ? ESCAPE '\\'",(bucket_name,pattern)).fetchall()
+            self._removeEntries(conn,rows)
+        for bucket,key in set((r[1],r[2]) for r in rows):
+            self.removeLocks(bucket,key)
+
+    def evict(self,required_bytes=0,keep=None,keep_dirs=None):
+        """Removes entries until the total size (plus required_bytes) fits in the quota.
+        keep (a path or a list of paths) and whatever is below keep_dirs are left alone."""
+        if keep is None:
+            keep=[]
+        elif isinstance(keep,(str,Path)):
+            keep=[keep]
+        keep=set(str(k) for k in keep)
+        kept_dirs=tuple(str(d).rstrip(os.sep)+os.sep for d in keep_dirs or [])
+        evicted=0
+        ## eviction order depends on the latest accesses
+        self.flush()
+        with self._connect() as conn:
+            total=conn.execute("SELECT COALESCE(SUM(size),0) FROM entries").fetchone()[0]
+            if total+required_bytes<=self.max_bytes:
+                return evicted
+            if self.policy=='lfu':
+                order="hits ASC, last_access ASC"
+            else:
+                order="last_access ASC"
+            rows=conn.execute("SELECT path,size,bucket,key FROM entries ORDER BY {}".format(order)).fetchall()
+            evicted_objects=set()
+            for path,size,bucket,key in rows:
+                if total+required_bytes<=self.max_bytes: break
+                if path in keep or path.startswith(kept_dirs): continue
+                try:
+                    Path(path).unlink()
+                except FileNotFoundError:
+                    pass
+                conn.execute("DELETE FROM entries WHERE path=?",(path,))
+                evicted_objects.add((bucket,key))
+                total-=size
+                evicted+=1
+                self._incrementStat('evictions')
+                self._incrementStat('evicted_bytes',size)
+        for bucket,key in evicted_objects:
+            self.removeLocks(bucket,key)
+        return evicted
+
+    def clear(self):
+        with self._connect() as conn:
+            rows=conn.execute("SELECT path,bucket,key FROM entries").fetchall()
+            self._removeEntries(conn,rows)
+            conn.execute("DELETE FROM object_meta")
+        for bucket,key in set((r[1],r[2]) for r in rows):
+            self.removeLocks(bucket,key)
+        return utils.result_message("{} entries removed".format(len(rows)))
+
+    def getStats(self):
+        self.flush()
+        with self._connect() as conn:
+            count,total=conn.execute("SELECT COUNT(*), COALESCE(SUM(size),0) FROM entries").fetchone()
+            counters=dict(conn.execute("SELECT name,value FROM stats").fetchall())
+        res={'entries':count,
+             'total_bytes':total,
+             'max_bytes':self.max_bytes,
+             'policy':self.policy}
+        for name in ['hits','misses','evictions','evicted_bytes','metadata_hits','metadata_misses','derived_hits','derived_misses']:
+            res[name]=counters.get(name,0)
+        lookups=res['hits']+res['misses']
+        res['hit_ratio']=res['hits']/lookups if lookups>0 else 0.0
+        return res
+
+###### utilities
+
+    def _notify(self,bucket_name,key):
+        for listener in self.listeners:
+            try:
+                listener(bucket_name,key)
+            except Exception as e:
+                self.auth.app.logger.warning("Cache access listener failed : {}".format(str(e)))
+
+    @contextmanager
+    def _connect(self):
+        conn=sqlite3.connect(str(self.manifest_path),timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _isFresh(self,path,bucket_name,key,meta):
+        entry=self.getEntry(path)
+        return entry is not None and entry['bucket']==bucket_name and entry['key']==key \
+               and entry['etag']==meta['etag'] and path.exists()
+
+    def _result(self,path,meta):
+        return {'path':path,
+                'size':path.stat().st_size,
+                'etag':meta['etag'],
+                'last_modified':meta['last_modified']}
+
+    def _putEntry(self,path,bucket_name,key,meta):
+        now=time.time()
+        last_modified=meta['last_modified']
+        if isinstance(last_modified,datetime.datetime):
+            last_modified=last_modified.isoformat()
+        with self._connect() as conn:
+            conn.execute("""INSERT OR REPLACE INTO entries
+                            (path,bucket,key,etag,size,last_modified,created_at,last_access,hits)
+                            VALUES (?,?,?,?,?,?,?,?,0)""",
+                         (str(path),bucket_name,key,meta['etag'],path.stat().st_size,last_modified,now,now))
+
+    def _removeEntries(self,conn,rows):
+        for path,_,_ in rows:
+            try:
+                Path(path).unlink()
+            except FileNotFoundError:
+                pass
+            conn.execute("DELETE FROM entries WHERE path=?",(path,))
+
+    def _touch(self,path):
+        with self.pending_lock:
+            _,hits=self.pending_touches.get(str(path),(0,0))
+            self.pending_touches[str(path)]=(time.time(),hits+1)
+        self._flushIfDue()
+
+    def _incrementStat(self,name,value=1):
+        with self.pending_lock:
+            self.pending_stats[name]=self.pending_stats.get(name,0)+value
+        self._flushIfDue()
+
+    def _flushIfDue(self):
+        if time.time()-self.flushed_at>=self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """Writes the pending hits , access times and counters to the manifest in one transaction."""
+        with self.pending_lock:
+            touches,self.pending_touches=self.pending_touches,{}
+            stats,self.pending_stats=self.pending_stats,{}
+            self.flushed_at=time.time()
+        if not touches and not stats:
+            return
+        with self._connect() as conn:
+            conn.executemany("UPDATE entries SET last_access=MAX(last_access,?), hits=hits+? WHERE path=?",
+                             [(t,h,p) for p,(t,h) in touches.items()])
+            conn.executemany("INSERT INTO stats (name,value) VALUES (?,?) ON CONFLICT(name) DO UPDATE SET value=value+excluded.value",
+                             list(stats.items()))
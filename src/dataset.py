@@ -31,16 +31,26 @@ import requests
 from requests.auth import HTTPBasicAuth
 
 class DatasetAPI:
+    ## (path , method) of the endpoints that change the metadata tables , the only ones that bump the dataset data version ;
+    ## the qc entries are also written by the storage API
+    WRITE_ENDPOINTS=frozenset([(p,m) for p in ['/api/v1/dataset/wafers','/api/v1/dataset/chips','/api/v1/dataset/dbits','/api/v1/dataset/qc']
+                                     for m in ['POST','PUT','DELETE']]+
+                              [(p,'POST') for p in ['/api/v1/dataset/wafers/upload','/api/v1/dataset/chips/upload','/api/v1/dataset/dbits/upload']]+
+                              [('/api/v1/storage/qc_entry',m) for m in ['POST','DELETE']])
+
     def __init__(self,auth,datastore,**kwargs):
 
         self.auth=auth
         self.datastore=datastore
         self.bucket_name=self.auth.app.config['S3_BUCKET_NAME']
         self.tempDirectory=Path(self.auth.app.config['TEMP_DIRECTORY'])
+        self.cache_control=self.auth.app.config.get('METADATA_CACHE_CONTROL','private, no-cache')
+        self.modified_field=self.auth.app.config.get('METADATA_MODIFIED_FIELD','modified')
         self.wafers_table=self.datastore.getTable(self.auth.app.config['DATA_TABLES']['metadata.wafers']['table_name'])
         self.chips_table=self.datastore.getTable(self.auth.app.config['DATA_TABLES']['metadata.chips']['table_name'])
         self.dbits_table=self.datastore.getTable(self.auth.app.config['DATA_TABLES']['metadata.dbits']['table_name'])
         self.qc_table=self.datastore.getTable(self.auth.app.config['DATA_TABLES']['studies.qc']['table_name'])
+        self.versions_table=self.datastore.getTable(self.auth.app.config['DATA_TABLES']['application_data']['table_name'])
         self.initialize()
         self.initEndpoints()
         user = self.auth.app.config['SLIMS_USERNAME']
@@ -52,6 +62,16 @@ class DatasetAPI:
 ##### Endpoints
 
     def initEndpoints(self):
+        @self.auth.app.after_request
+        def _bumpDatasetVersion(resp):
+            ## a successful write invalidates the ETags of the dataset lists
+            if (request.path,request.method) in self.WRITE_ENDPOINTS and resp.status_code<400:
+                try:
+                    utils.bump_data_version(self.versions_table,'dataset')
+                except Exception as e:
+                    self.auth.app.logger.exception("Couldn't bump the dataset data version : {}".format(str(e)))
+            return resp
+
 ##### SLIMS
         @self.auth.app.route('/api/v1/dataset/slimstest_list_runids',methods=['GET'])
         @self.auth.login_required
@@ -294,10 +314,13 @@ class DatasetAPI:
             param_options=request.args.get('options',default=None,type=str)
             if param_options is not None:
                 param_options=json.loads(param_options)
+            resp=None
             try:
                 u,g=current_user
                 if request.method=='GET':
-                    res= self.getWafers(param_filter,param_options,u,g)
+                    validators=self.listValidators(self.wafers_table,param_filter,param_options,g)
+                    resp=utils.versioned_response(lambda: utils.stream_json_list(self.getWafers(param_filter,param_options,u,g,stream=True)),
+                                                  validators,self.cache_control,sc)
                 elif request.method=='DELETE':
                     res= self.deleteWafers(param_filter,param_options,u,g)
             except Exception as e:
@@ -306,8 +329,9 @@ class DatasetAPI:
                 res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
                 self.auth.app.logger.exception(res['msg'])
             finally:
-                resp=Response(json.dumps(res),status=sc)
-                resp.headers['Content-Type']='application/json'
+                if resp is None:
+                    resp=Response(json.dumps(res),status=sc)
+                    resp.headers['Content-Type']='application/json'
                 self.auth.app.logger.info(utils.log(str(sc)))
                 return resp  
 
@@ -491,10 +515,13 @@ class DatasetAPI:
             param_options=request.args.get('options',default=None,type=str)
             if param_options is not None:
                 param_options=json.loads(param_options)
+            resp=None
             try:
                 u,g=current_user
                 if request.method=='GET':
-                    res= self.getChips(param_filter,param_options,u,g)
+                    validators=self.listValidators(self.chips_table,param_filter,param_options,g)
+                    resp=utils.versioned_response(lambda: utils.stream_json_list(self.getChips(param_filter,param_options,u,g,stream=True)),
+                                                  validators,self.cache_control,sc)
                 elif request.method=='DELETE':
                     res= self.deleteChips(param_filter,param_options,u,g)
             except Exception as e:
@@ -503,8 +530,9 @@ class DatasetAPI:
                 res=utils.error_message("Error : {} {}".format(str(e),exc),status_code=sc)
                 self.auth.app.logger.exception(res['msg'])
             finally:
-                resp=Response(json.dumps(res),status=sc)
-                resp.headers['Content-Type']='application/json'
+                if resp is None:
+                    resp=Response(json.dumps(res),status=sc)
+                    resp.headers['Content-Type']='application/json'
                 self.auth.app.logger.info(utils.log(str(sc)))
                 return resp  
 
@@ -583,10 +611,14 @@ class DatasetAPI:
             param_options=request.args.get('options',default=None,type=str)
             if param_options is not None:
                 param_options=json.loads(param_options)
+            resp=None
             try:
                 u,g=current_user
                 if request.method=='GET':
-                    res= self.getDBiT(param_filter,param_options,u,g)
+                    ## documents are encoded straight from the cursor , the ETag comes from the write counter and the count
+                    validators=self.listValidators(self.dbits_table,param_filter,param_options,g)
+                    resp=utils.versioned_response(lambda: utils.stream_json_list(self.getDBiT(param_filter,param_options,u,g,stream=True)),
+                                                  validators,self.cache_control,sc)
                 elif request.method=='DELETE':
                     res= self.deleteDBiT(param_filter,param_options,u,g)
             except Exception as e:
@@ -595,8 +627,9 @@ class DatasetAPI:
                 res=utils.error_message("Error : {} {}".format(str(e),exc),status_code=sc)
                 self.auth.app.logger.exception(res['msg'])
             finally:
-                resp=Response(json.dumps(res),status=sc)
-                resp.headers['Content-Type']='application/json'
+                if resp is None:
+                    resp=Response(json.dumps(res),status=sc)
+                    resp.headers['Content-Type']='application/json'
                 self.auth.app.logger.info(utils.log(str(sc)))
                 return resp
 #### Study.QC
@@ -633,17 +666,21 @@ class DatasetAPI:
             param_options=request.args.get('options',default=None,type=str)
             if param_options is not None:
                 param_options=json.loads(param_options)
+            resp=None
             try:
                 u,g=current_user
-                res= self.getQc(param_filter,param_options,u,g)
+                validators=self.listValidators(self.qc_table,param_filter,param_options,g)
+                resp=utils.versioned_response(lambda: utils.stream_json_list(self.getQc(param_filter,param_options,u,g,stream=True)),
+                                              validators,self.cache_control,sc)
             except Exception as e:
                 sc=500
                 exc=traceback.format_exc()
                 res=utils.error_message("Error : {} {}".format(str(e),exc),status_code=sc)
                 self.auth.app.logger.exception(res['msg'])
             finally:
-                resp=Response(json.dumps(res),status=sc)
-                resp.headers['Content-Type']='application/json'
+                if resp is None:
+                    resp=Response(json.dumps(res),status=sc)
+                    resp.headers['Content-Type']='application/json'
                 self.auth.app.logger.info(utils.log(str(sc)))
                 return resp  
 
@@ -898,8 +935,10 @@ class DatasetAPI:
             upsids+=[r.upserted_id]
         return utils.result_message({ 'modified_count':mc, 'upserted_ids':upsids })
 
-    def getWafers(self,fltr,options,username,groups):
+    def getWafers(self,fltr,options,username,groups,stream=False):
         table=self.wafers_table
+        if stream:
+            return table.find(fltr,options)
         res=list(table.find(fltr,options))
         return res 
 
@@ -951,8 +990,10 @@ class DatasetAPI:
             upsids+=[r.upserted_id]
         return utils.result_message({ 'modified_count':mc, 'upserted_ids':upsids })
 
-    def getChips(self,fltr,options,username,groups):
+    def getChips(self,fltr,options,username,groups,stream=False):
         table=self.chips_table
+        if stream:
+            return table.find(fltr,options)
         res=list(table.find(fltr,options))
         return res 
 
@@ -993,8 +1034,23 @@ class DatasetAPI:
             upsids+=[r.upserted_id]
         return utils.result_message({ 'modified_count':mc, 'upserted_ids':upsids })
 
-    def getDBiT(self,fltr,options,username,groups):
+    def listValidators(self,table,fltr,options,groups):
+        ## ETag inputs of a list endpoint : the write counter , the estimated count (from the collection
+        ## metadata , no scan) , the latest modification time and the caller's query and scope
+        return [table.name,utils.data_version(self.versions_table,'dataset'),table.estimated_document_count(),
+                self.lastModified(table),fltr,options,sorted(groups)]
+
+    def lastModified(self,table):
+        ## latest modification time of a collection , catches in-place edits made outside the API
+        if not self.modified_field:
+            return None
+        doc=table.find_one({self.modified_field:{'$exists':True}},{self.modified_field:1},sort=[(self.modified_field,-1)])
+        return (doc or {}).get(self.modified_field)
+
+    def getDBiT(self,fltr,options,username,groups,stream=False):
         table=self.dbits_table
+        if stream:
+            return table.find(fltr,options)
         res=list(table.find(fltr,options))
         return res 
 
@@ -1024,8 +1080,10 @@ class DatasetAPI:
             upsids+=[r.upserted_id]
         return utils.result_message({ 'modified_count':mc, 'upserted_ids':upsids })
 
-    def getQc(self,fltr,options,username,groups):
+    def getQc(self,fltr,options,username,groups,stream=False):
         table=self.qc_table
+        if stream:
+            return table.find(fltr,options)
         res=list(table.find(fltr,options))
         return res 
 
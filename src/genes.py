@@ -13,7 +13,6 @@ from flask import request, Response , send_from_directory
 from flask_jwt_extended import jwt_required,get_jwt_identity,current_user
 from werkzeug.utils import secure_filename
 # import miscellaneous modules
-import os
 import io
 import uuid
 import time
@@ -22,12 +21,12 @@ import sys
 import json
 from pathlib import Path
 import random
-import datetime
 import shutil
 import copy
 import yaml
 import csv
 from . import utils 
+from . import tabular
 import scanpy as sc
 import numpy as np 
 import gzip
@@ -45,6 +44,7 @@ class GeneAPI:
         self.tempDirectory=Path(self.auth.app.config['TEMP_DIRECTORY'])
         self.qc_table=self.datastore.getTable(self.auth.app.config['DATA_TABLES']['studies.qc']['table_name'])
         self.aws_s3=boto3.client('s3')
+        self.object_cache=self.auth.app.config['SUBMODULES']['ObjectCache']
         self.initialize()
         self.initEndpoints()
 
@@ -96,17 +96,25 @@ class GeneAPI:
         def _getSpatialData():
             sc=200
             res=None
+            resp=None
             req=request.get_json()
             try:
-                res=self.get_SpatialData(req)
+                if req.get('format','json')!='json':
+                    resp=self.spatialDataResponse(self.get_SpatialDataColumnar(req))
+                else:
+                    res=self.get_SpatialData(req)
+            except ValueError as e:
+                sc=400
+                res=utils.error_message(str(e),status_code=sc)
             except Exception as e:
                 sc=500
                 exc=traceback.format_exc()
                 res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
                 self.auth.app.logger.exception(res['msg'])
             finally:
-                resp=Response(json.dumps(res),status=sc)
-                resp.headers['Content-Type']='application/json'
+                if resp is None:
+                    resp=Response(json.dumps(res),status=sc)
+                    resp.headers['Content-Type']='application/json'
                 self.auth.app.logger.info(utils.log(str(sc)))
                 return resp
         
@@ -114,17 +122,25 @@ class GeneAPI:
         def _getSpatialDataByToken(token):
             sc=200
             res=None
+            resp=None
             req=request.get_json()
             try:
-                res=self.get_SpatialDataByToken(token, req)
+                if req.get('format','json')!='json':
+                    resp=self.spatialDataResponse(self.get_SpatialDataColumnarByToken(token, req))
+                else:
+                    res=self.get_SpatialDataByToken(token, req)
+            except ValueError as e:
+                sc=400
+                res=utils.error_message(str(e),status_code=sc)
             except Exception as e:
                 sc=500
                 exc=traceback.format_exc()
                 res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
                 self.auth.app.logger.exception(res['msg'])
             finally:
-                resp=Response(json.dumps(res),status=sc)
-                resp.headers['Content-Type']='application/json'
+                if resp is None:
+                    resp=Response(json.dumps(res),status=sc)
+                    resp.headers['Content-Type']='application/json'
                 self.auth.app.logger.info(utils.log(str(sc)))
                 return resp
         
@@ -273,6 +289,11 @@ class GeneAPI:
       return self.get_GeneMotifNames({'filename': data})
   
     def get_SpatialData(self, req):
+      slicing = tabular.slicing_params(req)
+      if tabular.has_slicing(slicing):
+        ## offset / limit / columns / where through the per ETag line index
+        out, _ = tabular.read_rows(self.object_cache, self.bucket_name, req['filename'], **slicing)
+        return out
       out = []
       name = self.getFileObject(self.bucket_name, req['filename'])
       if '.gz' not in req['filename']:
@@ -287,11 +308,32 @@ class GeneAPI:
               out.append(r)
       return out
     
+    def get_SpatialDataColumnar(self, req):
+      ## format=npy or format=arrow : typed columns instead of lists of strings
+      return tabular.columnar_object(self.object_cache, self.bucket_name, req['filename'], req['format'], req.get('header', 'auto'))
+
+    def get_SpatialDataColumnarByToken(self, token, request):
+      req = self.decodeLink(token, None, None)
+      data = req['args'][request['key']]
+      return self.get_SpatialDataColumnar({'filename': data, 'format': request['format'], 'header': request.get('header', 'auto')})
+
+    def spatialDataResponse(self, obj):
+      if obj is None:
+        res = utils.error_message("The file doesn't exists", status_code=404)
+        resp = Response(json.dumps(res), status=404)
+        resp.headers['Content-Type'] = 'application/json'
+        return resp
+      mimetype = tabular.FORMATS[Path(obj['path']).suffix[1:]][1]
+      ## same serving path as the storage endpoints (x-accel / sendfile , ranges , Cache-Control) ;
+      ## StorageAPI is created after this module , so it is looked up per request
+      return self.auth.app.config['SUBMODULES']['StorageAPI'].fileResponse(obj, mimetype=mimetype)
+
     def get_SpatialDataByToken(self, token, request):
       req = self.decodeLink(token, None, None)
       key = request['key']
       data = req['args'][key]
-      return self.get_SpatialData({'filename': data})
+      params = {k: request[k] for k in ['offset', 'limit', 'columns', 'where'] if k in request}
+      return self.get_SpatialData(dict(params, filename=data))
       
     def getGeneExpressions(self,req, u, g): ## gene expression array 
         if "filename" not in req: return utils.error_message("No filename is provided",500)
@@ -316,33 +358,19 @@ class GeneAPI:
       return data + lenOfTixels 
     def checkFileExists(self,bucket_name,filename):
       try:
-          object = self.aws_s3.head_object(Bucket=bucket_name, Key=filename)
-          date = object['LastModified']
-          size = object['ContentLength']
-          return 200, True, date, size
+          meta = self.object_cache.headObject(bucket_name, filename)
       except:
           return 404, False, '', ''
+      if not meta['exists']:
+          return 404, False, '', ''
+      return 200, True, meta['last_modified'], meta['size']
     def getFileObject(self,bucket_name,filename):
-        _,tf,date,size=self.checkFileExists(bucket_name,filename)
-        temp_outpath=self.tempDirectory.joinpath(filename)
-        if not tf :
+        obj=self.object_cache.getObject(bucket_name,filename)
+        if obj is None :
+            temp_outpath=self.tempDirectory.joinpath(filename)
             if temp_outpath.exists(): return str(temp_outpath)
             else: return utils.error_message("The file doesn't exists in aws or on server",status_code=404)
-        else:
-            if not temp_outpath.exists():
-              temp_outpath.parent.mkdir(parents=True, exist_ok=True)
-              f=open(temp_outpath,'wb+')
-              self.aws_s3.download_fileobj(bucket_name,filename,f)
-              f.close()
-            else:
-              modified_time = os.path.getmtime(temp_outpath)
-              formatted = datetime.datetime.fromtimestamp(modified_time)
-              if date.replace(tzinfo=None) > formatted and size > 0:
-                f=open(temp_outpath,'wb+')
-                self.aws_s3.download_fileobj(bucket_name,filename,f)
-                f.close()
-
-            return str(temp_outpath)
+        return str(obj['path'])
 
     def getFileObjectGzip(self,bucket_name,filename):
         _,tf=self.checkFileExists(bucket_name,filename)
@@ -0,0 +1,267 @@
+##################################################################################
+### Module : imaging.py
+### Description : Image helpers for the storage image endpoints (tile pyramids , encoding)
+###
+###   Tile pyramids follow the Deep Zoom layout : level L is the image scaled by
+###   2^(L-top) where top=ceil(log2(max(width,height))) , cut in square tiles.
+###
+###   Rendered outputs are described by an operation chain , a list of tuples
+###   applied in order : ('channel',c) , ('rotate',degree) , ('crop',x1,x2,y1,y2) ,
+###   ('resize',max_width,max_height). render_name turns the chain into the
+###   derived file name used by the cache.
+###
+###   Right-angle rotations are done with transpose/flip (no interpolation) and
+###   JPEG sources are decoded at 1/2 , 1/4 or 1/8 scale when the chain only
+###   needs a smaller output.
+###
+###   Output formats are negotiated from the 'format' parameter and the Accept
+###   header ; AVIF is only offered when the OpenCV build can write it. Output
+###   sizes and qualities are snapped to a few values (OUTPUT_SIZES ,
+###   OUTPUT_QUALITIES) since every variant is a cache entry.
+###
+###   Thumbnails are built as a set (every size in every format) by a plain
+###   function so it can run in a process pool , and named after the hash of
+###   their own bytes so they can be cached forever.
+###
+### Copyrighted reserved by AtlasXomics
+##################################################################################
+
+import math
+import hashlib
+import cv2
+import numpy as np
+from PIL import Image
+
+def top_level(width,height):
+    return int(math.ceil(math.log2(max(width,height,1))))
+
+def level_dimensions(width,height,level):
+    scale=2**(top_level(width,height)-level)
+    return max(1,int(math.ceil(width/scale))),max(1,int(math.ceil(height/scale)))
+
+def tile_grid(width,height,tile_size):
+    return int(math.ceil(width/tile_size)),int(math.ceil(height/tile_size))
+
+def build_pyramid(img,tile_size):
+    """Yields (level , [(col,row,tile), ...]) from the full resolution level down to 1x1."""
+    height,width=img.shape[:2]
+    level_img=img
+    for level in range(top_level(width,height),-1,-1):
+        lw,lh=level_dimensions(width,height,level)
+        if (level_img.shape[1],level_img.shape[0])!=(lw,lh):
+            ## each level is reduced from the previous one , not from the source
+            level_img=cv2.resize(level_img,(lw,lh),interpolation=cv2.INTER_AREA)
+        cols,rows=tile_grid(lw,lh,tile_size)
+        tiles=[]
+        for row in range(rows):
+            for col in range(cols):
+                tiles.append((col,row,level_img[row*tile_size:(row+1)*tile_size,col*tile_size:(col+1)*tile_size]))
+        yield level,tiles
+
+def render_tile(img,level,col,row,tile_size):
+    """One tile of the pyramid , cut from the source and scaled down on its own."""
+    height,width=img.shape[:2]
+    scale=2**(top_level(width,height)-level)
+    lw,lh=level_dimensions(width,height,level)
+    tw=min(tile_size,lw-col*tile_size)
+    th=min(tile_size,lh-row*tile_size)
+    x0,y0=col*tile_size*scale,row*tile_size*scale
+    region=img[y0:min(height,(row*tile_size+th)*scale),x0:min(width,(col*tile_size+tw)*scale)]
+    if (region.shape[1],region.shape[0])==(tw,th):
+        return region
+    return cv2.resize(region,(tw,th),interpolation=cv2.INTER_AREA)
+
+RIGHT_ANGLE_ROTATIONS={90:cv2.ROTATE_90_COUNTERCLOCKWISE,180:cv2.ROTATE_180,270:cv2.ROTATE_90_CLOCKWISE}
+REDUCED_FLAGS={cv2.IMREAD_COLOR:{2:cv2.IMREAD_REDUCED_COLOR_2,4:cv2.IMREAD_REDUCED_COLOR_4,8:cv2.IMREAD_REDUCED_COLOR_8},
+               cv2.IMREAD_GRAYSCALE:{2:cv2.IMREAD_REDUCED_GRAYSCALE_2,4:cv2.IMREAD_REDUCED_GRAYSCALE_4,8:cv2.IMREAD_REDUCED_GRAYSCALE_8}}
+
+def rotate_no_cropping(img,degree):
+    ## degrees are counter-clockwise , as with cv2.getRotationMatrix2D
+    degree=degree%360
+    if degree==0:
+        return img
+    if degree in RIGHT_ANGLE_ROTATIONS:
+        return cv2.rotate(img,RIGHT_ANGLE_ROTATIONS[degree])
+    (h, w) = img.shape[:2]
+    (cX, cY) = (w // 2, h // 2)
+    M = cv2.getRotationMatrix2D((cX, cY), degree, 1.0)
+    abs_cos = abs(M[0,0])
+    abs_sin = abs(M[0,1])
+    bound_w = int(h * abs_sin + w * abs_cos)
+    bound_h = int(h * abs_cos + w * abs_sin)
+    M[0, 2] += bound_w/2 - cX
+    M[1, 2] += bound_h/2 - cY
+    return cv2.warpAffine(img, M, (bound_w, bound_h))
+
+def apply_ops(img,ops):
+    for op in ops:
+        if op[0]=='channel':
+            if img.ndim==3:
+                ## contiguous single channel copy , the geometric ops below then work on 1/3 of the data
+                img=cv2.extractChannel(img,op[1])
+        elif op[0]=='rotate':
+            if op[1]!=0:
+                img=rotate_no_cropping(img,op[1])
+        elif op[0]=='crop':
+            x1,x2,y1,y2=op[1:]
+            img=img[y1:y2,x1:x2]
+        elif op[0]=='resize':
+            img=fit_image(img,op[1],op[2])
+        else:
+            raise Exception("Unknown image operation : {}".format(op[0]))
+    return img
+
+def fit_scale(width,height,max_width=None,max_height=None):
+    scale=1.0
+    if max_width:
+        scale=min(scale,max_width/width)
+    if max_height:
+        scale=min(scale,max_height/height)
+    return scale
+
+def fit_image(img,max_width=None,max_height=None):
+    ## downscale only , keeping the aspect ratio
+    height,width=img.shape[:2]
+    scale=fit_scale(width,height,max_width,max_height)
+    if scale>=1.0:
+        return img
+    size=(max(1,int(round(width*scale))),max(1,int(round(height*scale))))
+    return cv2.resize(img,size,interpolation=cv2.INTER_AREA)
+
+def reduction_factor(width,height,ops):
+    """Largest JPEG decode reduction (1 , 2 , 4 or 8) that still yields at least the resolution the chain outputs."""
+    for op in ops:
+        if op[0]=='channel':
+            continue
+        if op[0]=='rotate':
+            degree=op[1]%360
+            if degree in (90,270):
+                width,height=height,width
+            elif degree not in (0,180):
+                return 1
+            continue
+        if op[0]=='resize':
+            scale=fit_scale(width,height,op[1],op[2])
+            for factor in (8,4,2):
+                if scale*factor<=1.0:
+                    return factor
+        ## crop boxes are in source coordinates , decode at full size
+        return 1
+    return 1
+
+def read_image(path,ops=(),flags=cv2.IMREAD_COLOR):
+    path=str(path)
+    factor=1
+    if path.lower().endswith(('.jpg','.jpeg')) and flags in REDUCED_FLAGS:
+        ## the JPEG header gives the size without decoding
+        with Image.open(path) as im:
+            width,height=im.size
+        factor=reduction_factor(width,height,ops)
+    if factor>1:
+        return cv2.imread(path,REDUCED_FLAGS[flags][factor])
+    return cv2.imread(path,flags)
+
+def render_name(ops,ext='.jpg',quality=None):
+    parts=[op[0]+'-'.join(str(v) for v in op[1:]) for op in ops]
+    if quality is not None:
+        parts.append('q{}'.format(int(quality)))
+    return 'render/{}{}'.format('.'.join(parts) or 'original',ext)
+
+FORMATS={'jpg':('.jpg','image/jpeg'),
+         'png':('.png','image/png'),
+         'webp':('.webp','image/webp'),
+         'avif':('.avif','image/avif')}
+
+def supported_formats():
+    return [k for k,(ext,_) in FORMATS.items() if cv2.haveImageWriter(ext)]
+
+def negotiate_format(requested,accept,default='jpg'):
+    """Returns (name , ext , mimetype) for a 'format' parameter (jpg , png , webp , avif or auto)."""
+    requested=(requested or default).lower().replace('jpeg','jpg')
+    supported=supported_formats()
+    if requested=='auto':
+        requested=default
+        accept=accept or ''
+        for candidate in ['avif','webp']:
+            if 'image/'+candidate in accept and candidate in supported:
+                requested=candidate
+                break
+    if requested not in FORMATS or requested not in supported:
+        raise ValueError("Unsupported image format : {}".format(requested))
+    ext,mimetype=FORMATS[requested]
+    return requested,ext,mimetype
+
+OUTPUT_SIZES=(256,512,1024,2048,4096)
+OUTPUT_QUALITIES=(50,75,90)
+
+def snap_value(value,allowed,name,strict=False):
+    """value if allowed , else the next allowed value (the largest one above all of them) ; strict raises ValueError instead."""
+    if value is None or value in allowed:
+        return value
+    if strict:
+        raise ValueError("Unsupported {} : {} (one of {})".format(name,value,', '.join(str(v) for v in sorted(allowed))))
+    larger=[v for v in sorted(allowed) if v>=value]
+    return larger[0] if larger else max(allowed)
+
+def encode_image(img,ext='.jpg',quality=None):
+    params=[]
+    if quality is not None:
+        quality=max(1,min(100,int(quality)))
+        if ext in ['.jpg','.jpeg']:
+            params=[cv2.IMWRITE_JPEG_QUALITY,quality]
+        elif ext=='.webp':
+            params=[cv2.IMWRITE_WEBP_QUALITY,quality]
+        elif ext=='.avif' and hasattr(cv2,'IMWRITE_AVIF_QUALITY'):
+            params=[cv2.IMWRITE_AVIF_QUALITY,quality]
+        elif ext=='.png':
+            ## lossless , quality maps to the zlib level instead
+            params=[cv2.IMWRITE_PNG_COMPRESSION,max(0,min(9,quality//10))]
+    success,encoded=cv2.imencode(ext,img,params)
+    if not success:
+        raise Exception("Couldn't encode the image as {}".format(ext))
+    return encoded.tobytes()
+
+def decode_image(data,flags=cv2.IMREAD_COLOR):
+    return cv2.imdecode(np.frombuffer(data,dtype=np.uint8),flags)
+
+def assemble_crop(read_tile,width,height,tile_size,x1,x2,y1,y2):
+    """Builds the [y1:y2 , x1:x2] crop of a pyramid level (width x height) from its tiles.
+    read_tile(col,row) returns the decoded tile."""
+    x1,x2=max(0,x1),min(width,x2)
+    y1,y2=max(0,y1),min(height,y2)
+    if x2<=x1 or y2<=y1:
+        raise ValueError("Empty crop box")
+    canvas=None
+    for row in range(y1//tile_size,(y2-1)//tile_size+1):
+        for col in range(x1//tile_size,(x2-1)//tile_size+1):
+            tile=read_tile(col,row)
+            if canvas is None:
+                canvas=np.zeros((y2-y1,x2-x1)+tile.shape[2:],dtype=tile.dtype)
+            tx,ty=col*tile_size,row*tile_size
+            ## intersection of the tile and the crop box , in level coordinates
+            ix1,ix2=max(x1,tx),min(x2,tx+tile.shape[1])
+            iy1,iy2=max(y1,ty),min(y2,ty+tile.shape[0])
+            canvas[iy1-y1:iy2-y1,ix1-x1:ix2-x1]=tile[iy1-ty:iy2-ty,ix1-tx:ix2-tx]
+    return canvas
+
+THUMBNAIL_SIZES=(100,200,400)
+THUMBNAIL_FORMATS=('webp','png')
+
+def build_thumbnails(data,sizes=THUMBNAIL_SIZES,formats=THUMBNAIL_FORMATS,quality=80):
+    """Returns [(size , format , bytes), ...] for an encoded image , each fitting in size x size."""
+    img=decode_image(data,cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise Exception("Couldn't decode the image")
+    supported=supported_formats()
+    res=[]
+    for size in sizes:
+        thumb=fit_image(img,size,size)
+        for fmt in formats:
+            if fmt not in supported:
+                continue
+            ext,_=FORMATS[fmt]
+            res.append((size,fmt,encode_image(thumb,ext,None if fmt=='png' else quality)))
+    return res
+
+def thumbnail_name(stem,size,fmt,data):
+    return '{}.{}.{}{}'.format(stem,size,hashlib.sha1(data).hexdigest()[:12],FORMATS[fmt][0])
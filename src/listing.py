@@ -0,0 +1,268 @@
+##################################################################################
+### Module : listing.py
+### Description : In-memory index of S3 bucket listings
+###
+###   Each bucket is kept as a sorted array of keys with parallel size / ETag /
+###   mtime arrays , so prefix queries are two bisects instead of a paginated
+###   list_objects call. Only the prefixes that are queried are listed , on
+###   first use ; once a prefix is LISTING_REFRESH_SECONDS old , the next query
+###   starts a background re-listing and is answered from the previous snapshot.
+###   Queries only wait for S3 when a prefix was never loaded or our own writes
+###   invalidated it. Prefixes not queried for LISTING_IDLE_SECONDS are dropped.
+###   Our own writes update the index directly , writes from other workers show
+###   up within about LISTING_REFRESH_SECONDS , so zips and moves list S3
+###   directly.
+###
+###   The content hash index maps (sha256 , size) of uploaded objects to their
+###   key and ETag. It is kept in Mongo since S3 ETags aren't content hashes and
+###   can't be recomputed from a listing ; entries are checked against the
+###   object's current ETag before being reused and dropped when stale.
+###
+### Copyrighted reserved by AtlasXomics
+##################################################################################
+
+import time
+import bisect
+import threading
+from array import array
+## aws
+import boto3
+
+class BucketIndex:
+    def __init__(self):
+        self.keys=[]
+        self.keys_lower=[]
+        self.sizes=array('q')
+        self.mtimes=array('d')
+        self.etags=[]
+
+    def span(self,prefix):
+        start=bisect.bisect_left(self.keys,prefix)
+        stop=bisect.bisect_left(self.keys,prefix+'\U0010ffff')
+        return start,stop
+
+    def replace(self,prefix,objects):
+        ## objects must be sorted by key (as returned by S3) and all start with prefix
+        start,stop=self.span(prefix)
+        keys=[o['Key'] for o in objects]
+        self.keys[start:stop]=keys
+        self.keys_lower[start:stop]=[k.lower() for k in keys]
+        self.sizes[start:stop]=array('q',[o['Size'] for o in objects])
+        self.mtimes[start:stop]=array('d',[o['LastModified'].timestamp() for o in objects])
+        self.etags[start:stop]=[o['ETag'].strip('"') for o in objects]
+
+    def put(self,key,size,etag,mtime):
+        i=bisect.bisect_left(self.keys,key)
+        if i<len(self.keys) and self.keys[i]==key:
+            self.sizes[i]=size
+            self.etags[i]=etag
+            self.mtimes[i]=mtime
+            return
+        self.keys.insert(i,key)
+        self.keys_lower.insert(i,key.lower())
+        self.sizes.insert(i,size)
+        self.mtimes.insert(i,mtime)
+        self.etags.insert(i,etag)
+
+    def remove(self,key):
+        i=bisect.bisect_left(self.keys,key)
+        if i<len(self.keys) and self.keys[i]==key:
+            del self.keys[i]
+            del self.keys_lower[i]
+            del self.sizes[i]
+            del self.mtimes[i]
+            del self.etags[i]
+
+    def entry(self,i):
+        return {'key':self.keys[i],'size':self.sizes[i],'etag':self.etags[i],'mtime':self.mtimes[i]}
+
+class ListingIndex:
+    def __init__(self,auth,**kwargs):
+        self.auth=auth
+        self.enabled=self.auth.app.config.get('LISTING_INDEX_ENABLED',True)
+        ## listings are only kept for these buckets , others are listed directly
+        self.bucket_names=self.auth.app.config.get('LISTING_INDEX_BUCKETS',None) or [self.auth.app.config['S3_BUCKET_NAME']]
+        self.refresh_seconds=float(self.auth.app.config.get('LISTING_REFRESH_SECONDS',30))
+        self.idle_seconds=float(self.auth.app.config.get('LISTING_IDLE_SECONDS',1800))
+        self.aws_s3=boto3.client('s3')
+        self.buckets={}
+        ## bucket -> {listed prefix : listing time} , and (bucket , prefix) -> last query time
+        self.loaded={}
+        self.used={}
+        ## (bucket , prefix) being re-listed in the background
+        self.refreshing=set()
+        self.lock=threading.RLock()
+
+###### queries
+
+    def covers(self,bucket_name):
+        return self.enabled and bucket_name in self.bucket_names
+
+    def listKeys(self,bucket_name,prefix,delimiter=None):
+        index=self.getBucket(bucket_name,prefix)
+        with self.lock:
+            start,stop=index.span(prefix)
+            keys=index.keys[start:stop]
+        if delimiter:
+            ## same as S3 'Contents' with a delimiter : nothing below the next delimiter
+            keys=[k for k in keys if delimiter not in k[len(prefix):]]
+        return keys
+
+    def listEntries(self,bucket_name,prefix):
+        index=self.getBucket(bucket_name,prefix)
+        with self.lock:
+            start,stop=index.span(prefix)
+            return [index.entry(i) for i in range(start,stop)]
+
+    def searchKeys(self,bucket_name,prefix,substrings):
+        ## case-insensitive substring match , on the pre-lowered keys
+        substrings=[s.lower() for s in substrings]
+        index=self.getBucket(bucket_name,prefix)
+        with self.lock:
+            start,stop=index.span(prefix)
+            keys=index.keys[start:stop]
+            keys_lower=index.keys_lower[start:stop]
+        return [k for k,kl in zip(keys,keys_lower) if any(s in kl for s in substrings)]
+
+    def listFolders(self,bucket_name,prefix,delimiter='/'):
+        index=self.getBucket(bucket_name,prefix)
+        res=[]
+        with self.lock:
+            start,stop=index.span(prefix)
+            i=start
+            while i<stop:
+                rest=index.keys[i][len(prefix):]
+                pos=rest.find(delimiter)
+                if pos<0:
+                    i+=1
+                    continue
+                folder=rest[:pos]
+                res.append(folder)
+                ## jump over everything inside this folder
+                i=bisect.bisect_left(index.keys,prefix+folder+delimiter+'\U0010ffff',i,stop)
+        return res
+
+###### maintenance
+
+    def getBucket(self,bucket_name,prefix=''):
+        """Index of the bucket with prefix loaded , listing only that prefix if it isn't (or was invalidated).
+        A stale prefix is re-listed in the background and the current snapshot is returned."""
+        now=time.time()
+        with self.lock:
+            index=self.buckets.setdefault(bucket_name,BucketIndex())
+            loaded=self.loaded.setdefault(bucket_name,{})
+            ## the longest loaded prefix of the query answers it
+            covering=next((prefix[:i] for i in range(len(prefix),-1,-1) if prefix[:i] in loaded),None)
+            if covering is not None:
+                self.used[(bucket_name,covering)]=now
+                ## 0 : invalidated by our own write , the snapshot is known to be wrong
+                if loaded[covering]>0:
+                    if loaded[covering]<=now-self.refresh_seconds:
+                        self.refreshInBackground(bucket_name,covering)
+                    return index
+        self.loadPrefix(bucket_name,prefix)
+        return index
+
+    def refreshInBackground(self,bucket_name,prefix):
+        ## at most one re-listing per prefix at a time
+        with self.lock:
+            if (bucket_name,prefix) in self.refreshing:
+                return
+            self.refreshing.add((bucket_name,prefix))
+        def refresh():
+            try:
+                self.loadPrefix(bucket_name,prefix)
+            except Exception as e:
+                self.auth.app.logger.warning("Couldn't refresh the listing of s3://{}/{} : {}".format(bucket_name,prefix,str(e)))
+            finally:
+                with self.lock:
+                    self.refreshing.discard((bucket_name,prefix))
+        threading.Thread(target=refresh,daemon=True).start()
+
+    def loadPrefix(self,bucket_name,prefix):
+        objects=self.listAll(bucket_name,prefix)
+        now=time.time()
+        with self.lock:
+            index=self.buckets.setdefault(bucket_name,BucketIndex())
+            loaded=self.loaded.setdefault(bucket_name,{})
+            index.replace(prefix,objects)
+            ## narrower prefixes are now part of this one
+            for p in [p for p in loaded if p.startswith(prefix)]:
+                del loaded[p]
+                self.used.pop((bucket_name,p),None)
+            loaded[prefix]=now
+            self.used[(bucket_name,prefix)]=now
+            self.evictIdle(bucket_name,now)
+
+    def evictIdle(self,bucket_name,now):
+        ## prefixes nobody queried for a while are dropped , so memory follows the working set
+        loaded=self.loaded[bucket_name]
+        index=self.buckets[bucket_name]
+        cutoff=now-self.idle_seconds
+        for p in sorted(loaded):
+            nested=[q for q in loaded if q.startswith(p)]
+            if not nested or any(self.used.get((bucket_name,q),0)>=cutoff for q in nested):
+                continue
+            if not any(p.startswith(q) for q in loaded if q!=p):
+                index.replace(p,[])
+            for q in nested:
+                del loaded[q]
+                self.used.pop((bucket_name,q),None)
+
+    def isLoaded(self,bucket_name,key):
+        loaded=self.loaded.get(bucket_name,{})
+        return any(key[:i] in loaded for i in range(len(key)+1))
+
+    def put(self,bucket_name,key,size,etag=None,mtime=None):
+        """Add or update a key we just wrote , if its prefix is loaded."""
+        with self.lock:
+            if self.isLoaded(bucket_name,key):
+                self.buckets[bucket_name].put(key,size,etag or '',mtime or time.time())
+
+    def invalidate(self,bucket_name,key):
+        ## re-list the folder of a key on its next query
+        self.invalidatePrefix(bucket_name,key[:key.rfind('/')+1])
+
+    def invalidatePrefix(self,bucket_name,prefix):
+        with self.lock:
+            loaded=self.loaded.get(bucket_name,{})
+            for p in list(loaded):
+                if p.startswith(prefix) or prefix.startswith(p):
+                    loaded[p]=0
+
+    def remove(self,bucket_name,key):
+        with self.lock:
+            index=self.buckets.get(bucket_name)
+            if index is not None:
+                index.remove(key)
+
+    def listAll(self,bucket_name,prefix):
+        paginator=self.aws_s3.get_paginator('list_objects_v2')
+        res=[]
+        for page in paginator.paginate(Bucket=bucket_name,Prefix=prefix):
+            res+=page.get('Contents',[])
+        return res
+
+class ContentHashIndex:
+    def __init__(self,table):
+        self.table=table
+        try:
+            self.table.create_index([('sha256',1),('size',1)])
+        except Exception:
+            pass
+
+    def record(self,bucket_name,key,sha256,size,etag):
+        ## one entry per object , overwriting a key replaces its hash
+        self.table.replace_one({'_id':'{}/{}'.format(bucket_name,key)},
+                               {'_id':'{}/{}'.format(bucket_name,key),'bucket_name':bucket_name,'key':key,
+                                'sha256':sha256,'size':int(size),'etag':etag},upsert=True)
+
+    def lookup(self,sha256,size,is_current,bucket_name=None):
+        """First indexed object with this content for which is_current(entry) holds , preferring bucket_name."""
+        entries=list(self.table.find({'sha256':sha256,'size':int(size)}))
+        entries.sort(key=lambda e:e['bucket_name']!=bucket_name)
+        for entry in entries:
+            if is_current(entry):
+                return entry
+            self.table.delete_one({'_id':entry['_id']})
+        return None
@@ -0,0 +1,121 @@
+##################################################################################
+### Module : prefetch.py
+### Description : Run-aware prefetching into the local object cache
+###
+###   Opening a run always reads the same files first (metadata , tissue
+###   positions , gene names , the hires image). When any object under a run
+###   prefix (<root>/<run id>/...) goes through the object cache , the rest of
+###   those files , the PREFETCH_FILES entries of its studies.qc record , are
+###   downloaded in the background ; raw matrices and barcodes never are. A run is
+###   queued at most once per PREFETCH_RUN_TTL seconds , at most PREFETCH_WORKERS
+###   downloads run at a time and at most PREFETCH_MAX_BYTES_PER_RUN bytes are
+###   downloaded per run , in PREFETCH_FILES order. Files already in the cache
+###   don't count against that budget.
+###
+### Copyrighted reserved by AtlasXomics
+##################################################################################
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+## sections of a qc entry's 'files'
+SECTIONS=['meta','data','images']
+## entries the viewer reads first , in the order they are fetched
+DEFAULT_FILES=['metadata','tissue_positions_list','scalefactors_json','genes','tissue_hires_image','tissue_lowres_image']
+## raw count matrices , only read by downloads and the analysis jobs
+RAW_SUFFIXES=('.mtx','.mtx.gz','barcodes.tsv','barcodes.tsv.gz')
+
+class RunPrefetcher:
+    def __init__(self,auth,object_cache,qc_table,**kwargs):
+        self.auth=auth
+        self.object_cache=object_cache
+        self.qc_table=qc_table
+        self.enabled=self.auth.app.config.get('PREFETCH_ENABLED',True)
+        self.workers=int(self.auth.app.config.get('PREFETCH_WORKERS',4))
+        self.max_bytes=int(self.auth.app.config.get('PREFETCH_MAX_BYTES_PER_RUN',1024**3))
+        self.run_ttl=float(self.auth.app.config.get('PREFETCH_RUN_TTL',600))
+        self.files=self.auth.app.config.get('PREFETCH_FILES',None) or DEFAULT_FILES
+        self.recent={}
+        self.pool=None
+        self.lock=threading.Lock()
+        self.stats={'runs':0,'files':0,'bytes':0,'skipped':0,'failed':0}
+
+    def notify(self,bucket_name,key):
+        """Called on every object cache access , queues the run of the key if it wasn't recently."""
+        if not self.enabled or threading.current_thread().name.startswith('prefetch'):
+            return
+        parts=key.split('/')
+        if len(parts)<3 or not parts[0] or not parts[1]:
+            return
+        root,run_id=parts[0],parts[1]
+        now=time.time()
+        with self.lock:
+            if self.recent.get((bucket_name,root,run_id),0)>now-self.run_ttl:
+                return
+            if len(self.recent)>10000:
+                self.recent={k:t for k,t in self.recent.items() if t>now-self.run_ttl}
+            self.recent[(bucket_name,root,run_id)]=now
+            if self.pool is None:
+                ## created on first use so that it runs in the worker process
+                self.pool=ThreadPoolExecutor(max_workers=self.workers,thread_name_prefix='prefetch')
+        self.pool.submit(self.prefetchRun,bucket_name,root,run_id,key)
+
+    def workingSet(self,root,run_id):
+        entry=self.qc_table.find_one({'id':run_id})
+        if entry is None:
+            return []
+        files=entry.get('files',{})
+        if files.get('root',root)!=root:
+            return []
+        paths={}
+        for section in SECTIONS:
+            for name,path in (files.get(section) or {}).items():
+                paths.setdefault(name,path)
+        keys=[]
+        for name in self.files:
+            path=paths.get(name)
+            if not path or path.endswith(RAW_SUFFIXES):
+                continue
+            key='{}/{}'.format(root,path)
+            if key not in keys:
+                keys.append(key)
+        return keys
+
+    def prefetchRun(self,bucket_name,root,run_id,requested_key):
+        try:
+            budget=self.max_bytes
+            queued=0
+            for key in self.workingSet(root,run_id):
+                if key==requested_key:
+                    continue
+                meta=self.object_cache.headObject(bucket_name,key)
+                if not meta['exists'] or self.object_cache.isCached(bucket_name,key,meta):
+                    continue
+                if meta['size']>budget:
+                    with self.lock:
+                        self.stats['skipped']+=1
+                    continue
+                budget-=meta['size']
+                queued+=1
+                self.pool.submit(self.fetch,bucket_name,key)
+            with self.lock:
+                self.stats['runs']+=1
+            self.auth.app.logger.info("Prefetching {} files ({} bytes) of {}/{}".format(queued,self.max_bytes-budget,root,run_id))
+        except Exception as e:
+            self.auth.app.logger.exception("Prefetch of {}/{} failed : {}".format(root,run_id,str(e)))
+
+    def fetch(self,bucket_name,key):
+        try:
+            obj=self.object_cache.getObject(bucket_name,key)
+            with self.lock:
+                self.stats['files']+=1
+                self.stats['bytes']+=obj['size'] if obj is not None else 0
+        except Exception as e:
+            with self.lock:
+                self.stats['failed']+=1
+            self.auth.app.logger.warning("Prefetch of s3://{}/{} failed : {}".format(bucket_name,key,str(e)))
+
+    def getStats(self):
+        with self.lock:
+            return dict(self.stats,enabled=self.enabled,max_bytes_per_run=self.max_bytes,workers=self.workers)
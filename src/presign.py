@@ -0,0 +1,136 @@
+##################################################################################
+### Module : presign.py
+### Description : Presigned S3 GET urls , signed locally with SigV4
+###
+###   The SigV4 signing key only depends on the secret key , the date and the
+###   region , so it is derived once per day/region instead of once per url.
+###   Urls are memoized per (bucket , key , expiry) inside a time window of
+###   PRESIGN_WINDOW_SECONDS : the signature date is the start of the window and
+###   X-Amz-Expires is extended by the window length , so a memoized url is
+###   always valid for at least the requested expiry. SigV4 caps X-Amz-Expires at
+###   7 days : expiries that leave no room for the window (above MAX_EXPIRY minus
+###   PRESIGN_WINDOW_SECONDS) are signed at the current time and not memoized ,
+###   expiries above MAX_EXPIRY are rejected.
+###
+### Copyrighted reserved by AtlasXomics
+##################################################################################
+
+import hmac
+import time
+import hashlib
+import datetime
+import threading
+from urllib.parse import quote
+## aws
+import boto3
+from botocore.exceptions import ClientError
+
+MAX_EXPIRY=7*24*3600
+
+class PresignedUrlService:
+    def __init__(self,auth,**kwargs):
+        self.auth=auth
+        self.window=int(self.auth.app.config.get('PRESIGN_WINDOW_SECONDS',300))
+        self.session=boto3.session.Session()
+        self.default_region=self.session.region_name or 'us-east-1'
+        self.aws_s3=boto3.client('s3')
+        self.regions={}
+        self.signing_keys={}
+        self.urls={}
+        self.urls_window=None
+        self.lock=threading.Lock()
+
+    def getUrl(self,bucket_name,key,expiry=3600):
+        return self.getUrls([(bucket_name,key)],expiry)[0]
+
+    def getUrls(self,objects,expiry=3600):
+        """Presigned GET urls for a list of (bucket , key) , signed in one pass."""
+        expiry=int(expiry)
+        if expiry<=0 or expiry>MAX_EXPIRY:
+            raise ValueError("expiry must be between 1 and {} seconds".format(MAX_EXPIRY))
+        credentials=self.session.get_credentials()
+        if credentials is None:
+            raise Exception("No AWS credentials available to sign urls")
+        credentials=credentials.get_frozen_credentials()
+        now=int(time.time())
+        window_start=now-now%self.window
+        with self.lock:
+            if self.urls_window!=window_start:
+                ## memoized urls of the previous window are never handed out again
+                self.urls={}
+                self.urls_window=window_start
+        if expiry+self.window>MAX_EXPIRY:
+            return [self.sign(credentials,bucket_name,key,now,expiry) for bucket_name,key in objects]
+        res=[]
+        for bucket_name,key in objects:
+            memo_key=(credentials.access_key,bucket_name,key,expiry)
+            url=self.urls.get(memo_key)
+            if url is None:
+                url=self.sign(credentials,bucket_name,key,window_start,expiry+self.window)
+                with self.lock:
+                    if self.urls_window==window_start:
+                        self.urls[memo_key]=url
+            res.append(url)
+        return res
+
+    def getRegion(self,bucket_name):
+        region=self.regions.get(bucket_name)
+        if region is None:
+            try:
+                region=self.aws_s3.get_bucket_location(Bucket=bucket_name).get('LocationConstraint') or 'us-east-1'
+                ## legacy LocationConstraint of eu-west-1 buckets
+                if region=='EU':
+                    region='eu-west-1'
+            except ClientError as e:
+                code=e.response.get('Error',{}).get('Code')
+                ## S3 names the bucket's region on most errors , even when the caller can't read the location
+                region=e.response.get('ResponseMetadata',{}).get('HTTPHeaders',{}).get('x-amz-bucket-region')
+                if region is None and code!='AccessDenied':
+                    ## missing bucket , throttling ... : sign with the default region but ask again next time
+                    self.auth.app.logger.warning("Region of bucket {} unknown ({}) , using {}".format(bucket_name,code,self.default_region))
+                    return self.default_region
+                if region is None:
+                    self.auth.app.logger.warning("No permission to get the location of bucket {} , using {}".format(bucket_name,self.default_region))
+                    region=self.default_region
+            self.regions[bucket_name]=region
+        return region
+
+    def getSigningKey(self,secret_key,date,region):
+        cache_key=(secret_key,date,region)
+        signing_key=self.signing_keys.get(cache_key)
+        if signing_key is None:
+            k_date=hmac.new(('AWS4'+secret_key).encode('utf-8'),date.encode('utf-8'),hashlib.sha256).digest()
+            k_region=hmac.new(k_date,region.encode('utf-8'),hashlib.sha256).digest()
+            k_service=hmac.new(k_region,b's3',hashlib.sha256).digest()
+            signing_key=hmac.new(k_service,b'aws4_request',hashlib.sha256).digest()
+            with self.lock:
+                ## keys of past days are dropped with the new one
+                self.signing_keys={k:v for k,v in self.signing_keys.items() if k[1]==date}
+                self.signing_keys[cache_key]=signing_key
+        return signing_key
+
+    def sign(self,credentials,bucket_name,key,timestamp,expires):
+        region=self.getRegion(bucket_name)
+        signed_at=datetime.datetime.fromtimestamp(timestamp,tz=datetime.timezone.utc)
+        amz_date=signed_at.strftime('%Y%m%dT%H%M%SZ')
+        date=signed_at.strftime('%Y%m%d')
+        scope='{}/{}/s3/aws4_request'.format(date,region)
+        if '.' in bucket_name:
+            ## dotted bucket names don't match the wildcard certificate , use path style
+            host='s3.{}.amazonaws.com'.format(region)
+            path='/{}/{}'.format(quote(bucket_name,safe=''),quote(key,safe='/~'))
+        else:
+            host='{}.s3.{}.amazonaws.com'.format(bucket_name,region)
+            path='/'+quote(key,safe='/~')
+        params={'X-Amz-Algorithm':'AWS4-HMAC-SHA256',
+                'X-Amz-Credential':'{}/{}'.format(credentials.access_key,scope),
+                'X-Amz-Date':amz_date,
+                'X-Amz-Expires':str(expires),
+                'X-Amz-SignedHeaders':'host'}
+        if credentials.token:
+            params['X-Amz-Security-Token']=credentials.token
+        query='&'.join('{}={}'.format(quote(k,safe='-_.~'),quote(v,safe='-_.~')) for k,v in sorted(params.items()))
+        canonical_request='\n'.join(['GET',path,query,'host:'+host,'','host','UNSIGNED-PAYLOAD'])
+        string_to_sign='\n'.join(['AWS4-HMAC-SHA256',amz_date,scope,hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+        signature=hmac.new(self.getSigningKey(credentials.secret_key,date,region),string_to_sign.encode('utf-8'),hashlib.sha256).hexdigest()
+        return 'https://{}{}?{}&X-Amz-Signature={}'.format(host,path,query,signature)
@@ -14,8 +14,22 @@ import boto3
 import csv
 import openpyxl
 import re
+import itertools
+import time
+import threading
 
 class MariaDB:
+    ## endpoints that change the database , the only ones that bump the run_db data version
+    WRITE_ENDPOINTS = frozenset([
+        "/api/v1/run_db/reinitialize_db",
+        "/api/v1/run_db/update_study_table",
+        "/api/v1/run_db/set_run_files",
+        "/api/v1/run_db/upload_metadata_page",
+        "/api/v1/run_db/create_reference_table",
+        "/api/v1/run_db/ensure_run_id_created",
+        "/api/v1/run_db/insert_new_publication",
+    ])
+
     def __init__(self, auth):
         self.auth = auth
         self.client = None
@@ -24,6 +38,12 @@ class MariaDB:
         self.username = self.auth.app.config["MYSQL_USERNAME"]
         self.password = self.auth.app.config["MYSQL_PASSWORD"]
         self.db = self.auth.app.config["MYSQL_DB"]
+        self.cache_control = self.auth.app.config.get("METADATA_CACHE_CONTROL", "private, no-cache")
+        ## view name -> (data version , expiry , row count , update time) , see list_validators
+        self.validator_ttl = float(self.auth.app.config.get("VALIDATOR_CACHE_SECONDS", 30))
+        self.validator_cache = {}
+        self.validator_lock = threading.Lock()
+        self.versions_table = self.auth.app.config['SUBMODULES']['Database'].getTable(self.auth.app.config['DATA_TABLES']['application_data']['table_name'])
         self.tempDirectory = Path(self.auth.app.config['TEMP_DIRECTORY'])
         self.api_db = Path(self.auth.app.config['API_DIRECTORY'])
         self.engine = self.initialize()
@@ -51,6 +71,16 @@ class MariaDB:
             return None
 
     def initEndpoints(self):
+        @self.auth.app.after_request
+        def _bump_run_db_version(resp):
+            ## a successful write invalidates the ETags of the run lists , read-only POSTs don't
+            if request.path in self.WRITE_ENDPOINTS and resp.status_code < 400:
+                try:
+                    utils.bump_data_version(self.versions_table, 'run_db')
+                except Exception as e:
+                    self.auth.app.logger.exception("Couldn't bump the run_db data version : {}".format(str(e)))
+            return resp
+
         @self.auth.app.route('/api/v1/run_db/reinitialize_db', methods=["GET"])
         def re_init():
             status_code = 200
@@ -86,19 +116,24 @@ class MariaDB:
                 
             """
             sc = 200
+            resp = None
             try:
                 user, groups= current_user
-                if 'admin' in groups:
-                    res = self.grab_runs_homepage_admin()
-                else:
-                    res = self.grab_runs_homepage_groups(groups)
+                def rows():
+                    if 'admin' in groups:
+                        return self.grab_runs_homepage_admin(stream=True)
+                    return self.grab_runs_homepage_groups(groups, stream=True)
+                ## a repeat visit with an unchanged run list gets a 304 without running the query
+                validators = self.list_validators(self.homepage_population_name, groups)
+                resp = utils.versioned_response(lambda: utils.stream_json_list(rows()), validators, self.cache_control, sc)
             except Exception as e:
                 sc = 500
                 exc = traceback.format_exc()
                 res = utils.error_message("{} {}".format(str(e), exc))
             finally:
-                resp = Response(json.dumps(res), sc)
-                resp.headers['Content-Type']='application/json'
+                if resp is None:
+                    resp = Response(json.dumps(res), sc)
+                    resp.headers['Content-Type']='application/json'
                 return resp
 
         @self.auth.app.route("/api/v1/run_db/get_run_from_results_id", methods=["POST"])
@@ -209,15 +244,18 @@ class MariaDB:
                 "tissue_type_list": ["fresh_frozen", "ffpe", "efpe"] }
             """
             sc = 200
+            resp = None
             try:
                 user, groups = current_user
-                res = self.get_field_options(groups)
+                ## options come from several tables , only the data version and update time validate them
+                resp = self.versioned_json(None, groups, lambda: self.get_field_options(groups))
             except Exception as e:
                 sc = 500
                 exc = traceback.format_exc()
                 res = utils.error_message("{} {}".format(str(e), exc))
             finally:
-                resp = Response(json.dumps(res), sc)
+                if resp is None:
+                    resp = Response(json.dumps(res), sc)
                 return resp
 
         @self.auth.app.route("/api/v1/run_db/get_run_ids", methods=['GET'])
@@ -238,14 +276,17 @@ class MariaDB:
                 
             """
             sc = 200
+            resp = None
             try:
-                res = self.get_run_ids()
+                user, groups = current_user
+                resp = self.versioned_json(self.full_db_data, groups, self.get_run_ids)
             except Exception as e:
                 sc = 500
                 exc = traceback.format_exc()
                 res = utils.error_message("{} {}".format(str(e), exc))
             finally:
-                resp = Response(json.dumps(res), sc)
+                if resp is None:
+                    resp = Response(json.dumps(res), sc)
                 return resp
         
         @self.auth.app.route("/api/v1/run_db/get_studies", methods=['GET'])
@@ -261,14 +302,17 @@ class MariaDB:
                 
             """
             sc = 200
+            resp = None
             try:
-                res = self.get_studies()
+                user, groups = current_user
+                resp = self.versioned_json("study_view", groups, self.get_studies)
             except Exception as e:
                 sc = 500
                 exc = traceback.format_exc()
                 res = utils.error_message("{} {}".format(str(e), exc))
             finally:
-                resp = Response(json.dumps(res), sc)
+                if resp is None:
+                    resp = Response(json.dumps(res), sc)
                 print(resp)
                 return resp
             
@@ -429,8 +473,9 @@ class MariaDB:
             sc = 200
             try:
                 user, groups = current_user
-                res = self.get_all_downloadable_files_run_id(groups)
-                resp = Response(json.dumps(res), sc)
+                validators = self.list_validators("files_run_id_view", groups)
+                resp = utils.versioned_response(lambda: utils.stream_json_dict(self.get_all_downloadable_files_run_id(groups, stream=True)),
+                                                validators, self.cache_control, sc)
             except Exception as e:
                 sc = 500
                 exc = traceback.format_exc()
@@ -459,28 +504,34 @@ class MariaDB:
             
             """
             sc = 200
+            resp = None
             try:
-                res = self.get_file_type_options()
+                user, groups = current_user
+                resp = self.versioned_json("file_type_table", groups, self.get_file_type_options)
             except Exception as e:
                 sc = 500
                 exc = traceback.format_exc()
                 res = utils.error_message("{} {}".format(str(e), exc))
             finally:
-                resp = Response(json.dumps(res), sc)
+                if resp is None:
+                    resp = Response(json.dumps(res), sc)
                 return resp
         
         @self.auth.app.route("/api/v1/run_db/get_study_types", methods=['GET'])
         @self.auth.login_required
         def _get_study_types():
             sc = 200
+            resp = None
             try:
-                res = self.get_study_types()
+                user, groups = current_user
+                resp = self.versioned_json("study_type_table", groups, self.get_study_types)
             except Exception as e:
                 sc = 500
                 exc = traceback.format_exc()
                 res = utils.error_message("{} {}".format(str(e), exc))
             finally:
-                resp = Response(json.dumps(res), sc)
+                if resp is None:
+                    resp = Response(json.dumps(res), sc)
                 return resp
         
         @self.auth.app.route("/api/v1/run_db/search_pmid", methods=["POST"])
@@ -518,29 +569,33 @@ class MariaDB:
         @self.auth.login_required
         def _retrieve_paths():
             status_code = 200
+            resp = None
             try:
                 user, groups = current_user
                 if not groups:
                     group = " "
                 else:
                     group = groups[0]
-                if group == "admin" or group == "user":
-                    res = self.get_paths_admin()
-                else:
-                    res = self.get_paths_group(group)
+                def paths():
+                    if group == "admin" or group == "user":
+                        return self.get_paths_admin()
+                    return self.get_paths_group(group)
+                resp = self.versioned_json(self.homepage_population_name, groups, paths)
             except Exception as e:
                 print(e)
                 status_code = 500
                 exc = traceback.format_exc()
                 res = utils.error_message("{} {}".format(str(e), exc))
             finally:
-                resp = Response(json.dumps(res), status=status_code)
+                if resp is None:
+                    resp = Response(json.dumps(res), status=status_code)
                 return resp
 
         @self.auth.app.route("/api/v1/run_db/get_summary_stats", methods=["GET"])
         @self.auth.login_required
         def _get_summary_stats():
             sc = 200
+            resp = None
             print(sc)
             try:
                 user, groups = current_user
@@ -549,16 +604,18 @@ class MariaDB:
                 else:
                     group = groups[0]
                 
-                if group == "admin" or group == "user":
-                    res = self.grab_summary_stat_admin()
-                else:
-                    res = self.grab_summary_stats(group)
+                def stats():
+                    if group == "admin" or group == "user":
+                        return self.grab_summary_stat_admin()
+                    return self.grab_summary_stats(group)
+                resp = self.versioned_json(self.homepage_population_name, groups, stats)
             except Exception as e:
                 sc = 500
                 exc = traceback.format_exc()
                 res = utils.error_message(f"{e} {exc}")
             finally:
-                resp = Response(json.dumps(res), sc)
+                if resp is None:
+                    resp = Response(json.dumps(res), sc)
                 return resp
             
             
@@ -861,6 +918,58 @@ class MariaDB:
 
     def get_connection(self):
         return self.engine.connect()
+
+    def list_validators(self, view_name, groups):
+        """Cheap ETag inputs of a list endpoint : the API write counter , the row count
+        (which catches rows added or removed outside the API) , the last update time of the
+        schema's tables (which catches in-place edits outside the API) and the caller's groups.
+        The count and update time are kept with the write counter they were read at , and only
+        read again once it changes or VALIDATOR_CACHE_SECONDS have passed. view_name None skips the count."""
+        version = utils.data_version(self.versions_table, 'run_db')
+        now = time.time()
+        with self.validator_lock:
+            cached = self.validator_cache.get(view_name)
+        if cached is not None and cached[0] == version and cached[1] > now:
+            count, updated = cached[2], cached[3]
+        else:
+            with self.get_connection() as conn:
+                count = conn.execute(f"SELECT COUNT(*) FROM {view_name}").fetchone()[0] if view_name else None
+                updated = conn.execute("SELECT MAX(UPDATE_TIME) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()").fetchone()[0]
+            with self.validator_lock:
+                self.validator_cache[view_name] = (version, now + self.validator_ttl, count, updated)
+        return [view_name, version, count, updated, sorted(groups)]
+
+    def versioned_json(self, view_name, groups, make_result):
+        """Response with make_result() as its json body and a weak ETag from list_validators ;
+        make_result only runs when the client's copy is stale."""
+        validators = self.list_validators(view_name, groups)
+        return utils.versioned_response(lambda: iter([json.dumps(make_result())]), validators, self.cache_control)
+
+    def get_streaming_connection(self):
+        ## server side cursor : rows are fetched from MySQL as the response is written
+        return self.engine.connect().execution_options(stream_results=True)
+
+    def stream_query(self, sql, params=None):
+        """Rows of sql as dictionaries , fetched through a server side cursor as they are consumed.
+        The cursor and its connection are released once the generator is exhausted or closed
+        (the response closes it when the client goes away).
+
+        Args:
+            sql str: sql statement
+            params tuple: parameters of the statement
+
+        Yields:
+            dictionary: Key: column name Value: value
+        """
+        conn = self.get_streaming_connection()
+        try:
+            res = conn.execute(sql) if params is None else conn.execute(sql, params)
+            try:
+                yield from self.iter_sql_dicts(res)
+            finally:
+                res.close()
+        finally:
+            conn.close()
     
     def get_username(self):
         user, groups = current_user
@@ -1308,7 +1417,7 @@ class MariaDB:
         res = self.sql_tuples_to_dict(obj)
         return res
     
-    def get_all_downloadable_files_run_id(self, groups):
+    def get_all_downloadable_files_run_id(self, groups, stream=False):
         sql = "SELECT * from files_run_id_view"
         lis = []
         if "admin" not in groups:
@@ -1320,6 +1429,16 @@ class MariaDB:
             sql = sql + where
         
         t = tuple(lis)
+        if stream:
+            ## ordered by run so each run's files are consecutive and can be written out as they are read
+            rows = self.stream_query(sql + " ORDER BY `run_id`", t)
+            def grouped():
+                try:
+                    files = (dict(file, presigned_url=None) for file in rows)
+                    yield from itertools.groupby(files, key=lambda f: f["run_id"])
+                finally:
+                    rows.close()
+            return grouped()
         conn = self.get_connection()
         res = conn.execute(sql, t)
         result = self.sql_tuples_to_dict(res)
@@ -1446,17 +1565,20 @@ class MariaDB:
         sql = """INSERT INTO study_tissue_table (study_id, tissue_id) VALUES (%s, %s);"""
         conn.execute(sql, (study_id, tissue_id))
     
-    def grab_runs_homepage_groups(self, groups):
+    def grab_runs_homepage_groups(self, groups, stream=False):
         """Method to access homepage_population view and only retrieve
         runs corresponding to a particular set of groups.
 
         Args:
             groups list: list of group names
+            stream bool: return a generator over a server side cursor instead of a list
 
         Returns:
             _type_: _description_
         """
         tup, sql = self.grab_runs_homepage_groups_sql(groups)
+        if stream:
+            return self.stream_query(sql, tup)
         conn = self.get_connection()
         sql_obj = conn.execute(sql, tup)
         res = self.sql_tuples_to_dict(sql_obj)
@@ -1484,13 +1606,17 @@ class MariaDB:
         sql = sql + in_sql + groups
         return (tup, sql)
 
-    def grab_runs_homepage_admin(self):
+    def grab_runs_homepage_admin(self, stream=False):
         """Selects all runs from homepage_population view.
+        Args:
+            stream bool: return a generator over a server side cursor instead of a list
         Returns:
             List[dictionary]: List of dictionary with each entry in list being a run.
         """
-        conn = self.get_connection()
         sql = f"SELECT * FROM {self.homepage_population_name};"
+        if stream:
+            return self.stream_query(sql)
+        conn = self.get_connection()
         sql_obj = conn.execute(sql)
         res = self.sql_tuples_to_dict(sql_obj)
         return res
@@ -1569,12 +1695,19 @@ class MariaDB:
         Returns:
             List[dictionary]: List where each element is a dictionary. Key: column name Value: value
         """
-        result = []
-        for v in sql_obj:
-            d = dict(v._mapping)
-            result.append(d)
+        return list(self.iter_sql_dicts(sql_obj))
+
+    def iter_sql_dicts(self, sql_obj):
+        """Generator version of sql_tuples_to_dict , rows are converted as they are fetched.
 
-        return result 
+        Args:
+            sql_obj CursorResult: Result of cursor execution of sql statement.
+
+        Yields:
+            dictionary: Key: column name Value: value
+        """
+        for v in sql_obj:
+            yield dict(v._mapping)
 
     def sql_obj_to_list(self, sql_obj):
         res = sql_obj.fetchall()
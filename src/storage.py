@@ -9,9 +9,10 @@
 ##################################################################################
 
 ### API
-from flask import request, Response , send_from_directory
+from flask import request, Response , send_from_directory, send_file
 from flask_jwt_extended import jwt_required,get_jwt_identity,current_user
 from werkzeug.utils import secure_filename
+from werkzeug.http import parse_range_header, http_date, parse_date
 # import miscellaneous modules
 import os
 import io
@@ -23,7 +24,6 @@ import json
 from pathlib import Path
 import random
 import datetime
-import shutil
 import csv 
 import cv2
 import jwt
@@ -31,12 +31,26 @@ from scipy import ndimage
 import re
 import gzip
 import base64
-from PIL import Image
+import hashlib
+import zipfile
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import quote
 ## aws
 import boto3
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ConnectTimeoutError
 
 from . import utils 
+from . import imaging
+from . import tabular
+from .listing import ListingIndex, ContentHashIndex
+from .presign import PresignedUrlService
+from .prefetch import RunPrefetcher
+from . import uploads
 
 class StorageAPI:
     def __init__(self,auth,datastore,**kwargs):
@@ -49,6 +63,50 @@ class StorageAPI:
         self.bucket_name=self.auth.app.config['S3_BUCKET_NAME']
         self.aws_s3 = boto3.client('s3')
         self.aws_s3_resource = boto3.resource('s3')
+        self.object_cache=self.auth.app.config['SUBMODULES']['ObjectCache']
+        self.listing=ListingIndex(self.auth)
+        self.presigner=PresignedUrlService(self.auth)
+        qc_table=self.auth.app.config['SUBMODULES']['Database'].getTable(self.auth.app.config['DATA_TABLES']['studies.qc']['table_name'])
+        self.prefetcher=RunPrefetcher(self.auth,self.object_cache,qc_table)
+        self.object_cache.addAccessListener(self.prefetcher.notify)
+        self.upload_part_size=int(self.auth.app.config.get('STORAGE_UPLOAD_PART_SIZE',16*1024*1024))
+        self.upload_tmp_prefix=self.auth.app.config.get('STORAGE_UPLOAD_TMP_PREFIX','tmp/uploads/')
+        self.upload_workers=int(self.auth.app.config.get('STORAGE_UPLOAD_WORKERS',4))
+        sessions_table=self.auth.app.config['DATA_TABLES'].get('storage.upload_sessions',{}).get('table_name','storage.upload_sessions')
+        self.upload_sessions=uploads.UploadSessions(self.aws_s3,
+                                                    self.auth.app.config['SUBMODULES']['Database'].getTable(sessions_table),
+                                                    int(self.auth.app.config.get('STORAGE_UPLOAD_SESSION_PART_SIZE',64*1024*1024)),
+                                                    int(self.auth.app.config.get('STORAGE_UPLOAD_SESSION_MAX_PART_SIZE',uploads.MAX_SESSION_PART_SIZE)))
+        hashes_table=self.auth.app.config['DATA_TABLES'].get('storage.content_hashes',{}).get('table_name','storage.content_hashes')
+        self.content_hashes=ContentHashIndex(self.auth.app.config['SUBMODULES']['Database'].getTable(hashes_table))
+        self.upload_dedup=self.auth.app.config.get('STORAGE_UPLOAD_DEDUP',False)
+        self.chunk_size=int(self.auth.app.config.get('STORAGE_CHUNK_SIZE',1024*1024))
+        self.serve_mode=self.auth.app.config.get('STORAGE_SERVE_MODE','stream')
+        self.cache_control=self.auth.app.config.get('STORAGE_CACHE_CONTROL','private, max-age=300')
+        self.x_accel_prefix=self.auth.app.config.get('STORAGE_X_ACCEL_PREFIX','/protected_cache/')
+        self.zip_workers=int(self.auth.app.config.get('STORAGE_ZIP_WORKERS',8))
+        ## already compressed formats are stored as is in zip archives
+        self.stored_extensions=['.gz','.zip','.png','.jpg','.jpeg','.h5ad','.bam','.bz2']
+        self.tile_size=int(self.auth.app.config.get('STORAGE_TILE_SIZE',256))
+        self.tile_quality=int(self.auth.app.config.get('STORAGE_TILE_QUALITY',85))
+        self.image_sizes=[int(v) for v in self.auth.app.config.get('STORAGE_IMAGE_SIZES',imaging.OUTPUT_SIZES)]
+        self.image_qualities=[int(v) for v in self.auth.app.config.get('STORAGE_IMAGE_QUALITIES',imaging.OUTPUT_QUALITIES)]
+        self.transfer_workers=int(self.auth.app.config.get('STORAGE_TRANSFER_WORKERS',16))
+        self.thumbnail_sizes=[int(v) for v in self.auth.app.config.get('STORAGE_THUMBNAIL_SIZES',imaging.THUMBNAIL_SIZES)]
+        self.thumbnail_formats=list(self.auth.app.config.get('STORAGE_THUMBNAIL_FORMATS',imaging.THUMBNAIL_FORMATS))
+        self.thumbnail_workers=int(self.auth.app.config.get('STORAGE_THUMBNAIL_WORKERS',4))
+        self.thumbnail_cache_control=self.auth.app.config.get('THUMBNAIL_CACHE_CONTROL','public, max-age=31536000, immutable')
+        ## the homepage's original single image (frontPage_<run>.<format>)
+        self.thumbnail_legacy_size=int(self.auth.app.config.get('STORAGE_THUMBNAIL_LEGACY_SIZE',200))
+        self.thumbnail_legacy_format=self.auth.app.config.get('STORAGE_THUMBNAIL_LEGACY_FORMAT','png')
+        self.thumbnail_pool=None
+        self.thumbnail_pool_lock=threading.Lock()
+        self.batch_list_min=int(self.auth.app.config.get('STORAGE_BATCH_LIST_MIN',4))
+        self.transfer_retries=int(self.auth.app.config.get('STORAGE_TRANSFER_RETRIES',4))
+        self.multipart_threshold=int(self.auth.app.config.get('STORAGE_MULTIPART_THRESHOLD',64*1024*1024))
+        self.transfer_config=TransferConfig(multipart_threshold=self.multipart_threshold,
+                                            multipart_chunksize=self.multipart_threshold,
+                                            max_concurrency=4)
         self.initialize()
         self.initEndpoints()
     def initialize(self):
@@ -67,10 +125,13 @@ class StorageAPI:
             param_filename=request.args.get('filename',type=str)
             param_bucket=request.args.get('bucket_name',default=self.bucket_name,type=str)
             try:
-                data_bytesio,_,size,_= self.getFileObject(param_bucket,param_filename)
-                resp=Response(data_bytesio,status=200)
-                resp.headers['Content-Length']=size
-                resp.headers['Content-Type']='application/octet-stream'
+                obj=self.getCachedObject(param_bucket,param_filename)
+                if obj is None:
+                    res=utils.error_message("The file doesn't exists",status_code=404)
+                    resp=Response(json.dumps(res),status=res['status_code'])
+                    resp.headers['Content-Type']='application/json'
+                else:
+                    resp=self.fileResponse(obj)
             except Exception as e:
                 exc=traceback.format_exc()
                 res=utils.error_message("Exception : {} {}".format(str(e),exc),500)
@@ -87,17 +148,15 @@ class StorageAPI:
             resp=None
             param_filename=request.args.get('filename',type=str)
             param_bucket=request.args.get('bucket_name',default=self.bucket_name,type=str)
-            try_cache = request.args.get('use_cache', type=str, default='false')
             rotation = request.args.get('rotation', type=int, default=0)
-            if try_cache == 'true':
-                use_cache = True
-            else:
-                use_cache = False
             try:
-                data_bytesio,_,size,_= self.getFileObjectAsJPG(bucket_name=param_bucket, filename= param_filename, try_cache= use_cache, rotation=rotation)
-                resp=Response(data_bytesio,status=200)
-                resp.headers['Content-Length']=size
-                resp.headers['Content-Type']='application/octet-stream'
+                output=self.getImageOutputParams(default_format='jpg')
+                ops=[('rotate',rotation)]+output['ops']
+                resp=self.renderedResponse(param_bucket,param_filename,ops,output)
+            except ValueError as e:
+                res=utils.error_message(str(e),400)
+                resp=Response(json.dumps(res),status=res['status_code'])
+                resp.headers['Content-Type']='application/json'
             except Exception as e:
                 exc=traceback.format_exc()
                 res=utils.error_message("Exception : {} {}".format(str(e),exc),500)
@@ -115,9 +174,22 @@ class StorageAPI:
             param_filename=request.args.get('filename',type=str)
             param_bucket=request.args.get('bucket_name',default=self.bucket_name,type=str)
             try:
-                data_bytesio,_,size,_= self.getImage(param_bucket, param_filename)
-                resp=Response(data_bytesio,status=200)
-                resp.headers['Content-Type']='application/octet-stream'
+                ## no login here , so no variant outside of the configured sizes and qualities
+                output=self.getImageOutputParams(default_format='png',strict=True)
+                if output['requested']:
+                    resp=self.renderedResponse(param_bucket,param_filename,output['ops'],output)
+                else:
+                    obj=self.getCachedObject(param_bucket,param_filename)
+                    if obj is None:
+                        res=utils.error_message("The file doesn't exists",status_code=404)
+                        resp=Response(json.dumps(res),status=res['status_code'])
+                        resp.headers['Content-Type']='application/json'
+                    else:
+                        resp=self.fileResponse(obj)
+            except ValueError as e:
+                res=utils.error_message(str(e),400)
+                resp=Response(json.dumps(res),status=res['status_code'])
+                resp.headers['Content-Type']='application/json'
             except Exception as e:
                 exc=traceback.format_exc()
                 res=utils.error_message("Exception : {} {}".format(str(e),exc),500)
@@ -140,10 +212,13 @@ class StorageAPI:
             y1 = request.args.get('y1', type=int)
             y2 = request.args.get('y2', type=int)
             try:
-                data_bytesio,size = self.get_gray_image_rotation_cropping_jpg(param_filename, param_rotation, x1 = x1, x2 = x2, y1 = y1, y2 = y2)
-                resp=Response(data_bytesio,status=200)
-                resp.headers['Content-Length']=size
-                resp.headers['Content-Type']='application/octet-stream'
+                output=self.getImageOutputParams(default_format='jpg')
+                ops=[('channel',0),('rotate',param_rotation),('crop',x1,x2,y1,y2)]+output['ops']
+                resp=self.renderedResponse(param_bucket,param_filename,ops,output)
+            except ValueError as e:
+                res=utils.error_message(str(e),400)
+                resp=Response(json.dumps(res),status=res['status_code'])
+                resp.headers['Content-Type']='application/json'
             except Exception as e:
                 exc=traceback.format_exc()
                 res=utils.error_message("Exception : {} {}".format(str(e),exc),500)
@@ -152,6 +227,77 @@ class StorageAPI:
             finally:
                 return resp    
         
+        @self.auth.app.route('/api/v1/storage/tiles/info',methods=['GET'])
+        @self.auth.login_required
+        def _getTileInfo():
+            sc=200
+            res=None
+            param_filename=request.args.get('filename',type=str)
+            param_bucket=request.args.get('bucket_name',default=self.bucket_name,type=str)
+            try:
+                res=self.getTilePyramid(param_bucket,param_filename)
+                if res is None:
+                    res=utils.error_message("The file doesn't exists",status_code=404)
+                    sc=404
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("Exception : {} {}".format(str(e),exc),sc)
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                return resp
+
+        @self.auth.app.route('/api/v1/storage/tiles/<int:level>/<int:x>_<int:y>',methods=['GET'])
+        @self.auth.login_required
+        def _getTile(level,x,y):
+            resp=None
+            param_filename=request.args.get('filename',type=str)
+            param_bucket=request.args.get('bucket_name',default=self.bucket_name,type=str)
+            try:
+                obj=self.getTile(param_bucket,param_filename,level,x,y)
+                if obj is None:
+                    res=utils.error_message("The tile doesn't exists",status_code=404)
+                    resp=Response(json.dumps(res),status=res['status_code'])
+                    resp.headers['Content-Type']='application/json'
+                else:
+                    resp=self.fileResponse(obj,mimetype='image/jpeg')
+            except Exception as e:
+                exc=traceback.format_exc()
+                res=utils.error_message("Exception : {} {}".format(str(e),exc),500)
+                resp=Response(json.dumps(res),status=res['status_code'])
+                resp.headers['Content-Type']='application/json'
+            finally:
+                return resp
+
+        @self.auth.app.route('/api/v1/storage/tiles/crop',methods=['GET'])
+        @self.auth.login_required
+        def _getTileCrop():
+            resp=None
+            param_filename=request.args.get('filename',type=str)
+            param_bucket=request.args.get('bucket_name',default=self.bucket_name,type=str)
+            level=request.args.get('level',type=int)
+            x1 = request.args.get('x1', type=int)
+            x2 = request.args.get('x2', type=int)
+            y1 = request.args.get('y1', type=int)
+            y2 = request.args.get('y2', type=int)
+            try:
+                data_bytesio,size=self.getCropFromTiles(param_bucket,param_filename,level,x1,x2,y1,y2)
+                resp=Response(data_bytesio,status=200)
+                resp.headers['Content-Length']=size
+                resp.headers['Content-Type']='image/jpeg'
+            except ValueError as e:
+                res=utils.error_message(str(e),400)
+                resp=Response(json.dumps(res),status=res['status_code'])
+                resp.headers['Content-Type']='application/json'
+            except Exception as e:
+                exc=traceback.format_exc()
+                res=utils.error_message("Exception : {} {}".format(str(e),exc),500)
+                resp=Response(json.dumps(res),status=res['status_code'])
+                resp.headers['Content-Type']='application/json'
+            finally:
+                return resp
+
         @self.auth.app.route('/api/v1/storage/json',methods=['GET']) ### return json object from csv file
         @self.auth.login_required 
         def _getJsonFromFile():
@@ -166,9 +312,13 @@ class StorageAPI:
             else:
                 no_aws_yes_server = True
             try:
-                res = self.getJsonFromFile(param_bucket,param_filename, no_aws_yes_server)
-                resp=Response(json.dumps(res),status=200)
-                resp.headers['Content-Type']='application/json'
+                obj=self.getGzipPassthroughObject(param_bucket,param_filename,no_aws_yes_server)
+                if obj is not None:
+                    ## the stored bytes already are the gzip coded JSON document
+                    resp=self.gzipResponse(obj,mimetype='application/json')
+                else:
+                    resp=self.conditionalResponse(param_bucket,param_filename,
+                                                  lambda: self.getJsonResponse(param_bucket,param_filename,no_aws_yes_server))
             except Exception as e:
                 exc=traceback.format_exc()
                 res=utils.error_message("Exception : {} {}".format(str(e),exc),500)
@@ -190,9 +340,32 @@ class StorageAPI:
                 no_aws_yes_server = False
             else:
                 no_aws_yes_server = True
+            param_format=request.args.get('format', default='json', type=str)
+            param_header=request.args.get('header', default='auto', type=str)
             try:
-                res = self.getCsvFileAsJson(param_bucket,param_filename, no_aws_yes_server)
-                resp=Response(json.dumps(res),status=200)
+                slicing=tabular.slicing_params(request.args)
+                if param_format == 'csv':
+                    ## the file as stored , gzip coded when the client accepts it
+                    obj=self.getGzipPassthroughObject(param_bucket,param_filename,no_aws_yes_server)
+                    if obj is not None:
+                        resp=self.gzipResponse(obj,mimetype='text/csv')
+                    else:
+                        resp=self.getCsvFileResponse(param_bucket,param_filename,no_aws_yes_server)
+                elif param_format == 'json':
+                    resp=self.conditionalResponse(param_bucket,param_filename,
+                                                  lambda: self.getCsvRowsResponse(param_bucket,param_filename,no_aws_yes_server,slicing))
+                else:
+                    ## typed columnar encodings , parsed once per ETag
+                    obj=tabular.columnar_object(self.object_cache,param_bucket,param_filename,param_format,param_header)
+                    if obj is None:
+                        res=utils.error_message("The file doesn't exists",status_code=404)
+                        resp=Response(json.dumps(res),status=res['status_code'])
+                        resp.headers['Content-Type']='application/json'
+                    else:
+                        resp=self.fileResponse(obj,mimetype=tabular.FORMATS[param_format][1])
+            except ValueError as e:
+                res=utils.error_message(str(e),400)
+                resp=Response(json.dumps(res),status=res['status_code'])
                 resp.headers['Content-Type']='application/json'
             except Exception as e:
                 exc=traceback.format_exc()
@@ -211,10 +384,12 @@ class StorageAPI:
             param_root=request.args.get('root',type=str)
             param_bucket=request.args.get('bucket_name',default=self.bucket_name,type=str)
             try:
-                data_bytesio,_,size,_= self.getFilesZipped(param_bucket,param_root)
-                resp=Response(data_bytesio,status=200)
-                resp.headers['Content-Length']=size
-                resp.headers['Content-Type']='application/octet-stream'
+                ## the listing and the first member are read before the 200 is sent , so they fail with a proper error
+                chunks=self.getFilesZipped(param_bucket,param_root)
+                first=next(chunks)
+                resp=Response(itertools.chain([first],chunks),status=200,mimetype='application/zip')
+                resp.call_on_close(chunks.close)
+                resp.headers['Content-Disposition']='attachment; filename="{}.zip"'.format(Path(param_root).name or 'archive')
             except Exception as e:
                 exc=traceback.format_exc()
                 res=utils.error_message("Exception : {} {}".format(str(e),exc),500)
@@ -299,33 +474,8 @@ class StorageAPI:
             res=None
             try:
                 u,g=current_user
-                f=request.files['file']
-                filename=f.filename
-                bucket_name=self.bucket_name
-                output_filename=Path(filename).name
-                if 'bucket_name' in request.values:
-                    if request.values['bucket_name']:
-                        bucket_name=request.values['bucket_name']
-                if 'output_filename' in request.values:
-                    if request.values['output_filename']: 
-                        output_filename=request.values['output_filename']
-                        output_filename=Path(output_filename)
-                        try:
-                            output_filename=output_filename.relative_to('/')
-                        except:
-                            pass 
-                        output_filename=output_filename.__str__()
-
-                if 'meta' in request.values:
-                    try:
-                        payload={}
-                        payload.update(json.loads(request.values['meta']))
-                        payload.update({'created_by':u.username})
-                        payload.update({'created_at':utils.get_timestamp()})
-                    except:
-                        pass
-                
-                res= self.uploadFile(bucket_name,f,output_filename,meta=payload)
+                ## request.files is never touched , the body is parsed while it is uploaded to S3
+                res= self.uploadStream(u.username)
             except Exception as e:
                 sc=500
                 exc=traceback.format_exc()
@@ -337,6 +487,32 @@ class StorageAPI:
                 self.auth.app.logger.info(utils.log(str(sc)))
                 return resp
 
+        @self.auth.app.route('/api/v1/storage/upload/dedup',methods=['POST'])
+        @self.auth.admin_required
+        def _uploadDeduplicated():
+            sc=200
+            res=None
+            try:
+                u,g=current_user
+                ## the client hashed the file , nothing is sent if the content is already stored
+                params=request.get_json()
+                bucket_name,output_key=self.uploadDestination(params,params['output_filename'])
+                source=self.uploadDeduplicated(bucket_name,output_key,params['sha256'],params['size'])
+                res={'deduplicated':source is not None,'key':output_key}
+                if source is not None:
+                    res['source']='{}/{}'.format(source['bucket_name'],source['key'])
+                    self.auth.app.logger.info("File deduplicated s3://{}/{} from s3://{} by {}".format(bucket_name,output_key,res['source'],u.username))
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
         @self.auth.app.route('/api/v1/storage/upload_link',methods=['POST'])
         @self.auth.admin_required 
         def _uploadFileByLink():
@@ -365,6 +541,106 @@ class StorageAPI:
                 return resp  
 
 
+        @self.auth.app.route('/api/v1/storage/upload_sessions',methods=['POST'])
+        @self.auth.admin_required
+        def _createUploadSession():
+            sc=200
+            res=None
+            try:
+                u,g=current_user
+                params=request.get_json()
+                bucket_name,output_key=self.uploadDestination(params,params['output_filename'])
+                res=self.upload_sessions.create(bucket_name,output_key,params['size'],u.username,params.get('part_size'))
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("Error while creating the upload session : {} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
+        @self.auth.app.route('/api/v1/storage/upload_sessions/<session_id>',methods=['GET'])
+        @self.auth.admin_required
+        def _getUploadSession(session_id):
+            sc=200
+            res=None
+            try:
+                res=self.upload_sessions.listParts(session_id)
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
+        @self.auth.app.route('/api/v1/storage/upload_sessions/<session_id>/parts/<int:part_number>',methods=['PUT'])
+        @self.auth.admin_required
+        def _uploadSessionPart(session_id,part_number):
+            sc=200
+            res=None
+            try:
+                ## raw part bytes as the request body
+                res=self.upload_sessions.putPart(session_id,part_number,request.stream)
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("Error while uploading part {} : {} {}".format(part_number,str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
+        @self.auth.app.route('/api/v1/storage/upload_sessions/<session_id>/complete',methods=['POST'])
+        @self.auth.admin_required
+        def _completeUploadSession(session_id):
+            sc=200
+            res=None
+            try:
+                u,g=current_user
+                res=self.upload_sessions.complete(session_id)
+                self.finishUpload(res['bucket_name'],res['key'],res['size'],etag=res.get('etag'))
+                self.auth.app.logger.info("File uploaded s3://{}/{} ({} bytes) by {}".format(res['bucket_name'],res['key'],res['size'],u.username))
+            except ValueError as e:
+                sc=400
+                res=utils.error_message(str(e),status_code=sc)
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("Error while completing the upload : {} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
+        @self.auth.app.route('/api/v1/storage/upload_sessions/<session_id>',methods=['DELETE'])
+        @self.auth.admin_required
+        def _abortUploadSession(session_id):
+            sc=200
+            res=None
+            try:
+                res=self.upload_sessions.abort(session_id)
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
         @self.auth.app.route('/api/v1/storage/download_link',methods=['GET'])
         @self.auth.login_required
         def _downloadFileByLink():
@@ -410,10 +686,9 @@ class StorageAPI:
             bucket_name = request.args.get('bucket_name')
             print(path)
             print(bucket_name)
-            # code, tf = self.checkFileExists(bucket_name=bucket_name, filename=path)
             try:  
-                self.aws_s3.head_object(Bucket=bucket_name, Key=path)
-                dic = {"code": True}
+                _, tf, _, _ = self.checkFileExists(bucket_name=bucket_name, filename=path)
+                dic = {"code": tf}
                 resp = Response(json.dumps(dic), status = 200)
                 resp.headers['Content-Type'] = "application/json"
             except Exception as e:
@@ -423,6 +698,26 @@ class StorageAPI:
             finally:
                 return resp
             
+        @self.auth.app.route('/api/v1/storage/check_exists_batch', methods=['POST'])
+        @self.auth.login_required
+        def _checkFilesExistBatch():
+            sc = 200
+            res = None
+            try:
+                pl = request.get_json()
+                bucket_name = pl.get('bucket_name', self.bucket_name)
+                keys = pl.get('keys', [])
+                res = self.checkFilesExist(bucket_name, keys)
+            except Exception as e:
+                sc = 500
+                exc = traceback.format_exc()
+                res = utils.error_message("{} {}".format(str(e), exc), status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp = Response(json.dumps(res), status=sc)
+                resp.headers['Content-Type'] = 'application/json'
+                return resp
+
         @self.auth.app.route('/api/v1/storage/qc_entry',methods=['POST'])
         @self.auth.admin_required
         def _generate_qc_entry():
@@ -496,6 +791,23 @@ class StorageAPI:
                 resp.headers['Content-Type']='application/json'
                 self.auth.app.logger.info(utils.log(str(sc)))
                 return resp
+        @self.auth.app.route('/api/v1/storage/prefetch/stats',methods=['GET'])
+        @self.auth.admin_required
+        def _getPrefetchStats():
+            sc=200
+            res=None
+            try:
+                res=self.prefetcher.getStats()
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
         @self.auth.app.route('/api/v1/storage/fetch_buckets',methods=['GET'])
         @self.auth.admin_required
         def _fetchBuckets():
@@ -546,10 +858,16 @@ class StorageAPI:
             from_filter = pl["from_filter"]
             to_bucket = pl["to_bucket"]
             to_path = pl["to_path"]
-            
+            delete_source = pl.get("delete_source", False)
             
             try:
-                res = self.move_files(from_bucket, from_path, from_filter, to_bucket, to_path)
+                u, g = current_user
+                if delete_source and 'admin' not in g:
+                    ## copying stays open to users , removing the source objects doesn't
+                    sc = 401
+                    res = utils.error_message("Admin required to delete the source files", status_code = sc)
+                    return
+                res = self.move_files(from_bucket, from_path, from_filter, to_bucket, to_path, delete_source)
             except Exception as e:
                 sc = 500
                 exc = traceback.format_exc()
@@ -600,10 +918,80 @@ class StorageAPI:
                 self.auth.app.logger.info(utils.log(str(sc)))
                 return resp
               
+        @self.auth.app.route('/api/v1/storage/thumbnails/backfill',methods=['POST'])
+        @self.auth.admin_required
+        def _backfillThumbnails():
+            sc=200
+            res=None
+            try:
+                params=request.get_json(silent=True) or {}
+                res=self.backfillThumbnails(params.get('runs'))
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
+        @self.auth.app.route('/api/v1/storage/thumbnails/<run_id>',methods=['GET'])
+        @self.auth.login_required
+        def _getThumbnailIndex(run_id):
+            sc=200
+            res=None
+            try:
+                res=self.getThumbnailIndex(run_id)
+                if res is None:
+                    sc=404
+                    res=utils.error_message("No thumbnails for {}".format(run_id),status_code=sc)
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                res=utils.error_message("{} {}".format(str(e),exc),status_code=sc)
+                self.auth.app.logger.exception(res['msg'])
+            finally:
+                resp=Response(json.dumps(res),status=sc)
+                resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
+        @self.auth.app.route('/api/v1/storage/thumbnails/<run_id>/<name>',methods=['GET'])
+        def _getThumbnail(run_id,name):
+            ## same access as the homepage images , names are content hashed so they are cached for good
+            sc=200
+            resp=None
+            try:
+                obj=self.getThumbnailObject(run_id,name)
+                if obj is None:
+                    sc=404
+                    resp=Response(json.dumps(utils.error_message("Thumbnail doesn't exist",status_code=sc)),status=sc)
+                else:
+                    _,_,mimetype=imaging.negotiate_format(Path(name).suffix[1:],None)
+                    resp=self.fileResponse(obj,mimetype,self.thumbnail_cache_control)
+            except ValueError as e:
+                sc=400
+                resp=Response(json.dumps(utils.error_message(str(e),status_code=sc)),status=sc)
+            except Exception as e:
+                sc=500
+                exc=traceback.format_exc()
+                resp=Response(json.dumps(utils.error_message("{} {}".format(str(e),exc),status_code=sc)),status=sc)
+                self.auth.app.logger.exception(exc)
+            finally:
+                if resp is None:
+                    resp=Response(json.dumps(utils.error_message("Unknown error",status_code=500)),status=500)
+                if sc!=200:
+                    resp.headers['Content-Type']='application/json'
+                self.auth.app.logger.info(utils.log(str(sc)))
+                return resp
+
 ###### actual methods
 
 
     def generatePresignedUrls(self,file_paths):
+        ## each url is a memoized lookup or two HMACs , the signing key is shared by the batch
         result = {}
         for id, info in file_paths.items():
             path = info.get('path', None)
@@ -617,67 +1005,273 @@ class StorageAPI:
             raise Exception('path not found')
         if not bucket:
             raise Exception("bucket not found")
-        res = self.aws_s3.generate_presigned_url(
-            ClientMethod='get_object',
-            Params={
-                "Bucket": bucket,
-                "Key": path,
-            },
-            ExpiresIn=3600
-        )
+        res = self.presigner.getUrl(bucket, path, 3600)
         return res
 
-    def move_files(self, from_bucket, from_path, from_filter, to_bucket, to_path):
-        print(from_bucket, from_path, from_filter, to_bucket, to_path)
-        files = self.getFileList(from_bucket, from_path, fltr = [from_filter], only_files = True)
-        new_files = []
-        for file in files:
-            inx_substring = file.find(from_path)
-            new_file = to_path + file[inx_substring + len(from_path):]
-            new_files.append(new_file)
-        
-        
-        for i in range(len(files)):
-        # for i in range(10):
-            from_file = files[i]
-            to_file = new_files[i]
-            copy_source = { 'Bucket': from_bucket,
-                           'Key': from_file  
-                           }
-            print("from: ", from_bucket, " ", from_file )
-            print("to: ", to_bucket, " ", to_file)
-            self.aws_s3.copy(copy_source, to_bucket, to_file)
-        
-        for file in new_files:
-            if from_filter not in file:
-                print(file)
-        # pag_config = {"MaxKeys": 1000, "Prefix": from_path, "Bucket": from_bucket}
-        # paginator = self.aws_s3.get_paginator("list_objects")
-        # result = paginator.paginate(**pag_config)
-        
-        
-    
+    def move_files(self, from_bucket, from_path, from_filter, to_bucket, to_path, delete_source=False):
+        ## server side copies run concurrently ; large objects are copied in parts
+        bt = time.time()
+        objects = [o for o in self.listObjects(from_bucket, from_path) if not o['Key'].endswith('/')]
+        if from_filter:
+            objects = [o for o in objects if from_filter.lower() in o['Key'].lower()]
+        report = {'total': len(objects), 'copied': 0, 'failed': [], 'deleted': 0, 'bytes': 0}
+        copied = []
+        def copy(obj, to_file):
+            self.copyObject(from_bucket, obj['Key'], to_bucket, to_file, obj['Size'])
+            if not delete_source:
+                return True
+            ## a source is only deleted once its copy is seen in the destination
+            meta = self.object_cache.headObject(to_bucket, to_file, use_cache=False)
+            return meta['exists'] and meta['size'] == obj['Size']
+        with ThreadPoolExecutor(max_workers=self.transfer_workers) as pool:
+            futures = {}
+            for obj in objects:
+                from_file = obj['Key']
+                inx_substring = from_file.find(from_path)
+                to_file = to_path + from_file[inx_substring + len(from_path):]
+                futures[pool.submit(copy, obj, to_file)] = (obj, to_file)
+            for future in as_completed(futures):
+                obj, to_file = futures[future]
+                try:
+                    confirmed = future.result()
+                except Exception as e:
+                    report['failed'].append({'from': obj['Key'], 'to': to_file, 'error': str(e)})
+                    continue
+                report['copied'] += 1
+                report['bytes'] += obj['Size']
+                if confirmed:
+                    copied.append(obj['Key'])
+                else:
+                    report['failed'].append({'from': obj['Key'], 'to': to_file, 'error': 'copy not confirmed , source kept'})
+        self.listing.invalidatePrefix(to_bucket, to_path)
+        if delete_source:
+            deleted, errors = self.deleteObjects(from_bucket, copied)
+            report['deleted'] = deleted
+            report['failed'] += errors
+            self.listing.invalidatePrefix(from_bucket, from_path)
+        report['elapsed_seconds'] = time.time() - bt
+        self.auth.app.logger.info("move_files {}/{} -> {}/{} : {}".format(from_bucket, from_path, to_bucket, to_path,
+                                                                          {k: v for k, v in report.items() if k != 'failed'}))
+        return report
+
+    def copyObject(self, from_bucket, from_key, to_bucket, to_key, size):
+        copy_source = {'Bucket': from_bucket, 'Key': from_key}
+        def _copy():
+            if size >= self.multipart_threshold:
+                self.aws_s3.copy(copy_source, to_bucket, to_key, Config=self.transfer_config)
+            else:
+                self.aws_s3.copy_object(CopySource=copy_source, Bucket=to_bucket, Key=to_key)
+        self.withRetries(_copy)
+        self.object_cache.invalidate(to_bucket, to_key)
+
+    def deleteObjects(self, bucket_name, keys):
+        ## delete_objects takes at most 1000 keys per call
+        deleted = 0
+        errors = []
+        for i in range(0, len(keys), 1000):
+            batch = keys[i:i + 1000]
+            res = self.withRetries(self.aws_s3.delete_objects, Bucket=bucket_name,
+                                   Delete={'Objects': [{'Key': k} for k in batch], 'Quiet': True})
+            failed = {e['Key'] for e in res.get('Errors', [])}
+            errors += [{'from': e['Key'], 'error': e.get('Message', '')} for e in res.get('Errors', [])]
+            deleted += len(batch) - len(failed)
+            for k in batch:
+                self.object_cache.invalidate(bucket_name, k)
+        return deleted, errors
+
+    THROTTLING_ERRORS = frozenset(['Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+                                   'SlowDown', 'RequestLimitExceeded', 'TooManyRequestsException',
+                                   'RequestTimeout', 'RequestTimeoutException', 'InternalError', 'ServiceUnavailable'])
+
+    def isTransientError(self, e):
+        ## throttling , 5xx and network failures are worth another try , anything else (denied , missing , invalid) is final
+        if isinstance(e, ClientError):
+            error = e.response.get('Error', {})
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+            return error.get('Code') in self.THROTTLING_ERRORS or status >= 500
+        return isinstance(e, (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ConnectTimeoutError))
+
+    def withRetries(self, func, *args, **kwargs):
+        ## exponential backoff with jitter on top of botocore's own retries , for transient errors only
+        for attempt in range(self.transfer_retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.transfer_retries or not self.isTransientError(e):
+                    raise
+                delay = min(0.5 * 2 ** attempt, 10) * (0.5 + random.random() / 2)
+                self.auth.app.logger.warning("Retrying in {:.1f}s after error : {}".format(delay, str(e)))
+                time.sleep(delay)
+
     #move all spatial folder images for the homescreen to be in an accessible folder
-    def updateWebImages(self):
-      allRuns = self.datastore.grab_runs_homepage_admin()
-      for runs in allRuns:
+    def frontPageImageKeys(self):
+      ## (run id , S3 key of the front page image) of every homepage run
+      res = []
+      for runs in self.datastore.grab_runs_homepage_admin():
         path = runs['results_folder_path']
         if path[0] == 's':
           path = 'S' + path[1:]
         runId = path.split(f'S3://{self.bucket_name}/data/')[1][:-1]
         awsPath = path.split(f'S3://{self.bucket_name}/')[1] + 'frontPage_{}.png'.format(runId)
-        _, exists, _, _ = self.checkFileExists(self.bucket_name, awsPath)
-        if not exists: break
-        f=open('{path}/frontpage_images/frontPage_{run}.png'.format(path = self.webpage_dir, run = runId),'wb+')
-        self.aws_s3.download_fileobj(self.bucket_name, awsPath, f)
-        f.close()
-      return {'outcome':'success'}
+        res.append((runId, awsPath))
+      return res
+
+    def updateWebImages(self):
+      ## incremental : only images whose ETag differs from the local manifest are downloaded
+      image_dir = self.webpage_dir.joinpath('frontpage_images')
+      targets = [(awsPath, image_dir.joinpath('frontPage_{}.png'.format(runId))) for runId, awsPath in self.frontPageImageKeys()]
+      report = self.syncObjects(self.bucket_name, targets, image_dir.joinpath('.manifest.json'))
+      report['outcome'] = 'success'
+      return report
+
+    def syncObjects(self, bucket_name, targets, manifest_path):
+      """Mirrors (key , local path) targets , returns counts of added , updated , skipped , missing and failed files."""
+      bt = time.time()
+      manifest_path = Path(manifest_path)
+      manifest_path.parent.mkdir(parents=True, exist_ok=True)
+      try:
+        with open(manifest_path, 'r') as f:
+          manifest = json.load(f)
+      except (FileNotFoundError, ValueError):
+        manifest = {}
+      def sync(key, local_path):
+        meta = self.withRetries(self.object_cache.headObject, bucket_name, key, use_cache=False)
+        if not meta['exists']:
+          return 'missing', None
+        local_path = Path(local_path)
+        if local_path.exists() and manifest.get(str(local_path)) == meta['etag']:
+          return 'skipped', meta['etag']
+        status = 'updated' if local_path.exists() else 'added'
+        ## readers never see a partially written file
+        temp_path = local_path.with_name('.{}.{}'.format(local_path.name, uuid.uuid4().hex))
+        try:
+          self.withRetries(self.aws_s3.download_file, bucket_name, key, str(temp_path))
+          os.replace(temp_path, local_path)
+        finally:
+          if temp_path.exists():
+            temp_path.unlink()
+        return status, meta['etag']
+      report = {'added': 0, 'updated': 0, 'skipped': 0, 'missing': 0, 'failed': 0, 'errors': []}
+      with ThreadPoolExecutor(max_workers=self.transfer_workers) as pool:
+        futures = {pool.submit(sync, key, local_path): (key, local_path) for key, local_path in targets}
+        for future in as_completed(futures):
+          key, local_path = futures[future]
+          try:
+            status, etag = future.result()
+          except Exception as e:
+            status, etag = 'failed', None
+            report['errors'].append({'key': key, 'error': str(e)})
+          report[status] += 1
+          if etag is not None:
+            manifest[str(local_path)] = etag
+      temp_manifest = manifest_path.with_name(manifest_path.name + '.tmp')
+      with open(temp_manifest, 'w') as f:
+        json.dump(manifest, f)
+      os.replace(temp_manifest, manifest_path)
+      report['elapsed_seconds'] = time.time() - bt
+      self.auth.app.logger.info("Synced {} objects from {} : {}".format(len(targets), bucket_name,
+                                                                        {k: v for k, v in report.items() if k != 'errors'}))
+      return report
     def screenShotImages(self, url, run):
       base_string = url.replace("data:image/png;base64,", "")
       decoded_img = base64.b64decode(base_string)
-      img = Image.open(io.BytesIO(decoded_img))
-      img.thumbnail((200, 200))
-      img.save('{}/frontpage_images/frontPage_{}.png'.format(self.webpage_dir, run))
+      ## decoding and resizing run in the process pool , not on the request thread
+      return self.writeThumbnails(run, self.buildThumbnails(decoded_img))
+
+    def getThumbnailPool(self, broken=None):
+      ## created on first use so that it is forked from the worker process ,
+      ## and again when a child died (e.g. killed by the OOM killer) and broke it
+      with self.thumbnail_pool_lock:
+        if broken is not None and self.thumbnail_pool is broken:
+          broken.shutdown(wait=False)
+          self.thumbnail_pool = None
+        if self.thumbnail_pool is None:
+          self.thumbnail_pool = ProcessPoolExecutor(max_workers=self.thumbnail_workers)
+        return self.thumbnail_pool
+
+    def buildThumbnails(self, data):
+      pool = self.getThumbnailPool()
+      try:
+        return pool.submit(imaging.build_thumbnails, data, self.thumbnail_sizes, self.thumbnail_formats).result()
+      except BrokenProcessPool:
+        self.auth.app.logger.warning("Thumbnail pool broken , recreating it")
+        pool = self.getThumbnailPool(broken=pool)
+        return pool.submit(imaging.build_thumbnails, data, self.thumbnail_sizes, self.thumbnail_formats).result()
+
+    def writeThumbnails(self, run, thumbs):
+      image_dir = self.webpage_dir.joinpath('frontpage_images')
+      image_dir.mkdir(parents=True, exist_ok=True)
+      stem = 'frontPage_{}'.format(run)
+      index = {}
+      for size, fmt, data in thumbs:
+        name = imaging.thumbnail_name(stem, size, fmt, data)
+        index.setdefault(str(size), {})[fmt] = name
+        path = image_dir.joinpath(name)
+        if not path.exists():
+          temp_path = image_dir.joinpath('.{}.tmp'.format(name))
+          temp_path.write_bytes(data)
+          os.replace(temp_path, path)
+      ## the legacy image is the configured size , or the closest one generated , in the configured format
+      legacy = sorted([t for t in thumbs if t[1] == self.thumbnail_legacy_format], key=lambda t: abs(t[0] - self.thumbnail_legacy_size))
+      if legacy:
+        legacy_name = '{}.{}'.format(stem, self.thumbnail_legacy_format)
+        temp_path = image_dir.joinpath('.{}.tmp'.format(legacy_name))
+        temp_path.write_bytes(legacy[0][2])
+        os.replace(temp_path, image_dir.joinpath(legacy_name))
+      temp_path = image_dir.joinpath('.{}.thumbnails.json.tmp'.format(stem))
+      temp_path.write_text(json.dumps(index))
+      os.replace(temp_path, image_dir.joinpath(stem + '.thumbnails.json'))
+      ## thumbnails of a previous version of the image
+      names = set(n for formats in index.values() for n in formats.values())
+      pattern = re.compile(re.escape(stem) + r'\.\d+\.[0-9a-f]{12}\.\w+$')
+      for path in image_dir.glob(stem + '.*'):
+        if pattern.match(path.name) and path.name not in names:
+          path.unlink()
+      return index
+
+    def getThumbnailIndex(self, run):
+      path = self.webpage_dir.joinpath('frontpage_images', 'frontPage_{}.thumbnails.json'.format(run))
+      if not path.exists():
+        return None
+      return json.loads(path.read_text())
+
+    def getThumbnailObject(self, run, name):
+      if name != secure_filename(name) or not name.startswith('frontPage_{}.'.format(run)) or name.endswith('.json'):
+        return None
+      path = self.webpage_dir.joinpath('frontpage_images', name)
+      if not path.exists():
+        return None
+      st = path.stat()
+      return {'path': path,
+              'size': st.st_size,
+              'etag': name.split('.')[-2],
+              'last_modified': datetime.datetime.fromtimestamp(st.st_mtime, tz=datetime.timezone.utc)}
+
+    def backfillThumbnails(self, runs=None):
+      """Regenerates the thumbnails of every homepage run (or of the given runs) from their S3 front page images."""
+      bt = time.time()
+      targets = [(runId, awsPath) for runId, awsPath in self.frontPageImageKeys() if runs is None or runId in runs]
+      def backfill(run, key):
+        obj = self.object_cache.getObject(self.bucket_name, key)
+        if obj is None:
+          return 'missing'
+        data = Path(obj['path']).read_bytes()
+        self.writeThumbnails(run, self.buildThumbnails(data))
+        return 'generated'
+      report = {'generated': 0, 'missing': 0, 'failed': 0, 'errors': []}
+      ## threads fetch the sources , the process pool bounds the cpu work
+      with ThreadPoolExecutor(max_workers=self.thumbnail_workers * 2) as threads:
+        futures = {threads.submit(backfill, run, key): run for run, key in targets}
+        for future in as_completed(futures):
+          try:
+            report[future.result()] += 1
+          except Exception as e:
+            report['failed'] += 1
+            report['errors'].append({'run': futures[future], 'error': str(e)})
+      report['elapsed_seconds'] = time.time() - bt
+      self.auth.app.logger.info("Thumbnails backfilled : {}".format({k: v for k, v in report.items() if k != 'errors'}))
+      return report
+
     def grabAllBuckets(self):
       buckets = self.aws_s3.list_buckets()['Buckets']
       bucks = []
@@ -687,19 +1281,139 @@ class StorageAPI:
     def decodeInfo(self, token):
       req = self.decodeLink(token, None, None)
       return req['meta']
+    def uploadDestination(self,fields,filename):
+        ## same defaults as the form fields of /storage/upload
+        bucket_name=fields.get('bucket_name') or self.bucket_name
+        output_filename=Path(filename).name
+        if fields.get('output_filename'):
+            output_filename=Path(fields['output_filename'])
+            try:
+                output_filename=output_filename.relative_to('/')
+            except:
+                pass
+            output_filename=output_filename.__str__()
+        return bucket_name,output_filename
+
+    def uploadStream(self,username):
+        boundary=request.mimetype_params.get('boundary')
+        if request.mimetype!='multipart/form-data' or not boundary:
+            raise Exception("multipart/form-data body expected")
+        ## bucket_name / output_filename may also come in the query string , ahead of the body
+        fields=dict(request.args.items())
+        writer=None
+        uploaded=None
+        source=None
+        try:
+            for event in uploads.iter_multipart(request.stream,boundary,self.chunk_size):
+                if event[0]=='field':
+                    fields[event[1]]=event[2]
+                elif event[0]=='file' and event[1]=='file' and uploaded is None:
+                    bucket_name,output_key=self.uploadDestination(fields,event[2])
+                    filename=event[2]
+                    if self.flagRequested(fields,'destination_after_file'):
+                        ## the client sends bucket_name / output_filename after the file part ,
+                        ## never write to a key that could hold an unrelated object
+                        output_key='{}{}'.format(self.upload_tmp_prefix,uuid.uuid4().hex)
+                    ## in dedup mode a sha256 / size sent ahead of the file can skip the transfer to S3
+                    if self.dedupRequested(fields) and fields.get('sha256') and fields.get('size'):
+                        source=self.findDuplicate(fields['sha256'],fields['size'],bucket_name)
+                    if source is not None:
+                        writer=uploads.HashingSink()
+                    else:
+                        writer=uploads.MultipartUploadWriter(self.aws_s3,bucket_name,output_key,self.upload_part_size,self.upload_workers)
+                elif event[0]=='data' and writer is not None:
+                    writer.write(event[1])
+                elif event[0]=='end' and writer is not None:
+                    etag=writer.close()
+                    uploaded=(bucket_name,output_key,writer.size,writer.sha256.hexdigest(),etag)
+                    writer=None
+        except Exception:
+            if writer is not None:
+                writer.abort()
+            raise
+        if uploaded is None:
+            raise Exception("No file part in the request")
+        bucket_name,output_key,size,sha256,etag=uploaded
+        final_bucket,final_key=self.uploadDestination(fields,filename)
+        if source is not None:
+            if (sha256,size)!=(fields['sha256'].lower(),int(fields['size'])):
+                raise Exception("The file doesn't match the sha256 and size sent with it , nothing was stored")
+            self.copyDuplicate(source,final_bucket,final_key)
+            self.auth.app.logger.info("File deduplicated s3://{}/{} from s3://{}/{} by {}".format(final_bucket,final_key,source['bucket_name'],source['key'],username))
+            return utils.result_message(final_key)
+        if (final_bucket,final_key)!=(bucket_name,output_key):
+            ## temporary key , or destination fields sent after the file part without destination_after_file
+            try:
+                self.copyObject(bucket_name,output_key,final_bucket,final_key,size)
+            finally:
+                self.deleteFile(bucket_name,output_key)
+            etag=None
+        self.finishUpload(final_bucket,final_key,size,sha256,etag)
+        self.auth.app.logger.info("File uploaded s3://{}/{} ({} bytes) by {}".format(final_bucket,final_key,size,username))
+        return utils.result_message(final_key)
+
+    def finishUpload(self,bucket_name,key,size,sha256=None,etag=None):
+        ## shared by every path writing a new object : caches , listing and content hash index
+        self.object_cache.invalidate(bucket_name,key)
+        self.listing.put(bucket_name,key,size,etag)
+        if sha256 is not None:
+            self.recordContentHash(bucket_name,key,sha256,size,etag)
+
+    def dedupRequested(self,fields):
+        return self.flagRequested(fields,'dedup',self.upload_dedup)
+
+    def flagRequested(self,fields,name,default=False):
+        value=fields.get(name)
+        if value is None:
+            return default
+        return str(value).lower() in ['true','1','yes']
+
+    def findDuplicate(self,sha256,size,bucket_name=None):
+        def is_current(entry):
+            meta=self.object_cache.headObject(entry['bucket_name'],entry['key'])
+            return meta['exists'] and meta['etag']==entry['etag'] and meta['size']==entry['size']
+        return self.content_hashes.lookup(str(sha256).lower(),int(size),is_current,bucket_name)
+
+    def copyDuplicate(self,source,bucket_name,key):
+        if (source['bucket_name'],source['key'])!=(bucket_name,key):
+            self.copyObject(source['bucket_name'],source['key'],bucket_name,key,source['size'])
+            self.listing.put(bucket_name,key,source['size'])
+            self.recordContentHash(bucket_name,key,source['sha256'],source['size'])
+
+    def uploadDeduplicated(self,bucket_name,key,sha256,size):
+        """Server side copy of an already stored object with this content , returns its index entry or None."""
+        source=self.findDuplicate(sha256,size,bucket_name)
+        if source is not None:
+            self.copyDuplicate(source,bucket_name,key)
+        return source
+
+    def recordContentHash(self,bucket_name,key,sha256,size,etag=None):
+        try:
+            if etag is None:
+                ## copies of multipart objects get a new ETag
+                etag=self.object_cache.headObject(bucket_name,key,use_cache=False)['etag']
+            self.content_hashes.record(bucket_name,key,sha256,size,etag)
+        except Exception as e:
+            ## the upload itself succeeded , it just won't be found for dedup
+            self.auth.app.logger.exception("Couldn't index the content hash of s3://{}/{} : {}".format(bucket_name,key,str(e)))
+
     def uploadFile(self,bucket_name,fileobj,output_key,meta=None):
         try:
-            temp_outpath=self.tempDirectory.joinpath("{}_{}".format(utils.get_uuid(),Path(fileobj.filename).name))
             #_,tf=self.checkFileExists(bucket_name,output_key)
             #if not self.isFileExistInEntry(f.filename): self.insertEntry(meta)
             try:
-                ### save file in temporary disk
-                fileobj.save(str(temp_outpath))
-                ### move the file to s3
-                self.aws_s3.upload_file(str(temp_outpath),bucket_name,output_key)
-                temp_outpath.unlink()
-                self.auth.app.logger.info("File saved {}".format(str(temp_outpath)))
-                return utils.result_message(str(temp_outpath))                
+                ### stream the file to s3 with the same writer as /storage/upload , no temporary copy on disk
+                writer=uploads.MultipartUploadWriter(self.aws_s3,bucket_name,output_key,self.upload_part_size,self.upload_workers)
+                try:
+                    for chunk in iter(lambda: fileobj.stream.read(self.chunk_size),b''):
+                        writer.write(chunk)
+                except Exception:
+                    writer.abort()
+                    raise
+                etag=writer.close()
+                self.finishUpload(bucket_name,output_key,writer.size,writer.sha256.hexdigest(),etag)
+                self.auth.app.logger.info("File saved s3://{}/{}".format(bucket_name,output_key))
+                return utils.result_message(output_key)                
             except Exception as e:
                 exc=traceback.format_exc()
                 self.auth.app.logger.exception(utils.log(exc))
@@ -723,6 +1437,8 @@ class StorageAPI:
 
     def deleteFile(self,bucket_name, object_key):
         res=self.aws_s3.delete_object(Bucket=bucket_name, Key=object_key)
+        self.object_cache.invalidate(bucket_name, object_key)
+        self.listing.remove(bucket_name, object_key)
         return res 
       
     def uploadFile_link(self,bucket_name,fileobj,output_key,meta={}):
@@ -748,10 +1464,9 @@ class StorageAPI:
             return utils.error_message("The file doesn't exists",status_code=404)
         else:
             try:
-                resp=self.aws_s3.generate_presigned_url('get_object',
-                                                Params={'Key':filename,
-                                                        'Bucket':bucket_name},
-                                                ExpiresIn=expiry)
+                resp=self.presigner.getUrl(bucket_name,filename,expiry)
+            except ValueError as e:
+                return utils.error_message(str(e),status_code=400)
             except Exception as e:
                 exc=traceback.format_exc()
                 self.auth.app.logger.exception(utils.log(exc))
@@ -772,89 +1487,65 @@ class StorageAPI:
                 return utils.error_message("Couldn't have finished to get the link of the file: {}, {}".format(str(e),exc),status_code=500)
         self.auth.app.logger.info("File Link returned {}".format(str(resp)))
         return resp
-    def getFileObject(self,bucket_name,filename, no_aws_yes_server = True):
-      _,tf,date,size=self.checkFileExists(bucket_name,filename)
-      temp_outpath=self.tempDirectory.joinpath(filename)
-      ext=Path(filename).suffix
-      if not tf :
-        if temp_outpath.exists() and no_aws_yes_server:
-          f=open(temp_outpath, 'rb')
-          bytesIO=io.BytesIO(f.read())
-          size=os.fstat(f.fileno()).st_size
-          f.close() 
-          return bytesIO, ext, size , temp_outpath
-        else: return utils.error_message("The file doesn't exists",status_code=404)
-      else:
-          if not temp_outpath.exists():
-            temp_outpath.parent.mkdir(parents=True, exist_ok=True)
-            f=open(temp_outpath,'wb+')
-            self.aws_s3.download_fileobj(bucket_name,filename,f)
-            bytesIO=io.BytesIO(f.read())
-            size=os.fstat(f.fileno()).st_size
-            f.close()
-          else:
-            modified_time = os.path.getmtime(temp_outpath)
-            formatted = datetime.datetime.fromtimestamp(modified_time)
-            if date.replace(tzinfo=None) > formatted and size > 0:
-              f=open(temp_outpath,'wb+')
-              self.aws_s3.download_fileobj(bucket_name,filename,f)
-            else :
-              f=open(temp_outpath, 'rb')
-            bytesIO=io.BytesIO(f.read())
-            size=os.fstat(f.fileno()).st_size
-            f.close()
-          return bytesIO, ext, size , temp_outpath
-
-    def rotate_file_object(self, relative_path, degree):
-        rel_path = Path(relative_path)
-        path = self.tempDirectory.joinpath(rel_path)
-        img = cv2.imread(path.__str__(), cv2.IMREAD_COLOR)
-        img = self.rotate_image_no_cropping(img, degree)
-        bytesIO = self.get_img_bytes(img)
-        size_bytes = bytesIO.getbuffer().nbytes
-        return bytesIO, size_bytes
-    
     def get_img_bytes(self, img):
         success, encoded = cv2.imencode('.jpg', img)
         bytes = encoded.tobytes()
         bytesIO = io.BytesIO(bytes)
         return bytesIO
 
-    def getFileObjectAsJPG(self,bucket_name,filename, try_cache, rotation):
-        _,tf,date,size=self.checkFileExists(bucket_name,filename)
-        temp_filename="{}".format(Path(filename))
-        temp_outpath=self.tempDirectory.joinpath(temp_filename)
-        ext=Path(filename).suffix
-        if not tf :
-            return utils.error_message("The file doesn't exists",status_code=404)
-        if try_cache and temp_outpath.exists():
-            img = cv2.imread(temp_outpath.__str__(), cv2.IMREAD_COLOR)
-        else:
-            if temp_outpath.exists() == False: temp_outpath.parent.mkdir(parents=True, exist_ok=True)
-            f=open(temp_outpath,'wb+')
-            self.aws_s3.download_fileobj(bucket_name,filename,f)
-            f.close()
-            img=cv2.imread(temp_outpath.__str__(),cv2.IMREAD_COLOR)
-        if rotation != 0:
-            img = self.rotate_image_no_cropping(img=img, degree=rotation)
-        bytesIO = self.get_img_bytes(img)
-        size = bytesIO.getbuffer().nbytes
-        return bytesIO, ext, size , temp_outpath.__str__()
-    
-    def crop_image(self,img, x1, x2, y1, y2):
-        return img[y1: y2, x1: x2]
-
-    def get_gray_image_rotation_cropping_jpg(self, filename, rotation, x1, x2, y1, y2):
-        rel_path = Path(filename)
-        path = self.tempDirectory.joinpath(rel_path)
-        img=cv2.imread(path.__str__(),cv2.IMREAD_COLOR)
-        gray_img = img[:, :, 0]
-        if rotation != 0:
-            gray_img = self.rotate_image_no_cropping(gray_img, rotation)
-        cropped = self.crop_image(gray_img, x1, x2, y1, y2)
-        bytesIO = self.get_img_bytes(cropped)
-        size = bytesIO.getbuffer().nbytes
-        return bytesIO, size
+    def getImageOutputParams(self, default_format='jpg', strict=False):
+        ## max_width / max_height (max_size sets both) , quality and format (jpg , png , webp , avif or auto) from the query string
+        ## sizes and qualities are snapped to the configured values , strict rejects the others (ValueError)
+        max_size = request.args.get('max_size', type=int, default=None)
+        max_width = imaging.snap_value(request.args.get('max_width', type=int, default=max_size), self.image_sizes, 'max_width', strict)
+        max_height = imaging.snap_value(request.args.get('max_height', type=int, default=max_size), self.image_sizes, 'max_height', strict)
+        quality = imaging.snap_value(request.args.get('quality', type=int, default=None), self.image_qualities, 'quality', strict)
+        requested_format = request.args.get('format', type=str, default=None)
+        _, ext, mimetype = imaging.negotiate_format(requested_format, request.headers.get('Accept'), default_format)
+        return {'ops': [('resize', max_width, max_height)] if (max_width or max_height) else [],
+                'ext': ext,
+                'quality': quality,
+                ## without a format parameter the endpoints keep their previous content type
+                'mimetype': mimetype if requested_format else 'application/octet-stream',
+                'negotiated': requested_format == 'auto',
+                'requested': bool(max_width or max_height or quality or requested_format)}
+
+    def renderedResponse(self, bucket_name, filename, ops, output):
+        obj = self.getRenderedObject(bucket_name, filename, ops, ext=output['ext'], quality=output['quality'])
+        if obj is None:
+            res = utils.error_message("The file doesn't exists", status_code=404)
+            resp = Response(json.dumps(res), status=res['status_code'])
+            resp.headers['Content-Type'] = 'application/json'
+            return resp
+        resp = self.fileResponse(obj, mimetype=output['mimetype'])
+        if output['negotiated']:
+            resp.headers['Vary'] = 'Accept'
+        return resp
+
+    def getRenderedObject(self, bucket_name, filename, ops, ext='.jpg', quality=None):
+        ## encoded result of an operation chain , computed once per source ETag and kept with the cached object
+        meta = self.object_cache.headObject(bucket_name, filename)
+        if not meta['exists']:
+            return None
+        etag = meta['etag']
+        name = imaging.render_name(ops, ext, quality)
+        path = self.object_cache.getDerived(bucket_name, filename, etag, name)
+        if path is None:
+            with self.object_cache.lockObject(bucket_name, filename, name):
+                path = self.object_cache.getDerived(bucket_name, filename, etag, name)
+                if path is None:
+                    obj = self.object_cache.getObject(bucket_name, filename)
+                    if obj is None:
+                        ## deleted since the HEAD
+                        return None
+                    img = imaging.read_image(obj['path'], ops)
+                    img = imaging.apply_ops(img, ops)
+                    path = self.object_cache.putDerived(bucket_name, filename, etag, name, imaging.encode_image(img, ext, quality))
+        st = path.stat()
+        return {'path': path,
+                'size': st.st_size,
+                'etag': '{}-{}'.format(etag, hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]),
+                'last_modified': datetime.datetime.fromtimestamp(st.st_mtime, tz=datetime.timezone.utc)}
 
     # def check_spatial_folder_exists(self, bucket_name, run_id, root_folder):
     #     try:
@@ -863,97 +1554,280 @@ class StorageAPI:
     #     except ClientError:
     #         return False
 
-    def get_gray_image_rotation_jpg(self, filename, rotation):
-        rel_path = Path(filename)
-        path = self.tempDirectory.joinpath(rel_path)
-        img=cv2.imread(path.__str__(),cv2.IMREAD_COLOR)
-        gray_img = img[:, :, 0]
-        if rotation != 0:
-            gray_img = self.rotate_image_no_cropping(gray_img, rotation)
-        bytesIO = self.get_img_bytes(gray_img)
-        size = bytesIO.getbuffer().nbytes
-        return bytesIO, size
+    def getTilePyramid(self, bucket_name, filename, tile=None):
+        ## the pyramid is built once per ETag and kept in the object cache , info.json is written last ;
+        ## with tile , it is also rebuilt when that tile was evicted
+        meta = self.object_cache.headObject(bucket_name, filename)
+        if not meta['exists']:
+            return None
+        etag = meta['etag']
+        if tile is None:
+            info_path = self.object_cache.getDerived(bucket_name, filename, etag, 'tiles/info.json')
+            if info_path is not None:
+                with open(info_path, 'r') as f:
+                    return json.load(f)
+        with self.object_cache.lockObject(bucket_name, filename, 'tiles'):
+            ## a burst of misses waits here , only the first one rebuilds
+            info_path = self.object_cache.getDerived(bucket_name, filename, etag, 'tiles/info.json')
+            if info_path is not None and (tile is None or self.object_cache.getDerived(bucket_name, filename, etag, tile) is not None):
+                with open(info_path, 'r') as f:
+                    return json.load(f)
+            obj = self.object_cache.getObject(bucket_name, filename)
+            if obj is None:
+                return None
+            img = cv2.imread(obj['path'].__str__(), cv2.IMREAD_COLOR)
+            height, width = img.shape[:2]
+            ## the levels written so far must survive the eviction run by the next ones
+            tiles_dir = self.object_cache.derivedPath(bucket_name, filename, etag, 'tiles')
+            total = 0
+            for level, tiles in imaging.build_pyramid(img, self.tile_size):
+                files = [('tiles/{}/{}_{}.jpg'.format(level, col, row), imaging.encode_image(tile, '.jpg', self.tile_quality))
+                         for col, row, tile in tiles]
+                total += sum(len(data) for _, data in files)
+                self.object_cache.putDerivedFiles(bucket_name, filename, etag, files, keep_dirs=[tiles_dir])
+            info = {'width': width,
+                    'height': height,
+                    'tile_size': self.tile_size,
+                    'levels': imaging.top_level(width, height) + 1,
+                    'format': 'jpg',
+                    'bytes': total,
+                    'etag': etag}
+            self.object_cache.putDerived(bucket_name, filename, etag, 'tiles/info.json', json.dumps(info).encode('utf-8'))
+        return info
 
-    def rotate_image_no_cropping(self, img, degree):
-        (h, w) = img.shape[:2]
-        (cX, cY) = (w // 2, h // 2)
-        # rotate our image by 45 degrees around the center of the image
-        M = cv2.getRotationMatrix2D((cX, cY), degree, 1.0)
-        abs_cos = abs(M[0,0]) 
-        abs_sin = abs(M[0,1])
-        bound_w = int(h * abs_sin + w * abs_cos)
-        bound_h = int(h * abs_cos + w * abs_sin)
-        M[0, 2] += bound_w/2 - cX
-        M[1, 2] += bound_h/2 - cY
-        rotated = cv2.warpAffine(img, M, (bound_w, bound_h))
-        return rotated
-
-    def getImage(self,bucket_name,filename):
-        _,tf,date,size=self.checkFileExists(bucket_name,filename)
-        temp_filename="{}".format(Path(filename))
-        temp_outpath=self.tempDirectory.joinpath(temp_filename)
-        ext=Path(filename).suffix
-        tf=True
-        if not tf :
-            return utils.error_message("The file doesn't exists",status_code=404)
-        else:
-            if temp_outpath.exists() == False: 
-              temp_outpath.parent.mkdir(parents=True, exist_ok=True)
-              f=open(temp_outpath,'wb+')
-              self.aws_s3.download_fileobj(bucket_name,filename,f)
-            else:
-              f=open(temp_outpath,'rb+')
-            bytesIO=io.BytesIO(f.read())
-            size=os.fstat(f.fileno()).st_size
-            f.close()
-        return bytesIO, ext, size , temp_outpath.__str__()
+    def getTile(self, bucket_name, filename, level, x, y):
+        info = self.getTilePyramid(bucket_name, filename)
+        if info is None or level < 0 or level >= info['levels']:
+            return None
+        lw, lh = imaging.level_dimensions(info['width'], info['height'], level)
+        cols, rows = imaging.tile_grid(lw, lh, info['tile_size'])
+        if x < 0 or y < 0 or x >= cols or y >= rows:
+            return None
+        name = 'tiles/{}/{}_{}.jpg'.format(level, x, y)
+        path = self.object_cache.getDerived(bucket_name, filename, info['etag'], name)
+        if path is None and info.get('bytes', 0) <= self.object_cache.max_bytes // 2:
+            ## evicted , rebuild the pyramid for this ETag
+            rebuilt = self.getTilePyramid(bucket_name, filename, tile=name)
+            if rebuilt is None:
+                return None
+            info = rebuilt
+            path = self.object_cache.getDerived(bucket_name, filename, info['etag'], name)
+        if path is None:
+            ## a pyramid too large for the cache quota is not rebuilt over and over , the tile is rendered alone
+            path = self.renderTile(bucket_name, filename, info, level, x, y)
+            if path is None:
+                return None
+        st = path.stat()
+        return {'path': path,
+                'size': st.st_size,
+                'etag': '{}-t{}-{}-{}'.format(info['etag'], level, x, y),
+                'last_modified': datetime.datetime.fromtimestamp(st.st_mtime, tz=datetime.timezone.utc)}
 
+    def renderTile(self, bucket_name, filename, info, level, x, y):
+        obj = self.object_cache.getObject(bucket_name, filename)
+        if obj is None:
+            return None
+        img = cv2.imread(obj['path'].__str__(), cv2.IMREAD_COLOR)
+        tile = imaging.render_tile(img, level, x, y, info['tile_size'])
+        name = 'tiles/{}/{}_{}.jpg'.format(level, x, y)
+        return self.object_cache.putDerived(bucket_name, filename, info['etag'], name, imaging.encode_image(tile, '.jpg', self.tile_quality))
 
+    def getCropFromTiles(self, bucket_name, filename, level, x1, x2, y1, y2):
+        ## crop box in the coordinates of the requested level
+        if level is None or None in (x1, x2, y1, y2):
+            raise ValueError("level , x1 , x2 , y1 and y2 are required integers")
+        info = self.getTilePyramid(bucket_name, filename)
+        if info is None:
+            raise Exception("The file doesn't exists")
+        if level < 0 or level >= info['levels']:
+            raise ValueError("level must be between 0 and {}".format(info['levels'] - 1))
+        lw, lh = imaging.level_dimensions(info['width'], info['height'], level)
+        def read_tile(col, row):
+            obj = self.getTile(bucket_name, filename, level, col, row)
+            tile = cv2.imread(obj['path'].__str__(), cv2.IMREAD_COLOR) if obj is not None else None
+            if tile is None:
+                ## evicted between the lookup and the read , the tile is rendered alone
+                path = self.renderTile(bucket_name, filename, info, level, col, row)
+                if path is None:
+                    raise Exception("The file doesn't exists")
+                tile = cv2.imread(path.__str__(), cv2.IMREAD_COLOR)
+            return tile
+        cropped = imaging.assemble_crop(read_tile, lw, lh, info['tile_size'], x1, x2, y1, y2)
+        bytesIO = self.get_img_bytes(cropped)
+        size = bytesIO.getbuffer().nbytes
+        return bytesIO, size
 
     def getJsonFromFile(self, bucket_name, filename, no_aws_yes_server):
-      _,_,_,name=self.getFileObject(bucket_name,filename, no_aws_yes_server)
-      out = json.load(open(name,'rb'))
+      obj=self.getCachedObject(bucket_name,filename, no_aws_yes_server)
+      if obj is None: raise Exception("The file doesn't exists")
+      if filename.endswith('.gz'):
+        with gzip.open(obj['path'],'rb') as f:
+          return json.load(f)
+      out = json.load(open(obj['path'],'rb'))
       return out
 
+    def acceptsGzip(self):
+      return request.accept_encodings.quality('gzip') > 0
+
+    def getGzipPassthroughObject(self, bucket_name, filename, no_aws_yes_server=True):
+      ## .gz objects are handed to gzip capable clients without being decompressed
+      if not filename.endswith('.gz') or not self.acceptsGzip():
+        return None
+      obj=self.getCachedObject(bucket_name,filename,no_aws_yes_server)
+      if obj is None: raise Exception("The file doesn't exists")
+      return obj
+
+    def gzipResponse(self, obj, mimetype):
+      ## X-Accel-Redirect drops the upstream Content-Encoding , so these are always served by the app
+      obj=dict(obj, etag='{}-gzip'.format(obj['etag']) if obj['etag'] else None)
+      resp=self.fileResponse(obj,mimetype,redirect=False)
+      resp.headers['Content-Encoding']='gzip'
+      resp.headers['Vary']='Accept-Encoding'
+      return resp
+
+    def getCsvFileResponse(self, bucket_name, filename, no_aws_yes_server=True):
+      obj=self.getCachedObject(bucket_name,filename,no_aws_yes_server)
+      if obj is None: raise Exception("The file doesn't exists")
+      if not filename.endswith('.gz'):
+        return self.fileResponse(obj,mimetype='text/csv')
+      ## gzip file for a client without gzip support , decompressed chunk by chunk
+      etag='{}-identity'.format(obj['etag']) if obj['etag'] else None
+      resp=utils.not_modified(etag,obj['last_modified'],self.cache_control)
+      if resp is None:
+        ## opened before the response is built , so an eviction can't break the body
+        f=gzip.open(obj['path'],'rb')
+        resp=Response(self.readGzipChunks(f),status=200,mimetype='text/csv',direct_passthrough=True)
+        resp.call_on_close(f.close)
+        utils.set_validators(resp,etag,obj['last_modified'],self.cache_control)
+      resp.headers['Vary']='Accept-Encoding'
+      return resp
+
+    def readGzipChunks(self, f):
+      ## f is closed by the response , even when the body is never iterated
+      while True:
+        chunk=f.read(self.chunk_size)
+        if not chunk: break
+        yield chunk
+
+    def getJsonResponse(self, bucket_name, filename, no_aws_yes_server):
+        res = self.getJsonFromFile(bucket_name,filename, no_aws_yes_server)
+        resp=Response(json.dumps(res),status=200)
+        resp.headers['Content-Type']='application/json'
+        return resp
+
+    def getCsvRowsResponse(self, bucket_name, filename, no_aws_yes_server, slicing):
+        if tabular.has_slicing(slicing):
+            res,total = tabular.read_rows(self.object_cache,bucket_name,filename,**slicing)
+            resp=Response(json.dumps(res),status=200)
+            resp.headers['Content-Type']='application/json'
+            resp.headers['X-Total-Rows']=total
+            return resp
+        rows = self.iterCsvRows(bucket_name,filename, no_aws_yes_server)
+        return utils.json_stream_response(utils.stream_json_list(rows))
+
+    def transformEtag(self, bucket_name, filename):
+        ## S3 ETag of the source plus the request parameters that shape the response
+        meta=self.object_cache.headObject(bucket_name,filename)
+        if not meta['exists']:
+            return None
+        params=sorted(request.args.items(multi=True))
+        digest=hashlib.sha1(json.dumps(params).encode('utf-8')).hexdigest()[:16]
+        return '{}-{}'.format(meta['etag'],digest)
+
+    def conditionalResponse(self, bucket_name, filename, build):
+        ## build() only runs when the client doesn't already hold this version ;
+        ## a gzip capable client gets the stored .gz bytes instead , so shared caches must key on Accept-Encoding
+        etag=self.transformEtag(bucket_name,filename)
+        if etag is not None:
+            resp=utils.not_modified(etag,cache_control=self.cache_control)
+            if resp is not None:
+                resp.headers['Vary']='Accept-Encoding'
+                return resp
+        resp=build()
+        if etag is not None and resp.status_code==200:
+            utils.set_validators(resp,etag,cache_control=self.cache_control)
+        resp.headers['Vary']='Accept-Encoding'
+        return resp
+
     def getCsvFileAsJson(self,bucket_name,filename, no_aws_yes_server):
-        _,_,_,name=self.getFileObject(bucket_name,filename, no_aws_yes_server)
+        return list(self.iterCsvRows(bucket_name,filename,no_aws_yes_server))
+
+    def iterCsvRows(self,bucket_name,filename, no_aws_yes_server):
+        ## the lookup runs on the first next() , so a missing file still fails before any byte is sent
+        obj=self.getCachedObject(bucket_name,filename, no_aws_yes_server)
+        if obj is None: raise Exception("The file doesn't exists")
+        name=obj['path']
         if '.gz' not in filename:
-          out = []
           with open(name,'r') as cf:
-            csvreader = csv.reader(cf, delimiter=',')
-            for r in csvreader:
-                out.append(r)
+            yield from csv.reader(cf, delimiter=',')
         else:
-          out = []
           with gzip.open(name,'rt', encoding='utf-8') as cf:
-            csvreader = csv.reader(cf, delimiter=',')
-            for r in csvreader:
-              out.append(r)
-        return out
+            yield from csv.reader(cf, delimiter=',')
 
     def getFilesZipped(self,bucket_name, rootdir):
-        filelist=self.getFileList(bucket_name,rootdir)
-        temp_dir_name=utils.get_uuid()
-        temp_rootdir=self.tempDirectory.joinpath(temp_dir_name)
-        temp_rootdir.mkdir(parents=True,exist_ok=True)
-        temp_filelist=[temp_rootdir.joinpath(Path(f)).__str__() for f in filelist]
-        for idx,out_fn in enumerate(temp_filelist):
-            Path(out_fn).parent.mkdir(parents=True,exist_ok=True)
-            self.aws_s3.download_file(bucket_name, filelist[idx], out_fn)
-            out_fn.close()
-            os.remove(out_fn)
-        output_filename=self.tempDirectory.joinpath("{}.zip".format(temp_dir_name))
-        shutil.make_archive(self.tempDirectory.joinpath(temp_dir_name), 'zip', temp_rootdir.__str__())
-        ext='zip'
-        bytesIO=None
-        size=0
-        with open(output_filename,'rb') as f:
-            bytesIO=io.BytesIO(f.read())
-            size=os.fstat(f.fileno()).st_size
-        return bytesIO, ext, size , output_filename.__str__()
-
+        ## generator of zip bytes : objects are prefetched into the object cache by a bounded pool
+        ## and written one by one , so memory stays bounded by the prefetch window and the chunk size ;
+        ## prefetched copies are opened right away , so evicting them before their turn can't lose them
+        ## a failure after the first bytes is logged and raised , the server then drops the connection
+        ## instead of ending the archive as if it were complete
+        filelist=self.getFileList(bucket_name,rootdir,only_files=True,live=True)
+        stream=ZipStream()
+        keys=iter(filelist)
+        key=None
+        started=False
+        with ThreadPoolExecutor(max_workers=self.zip_workers) as pool:
+            pending=deque()
+            def prefetch():
+                key=next(keys,None)
+                if key is not None:
+                    pending.append((key,pool.submit(self.object_cache.openObject,bucket_name,key)))
+            try:
+                for _ in range(self.zip_workers*2):
+                    prefetch()
+                with zipfile.ZipFile(stream,'w',allowZip64=True) as zf:
+                    while pending:
+                        key,future=pending.popleft()
+                        prefetch()
+                        obj=future.result()
+                        if obj is None: continue
+                        zinfo=zipfile.ZipInfo(key,date_time=obj['last_modified'].timetuple()[:6])
+                        if Path(key).suffix.lower() in self.stored_extensions:
+                            zinfo.compress_type=zipfile.ZIP_STORED
+                        else:
+                            zinfo.compress_type=zipfile.ZIP_DEFLATED
+                        with obj['file'] as src, zf.open(zinfo,'w',force_zip64=True) as dest:
+                            for chunk in iter(lambda: src.read(self.chunk_size),b''):
+                                dest.write(chunk)
+                                data=stream.pop()
+                                if data:
+                                    started=True
+                                    yield data
+                        data=stream.pop()
+                        if data:
+                            started=True
+                            yield data
+            except Exception as e:
+                if started:
+                    self.auth.app.logger.exception("Zip stream of s3://{}/{} aborted at {} : {}".format(bucket_name,rootdir,key,str(e)))
+                raise
+            finally:
+                ## the client went away or a download failed : close what was prefetched
+                for _,future in pending:
+                    if not future.cancel():
+                        try:
+                            obj=future.result()
+                        except Exception:
+                            continue
+                        if obj is not None:
+                            obj['file'].close()
+        yield stream.pop()
 
     def get_subfolders(self, bucket_name, prefix, delim):
+        if self.listing.covers(bucket_name):
+            try:
+                return self.listing.listFolders(bucket_name, prefix, delim)
+            except Exception as e:
+                self.auth.app.logger.exception("Listing index unavailable : {}".format(str(e)))
         paginator_config = {"MaxKeys": 1000, "Prefix": prefix, "Bucket": bucket_name, "Delimiter": delim}
         paginator = self.aws_s3.get_paginator("list_objects")
         result = paginator.paginate(**paginator_config)
@@ -967,7 +1841,7 @@ class StorageAPI:
                 res.append(folder_name)
         return res
 
-    def getFileList(self,bucket_name,root_path, fltr=None, delimiter = None, only_files = False): #get all pages
+    def getFileList(self,bucket_name,root_path, fltr=None, delimiter = None, only_files = False, live = False): #get all pages
       #alter this to be a lambda function that filters based on the filters and also whether the object is a file or a folder
       def checkList(value, list):
         #can exclude an option if it is only looking for files and finds a folder
@@ -984,6 +1858,21 @@ class StorageAPI:
         return True
       
       if not bucket_name: bucket_name = self.bucket_name
+
+      ## live listings for callers that act on the result , the index can lag writes from other workers
+      if self.listing.covers(bucket_name) and not live:
+        try:
+          if fltr is not None:
+            res=self.listing.searchKeys(bucket_name,root_path,fltr)
+            if delimiter:
+              res=[k for k in res if delimiter not in k[len(root_path):]]
+          else:
+            res=self.listing.listKeys(bucket_name,root_path,delimiter)
+          if only_files:
+            res=[k for k in res if not k.endswith('/')]
+          return res
+        except Exception as e:
+          self.auth.app.logger.exception("Listing index unavailable : {}".format(str(e)))
           
       paginator=self.aws_s3.get_paginator('list_objects')
       operation_parameters = {'Bucket': bucket_name,
@@ -1001,32 +1890,187 @@ class StorageAPI:
               res+=temp
       return res 
 
+    def checkFilesExist(self, bucket_name, keys):
+        ## answers from the metadata cache first , then one listing per crowded folder and concurrent HEADs for the rest
+        res = {}
+        remaining = []
+        for key in set(keys):
+            meta = self.object_cache.getMetadata(bucket_name, key)
+            if meta is not None:
+                res[key] = meta['exists']
+            else:
+                remaining.append(key)
+        folders = {}
+        for key in remaining:
+            folders.setdefault(key[:key.rfind('/') + 1], []).append(key)
+        to_head = []
+        for folder, folder_keys in folders.items():
+            if len(folder_keys) < self.batch_list_min:
+                to_head += folder_keys
+                continue
+            listed = {}
+            paginator = self.aws_s3.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=folder, Delimiter='/'):
+                for obj in page.get('Contents', []):
+                    listed[obj['Key']] = obj
+            for key in folder_keys:
+                obj = listed.get(key)
+                if obj is None:
+                    meta = {'exists': False, 'etag': None, 'size': None, 'last_modified': None}
+                else:
+                    meta = {'exists': True, 'etag': obj['ETag'].strip('"'), 'size': obj['Size'], 'last_modified': obj['LastModified']}
+                self.object_cache.putMetadata(bucket_name, key, meta)
+                res[key] = meta['exists']
+        if len(to_head) > 0:
+            with ThreadPoolExecutor(max_workers=self.transfer_workers) as pool:
+                metas = pool.map(lambda k: self.object_cache.headObject(bucket_name, k, use_cache=False), to_head)
+                for key, meta in zip(to_head, metas):
+                    res[key] = meta['exists']
+        return res
+
+    def listObjects(self, bucket_name, prefix):
+        ## Key, Size, ETag and LastModified of every object under the prefix
+        paginator = self.aws_s3.get_paginator('list_objects_v2')
+        res = []
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            res += page.get('Contents', [])
+        return res
+
     def checkFileExists(self,bucket_name,filename):
       try:
-          object = self.aws_s3.head_object(Bucket=bucket_name, Key=filename)
-          date = object['LastModified']
-          size = object['ContentLength']
-          return 200, True, date, size
+          meta = self.object_cache.headObject(bucket_name, filename)
       except:
           return 404, False, '', ''
+      if not meta['exists']:
+          return 404, False, '', ''
+      return 200, True, meta['last_modified'], meta['size']
     
 ###### utilities
 
-    def getBucketName(self):
-        return self.bucket_name
-    def decodeLink(self,link,u,g):
-      secret=self.auth.app.config['JWT_SECRET_KEY']
-      return jwt.decode(link, secret,algorithms=['HS256'])
-
-
+    def serverPath(self,filename):
+        ## files that only exist on the server , never outside TEMP_DIRECTORY
+        path=Path(filename)
+        if path.is_absolute() or '..' in path.parts:
+            return None
+        return self.tempDirectory.joinpath(path)
 
+    def getCachedObject(self,bucket_name,filename,no_aws_yes_server=True):
+        obj=self.object_cache.getObject(bucket_name,filename)
+        if obj is not None:
+            return obj
+        temp_outpath=self.serverPath(filename)
+        if no_aws_yes_server and temp_outpath is not None and temp_outpath.is_file():
+            st=temp_outpath.stat()
+            return {'path':temp_outpath,
+                    'size':st.st_size,
+                    'etag':None,
+                    'last_modified':datetime.datetime.fromtimestamp(st.st_mtime,tz=datetime.timezone.utc)}
+        return None
 
+    def fileResponse(self,obj,mimetype='application/octet-stream',cache_control=None,redirect=True):
+        ## authorization is done by the endpoint decorators , only the byte copy is handed off ;
+        ## redirect=False keeps the body in the app in x-accel mode , the validators still apply
+        cache_control=cache_control or self.cache_control
+        resp=utils.not_modified(obj['etag'],obj['last_modified'],cache_control)
+        if resp is not None:
+            return resp
+        if self.serve_mode=='x-accel' and redirect and self.isServable(obj['path']):
+            resp=self.xAccelResponse(obj,mimetype)
+        elif self.serve_mode=='sendfile':
+            ## X-Sendfile when USE_X_SENDFILE is set , otherwise the server's wsgi.file_wrapper (sendfile under uwsgi)
+            resp=send_file(str(obj['path']),mimetype=mimetype,conditional=True,
+                           etag=obj['etag'] if obj['etag'] else True,
+                           last_modified=obj['last_modified'])
+        else:
+            resp=self.streamResponse(obj,mimetype)
+        resp.headers['Cache-Control']=cache_control
+        return resp
 
+    def isServable(self,path):
+        ## only resolved paths below TEMP_DIRECTORY are handed to the proxy
+        return self.tempDirectory.resolve() in Path(path).resolve().parents
 
+    def xAccelResponse(self,obj,mimetype):
+        ## the front proxy maps STORAGE_X_ACCEL_PREFIX (internal location) onto TEMP_DIRECTORY and serves ranges itself
+        rel_path=Path(obj['path']).resolve().relative_to(self.tempDirectory.resolve())
+        resp=Response(status=200,mimetype=mimetype)
+        resp.headers['X-Accel-Redirect']=self.x_accel_prefix.rstrip('/')+'/'+quote(rel_path.as_posix())
+        if obj['etag']:
+            resp.headers['ETag']='"{}"'.format(obj['etag'])
+        if obj['last_modified']:
+            resp.headers['Last-Modified']=http_date(obj['last_modified'])
+        return resp
 
+    def streamResponse(self,obj,mimetype='application/octet-stream'):
+        ## streams the local file in chunks , honoring a single Range (and If-Range) request ;
+        ## the file is opened before any header is set , so an eviction can't truncate the body
+        f=obj['file'] if 'file' in obj else open(obj['path'],'rb')
+        size=os.fstat(f.fileno()).st_size
+        etag='"{}"'.format(obj['etag']) if obj['etag'] else None
+        last_modified=obj['last_modified']
+        start,stop=0,size
+        sc=200
+        byte_range=parse_range_header(request.headers.get('Range'))
+        if byte_range is not None and len(byte_range.ranges)==1 and self.checkIfRange(etag,last_modified):
+            rng=byte_range.range_for_length(size)
+            if rng is None:
+                f.close()
+                resp=Response(status=416)
+                resp.headers['Content-Range']='bytes */{}'.format(size)
+                return resp
+            start,stop=rng
+            sc=206
+        resp=Response(self.readFileChunks(f,start,stop),status=sc,mimetype=mimetype,direct_passthrough=True)
+        resp.call_on_close(f.close)
+        resp.headers['Content-Length']=stop-start
+        resp.headers['Accept-Ranges']='bytes'
+        if sc==206:
+            resp.headers['Content-Range']='bytes {}-{}/{}'.format(start,stop-1,size)
+        if etag:
+            resp.headers['ETag']=etag
+        if last_modified:
+            resp.headers['Last-Modified']=http_date(last_modified)
+        return resp
 
+    def checkIfRange(self,etag,last_modified):
+        if_range=request.headers.get('If-Range')
+        if not if_range:
+            return True
+        if if_range.startswith('"') or if_range.startswith('W/'):
+            return etag is not None and if_range==etag
+        date=parse_date(if_range)
+        if date is None or last_modified is None:
+            return False
+        return int(last_modified.timestamp())==int(date.timestamp())
 
+    def readFileChunks(self,f,start,stop):
+        ## f is closed by the response , even when the body is never iterated
+        f.seek(start)
+        remaining=stop-start
+        while remaining>0:
+            chunk=f.read(min(self.chunk_size,remaining))
+            if not chunk: break
+            remaining-=len(chunk)
+            yield chunk
 
+    def getBucketName(self):
+        return self.bucket_name
+    def decodeLink(self,link,u,g):
+      secret=self.auth.app.config['JWT_SECRET_KEY']
+      return jwt.decode(link, secret,algorithms=['HS256'])
 
 
 
+class ZipStream:
+    ## write-only , non seekable sink for zipfile ; the written bytes are drained with pop()
+    def __init__(self):
+        self.chunks=[]
+    def write(self,data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    def flush(self):
+        pass
+    def pop(self):
+        data=b''.join(self.chunks)
+        self.chunks=[]
+        return data
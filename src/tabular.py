@@ -0,0 +1,329 @@
+##################################################################################
+### Module : tabular.py
+### Description : Typed columnar encodings of the CSV files served by storage and genes
+###
+###   CSVs are parsed once per source ETag with pandas (numeric columns are
+###   inferred as int64 / float64 , the rest stay strings) and the encoded result
+###   is kept as a derived file of the object cache.
+###     npy   : numpy structured array (np.save) , one field per column
+###     arrow : Apache Arrow IPC stream , only when pyarrow is installed
+###
+###   Row slicing (offset , limit , columns , where) reads through a line offset
+###   index , also built once per ETag : rows/offsets.npy holds the byte offset of
+###   every line (plus the end of file) of the plain text , which for .gz objects
+###   is a decompressed derived copy (rows/plain.csv) ; both are keyed to the
+###   ETag of the copy that was read. Rows are numbered as lines of the file , so
+###   a header line is row 0. Quoted fields spanning lines are not supported by
+###   the index.
+###
+### Copyrighted reserved by AtlasXomics
+##################################################################################
+
+import io
+import re
+import csv
+import mmap
+import gzip
+import datetime
+import numpy as np
+import pandas as pd
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+FORMATS={'npy':('.npy','application/octet-stream'),
+         'arrow':('.arrow','application/vnd.apache.arrow.stream')}
+
+def supported_formats():
+    return [f for f in FORMATS if f!='arrow' or pa is not None]
+
+def open_text(path,gz=False):
+    if gz:
+        return gzip.open(path,'rt',encoding='utf-8',newline='')
+    return open(path,'r',encoding='utf-8',newline='')
+
+def header_mode(header):
+    ## 'auto' , 'true' or 'false' ; every accepted spelling maps to one of them , so one cache entry each
+    value=str(header).strip().lower()
+    if value in ['auto','']:
+        return 'auto'
+    if value in ['true','1','yes']:
+        return 'true'
+    if value in ['false','0','no']:
+        return 'false'
+    raise ValueError("header must be auto , true or false : {}".format(header))
+
+def has_header(path,gz=False,header='auto'):
+    ## 'auto' sniffs the first lines : a first row of labels over typed columns is a header
+    header=header_mode(header)
+    if header!='auto':
+        return header=='true'
+    with open_text(path,gz) as f:
+        sample=f.read(64*1024)
+    if not sample.strip():
+        return False
+    try:
+        return csv.Sniffer().has_header(sample)
+    except csv.Error:
+        return False
+
+def read_frame(path,gz=False,header='auto'):
+    df=pd.read_csv(path,header=0 if has_header(path,gz,header) else None,
+                   compression='gzip' if gz else None,low_memory=False)
+    df.columns=[str(c) if isinstance(c,str) else 'f{}'.format(c) for c in df.columns]
+    return df
+
+def column_array(series):
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return series.to_numpy()
+    ## strings are stored as fixed width unicode so the file loads without pickle
+    return series.fillna('').astype(str).to_numpy().astype('U')
+
+def encode_npy(df):
+    arrays=[column_array(df[c]) for c in df.columns]
+    records=np.rec.fromarrays(arrays,names=list(df.columns)) if arrays else np.zeros(0)
+    buf=io.BytesIO()
+    np.save(buf,np.asarray(records),allow_pickle=False)
+    return buf.getvalue()
+
+def encode_arrow(df):
+    if pa is None:
+        raise Exception("pyarrow is not installed , use format=npy")
+    table=pa.Table.from_pandas(df,preserve_index=False)
+    sink=pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink,table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def encode_frame(df,fmt):
+    if fmt=='npy':
+        return encode_npy(df)
+    if fmt=='arrow':
+        return encode_arrow(df)
+    raise ValueError("Unsupported columnar format : {}".format(fmt))
+
+def columnar_object(object_cache,bucket_name,key,fmt,header='auto'):
+    """Returns the cached {path , size , etag , last_modified} of the encoded CSV , or None if the object is missing."""
+    if fmt not in supported_formats():
+        raise ValueError("Unsupported columnar format : {}".format(fmt))
+    header=header_mode(header)
+    meta=object_cache.headObject(bucket_name,key)
+    if not meta['exists']:
+        return None
+    ext,_=FORMATS[fmt]
+    name='columnar/header-{}{}'.format(header,ext)
+    etag=meta['etag']
+    path=object_cache.getDerived(bucket_name,key,etag,name)
+    if path is None:
+        with object_cache.lockObject(bucket_name,key,name):
+            path=object_cache.getDerived(bucket_name,key,etag,name)
+            if path is None:
+                obj=object_cache.getObject(bucket_name,key)
+                if obj is None:
+                    ## deleted after the HEAD
+                    return None
+                ## keyed to the version actually read , which may be newer than the HEAD above
+                etag=obj['etag']
+                df=read_frame(obj['path'],key.endswith('.gz'),header)
+                path=object_cache.putDerived(bucket_name,key,etag,name,encode_frame(df,fmt))
+    st=path.stat()
+    return {'path':path,
+            'size':st.st_size,
+            'etag':'{}-{}'.format(etag,name.replace('/','-')),
+            'last_modified':datetime.datetime.fromtimestamp(st.st_mtime,tz=datetime.timezone.utc)}
+
+def build_line_offsets(path,block_size=64*1024*1024):
+    ## the mmap is scanned block by block , so memory follows the number of lines , not the file size
+    size=path.stat().st_size
+    if size==0:
+        return np.zeros(1,dtype=np.int64)
+    parts=[np.zeros(1,dtype=np.int64)]
+    with open(path,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        for start in range(0,size,block_size):
+            block=np.frombuffer(mm,dtype=np.uint8,count=min(block_size,size-start),offset=start)
+            parts.append(np.flatnonzero(block==ord('\n')).astype(np.int64)+start+1)
+            del block
+    offsets=np.concatenate(parts)
+    if offsets[-1]!=size:
+        offsets=np.append(offsets,size)
+    return offsets
+
+def line_index(object_cache,bucket_name,key):
+    """Returns (plain text path , line offsets) for the object , built once per ETag , or None if the object is missing."""
+    if key.endswith('.gz'):
+        meta=object_cache.headObject(bucket_name,key)
+        if not meta['exists']:
+            return None
+        index=cached_line_index(object_cache,bucket_name,key,meta['etag'],None)
+        if index is not None:
+            return index
+        with object_cache.lockObject(bucket_name,key,'rows'):
+            obj=object_cache.getObject(bucket_name,key)
+            if obj is None:
+                return None
+            ## keyed to the version actually read , which may be newer than the HEAD above
+            etag=obj['etag']
+            index=cached_line_index(object_cache,bucket_name,key,etag,None)
+            if index is not None:
+                return index
+            plain_path=object_cache.getDerived(bucket_name,key,etag,'rows/plain.csv')
+            if plain_path is None:
+                ## decompressed straight to the derived file
+                with gzip.open(obj['path'],'rb') as f:
+                    plain_path=object_cache.putDerived(bucket_name,key,etag,'rows/plain.csv',f)
+            return plain_path,store_line_offsets(object_cache,bucket_name,key,etag,plain_path)
+    obj=object_cache.getObject(bucket_name,key)
+    if obj is None:
+        return None
+    index=cached_line_index(object_cache,bucket_name,key,obj['etag'],obj['path'])
+    if index is not None:
+        return index
+    with object_cache.lockObject(bucket_name,key,'rows'):
+        ## another request may have built it while we waited
+        index=cached_line_index(object_cache,bucket_name,key,obj['etag'],obj['path'])
+        if index is not None:
+            return index
+        return obj['path'],store_line_offsets(object_cache,bucket_name,key,obj['etag'],obj['path'])
+
+def cached_line_index(object_cache,bucket_name,key,etag,plain_path):
+    ## plain_path is None for .gz objects , whose plain text is a derived file of the same ETag
+    offsets_path=object_cache.getDerived(bucket_name,key,etag,'rows/offsets.npy')
+    if offsets_path is None:
+        return None
+    if plain_path is None:
+        plain_path=object_cache.getDerived(bucket_name,key,etag,'rows/plain.csv')
+        if plain_path is None:
+            return None
+    return plain_path,np.load(offsets_path,allow_pickle=False)
+
+def store_line_offsets(object_cache,bucket_name,key,etag,plain_path):
+    offsets=build_line_offsets(plain_path)
+    buf=io.BytesIO()
+    np.save(buf,offsets,allow_pickle=False)
+    object_cache.putDerived(bucket_name,key,etag,'rows/offsets.npy',buf.getvalue())
+    return offsets
+
+WHERE_PATTERN=re.compile(r'^\s*([^<>=!]+?)\s*(==|=|!=|<=|>=|<|>)\s*(.*?)\s*$')
+OPERATORS={'=':lambda a,b:a==b,'==':lambda a,b:a==b,'!=':lambda a,b:a!=b,
+           '<':lambda a,b:a<b,'<=':lambda a,b:a<=b,'>':lambda a,b:a>b,'>=':lambda a,b:a>=b}
+
+def as_number(value):
+    try:
+        return float(value)
+    except (TypeError,ValueError):
+        return None
+
+def parse_where(clauses):
+    ## 'column op value' , e.g. '1=1' or 'in_tissue=1' ; numeric when both sides are numbers
+    res=[]
+    for clause in clauses or []:
+        m=WHERE_PATTERN.match(clause)
+        if m is None:
+            raise ValueError("Invalid where clause : {}".format(clause))
+        res.append((m.group(1),m.group(2),m.group(3)))
+    return res
+
+def resolve_column(column,header_row):
+    column=str(column).strip()
+    if re.fullmatch(r'\d+',column):
+        return int(column)
+    if header_row is None or column not in header_row:
+        raise ValueError("Unknown column : {}".format(column))
+    return header_row.index(column)
+
+def make_filter(where,header_row):
+    tests=[]
+    for column,op,value in parse_where(where):
+        idx=resolve_column(column,header_row)
+        number=as_number(value)
+        tests.append((idx,OPERATORS[op],value,number))
+    def accept(row):
+        for idx,fn,value,number in tests:
+            if idx>=len(row):
+                return False
+            cell=row[idx]
+            if number is not None:
+                cell_number=as_number(cell)
+                if cell_number is None or not fn(cell_number,number):
+                    return False
+            elif not fn(cell,value):
+                return False
+        return True
+    return accept
+
+def read_lines(path,offsets,start,stop):
+    ## decoded csv rows of lines [start , stop)
+    with open(path,'rb') as f:
+        f.seek(int(offsets[start]))
+        data=f.read(int(offsets[stop]-offsets[start]))
+    return list(csv.reader(io.StringIO(data.decode('utf-8'),newline='')))
+
+def read_rows(object_cache,bucket_name,key,offset=0,limit=None,columns=None,where=None,batch=4096):
+    """Rows [offset , offset+limit) of the CSV (after the where filter) , restricted to columns."""
+    if offset<0 or (limit is not None and limit<0):
+        raise ValueError("offset and limit must be non-negative")
+    index=line_index(object_cache,bucket_name,key)
+    if index is None:
+        raise Exception("The file doesn't exists")
+    path,offsets=index
+    total=len(offsets)-1
+    header_row=None
+    if any(not re.fullmatch(r'\d+',str(c).strip()) for c in list(columns or [])+[w[0] for w in parse_where(where)]):
+        header_row=read_lines(path,offsets,0,1)[0] if total>0 else []
+    indices=[resolve_column(c,header_row) for c in columns] if columns else None
+    accept=make_filter(where,header_row) if where else None
+    out=[]
+    if accept is None:
+        ## straight seek to the requested lines
+        stop=total if limit is None else min(total,offset+limit)
+        rows=read_lines(path,offsets,offset,stop) if offset<stop else []
+    else:
+        ## offset and limit count matching rows , lines are scanned in batches
+        rows=[]
+        skipped=0
+        ## a header line , when columns are named , is never a match
+        line=1 if header_row is not None else 0
+        while line<total and (limit is None or len(rows)<limit):
+            for row in read_lines(path,offsets,line,min(total,line+batch)):
+                if not accept(row):
+                    continue
+                if skipped<offset:
+                    skipped+=1
+                    continue
+                rows.append(row)
+                if limit is not None and len(rows)>=limit:
+                    break
+            line+=batch
+    for row in rows:
+        out.append([row[i] if i<len(row) else '' for i in indices] if indices is not None else row)
+    return out,total
+
+def slicing_params(args):
+    ## offset , limit , columns (comma separated) and where (repeatable) from query args or a json body
+    def get_list(name):
+        if hasattr(args,'getlist'):
+            values=args.getlist(name)
+        else:
+            values=args.get(name)
+            values=values if isinstance(values,list) else ([values] if values is not None else [])
+        res=[]
+        for v in values:
+            res+=[x for x in str(v).split(',') if x!=''] if name=='columns' else [str(v)]
+        return res
+    def get_count(name):
+        ## a non-negative integer , anything else is the caller's error (400)
+        value=args.get(name)
+        if value is None or value=='':
+            return None
+        if isinstance(value,bool) or not re.fullmatch(r'\d+',str(value).strip()):
+            raise ValueError("{} must be a non-negative integer , got {!r}".format(name,value))
+        return int(str(value).strip())
+    offset=get_count('offset')
+    return {'offset':offset if offset is not None else 0,
+            'limit':get_count('limit'),
+            'columns':get_list('columns') or None,
+            'where':get_list('where') or None}
+
+def has_slicing(params):
+    return params['offset']>0 or params['limit'] is not None or params['columns'] is not None or params['where'] is not None
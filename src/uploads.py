@@ -0,0 +1,311 @@
+##################################################################################
+### Module : uploads.py
+### Description : Streaming uploads to S3
+###
+###   multipart/form-data bodies are decoded incrementally from the request
+###   stream (werkzeug's sans-io decoder) instead of being spooled by
+###   request.files , and file bytes are pushed into an S3 multipart upload as
+###   they arrive. At most `workers` parts are in flight and `workers` more are
+###   buffered , so memory is bounded by (2*workers+1)*part_size.
+###
+###   Upload sessions expose S3 multipart uploads directly to clients : a session
+###   (stored in Mongo) fixes the object size and part size , parts are PUT in
+###   any order and in parallel , and S3's own list of uploaded parts is the
+###   source of truth when an interrupted upload resumes. A part is held in
+###   memory while it is sent (S3 needs its MD5 up front) , so session parts are
+###   capped at STORAGE_UPLOAD_SESSION_MAX_PART_SIZE.
+###
+###   Streamed bodies are hashed (sha256) on the way through so uploads can be
+###   recorded in the content hash index and , in dedup mode , verified against a
+###   client supplied hash before an existing copy is reused.
+###
+### Copyrighted reserved by AtlasXomics
+##################################################################################
+
+import math
+import uuid
+import base64
+import hashlib
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.sansio.multipart import MultipartDecoder, Field, File, Data, Epilogue, NeedData
+from botocore.exceptions import ClientError
+
+MIN_PART_SIZE=5*1024*1024
+MAX_PART_SIZE=5*1024*1024*1024
+MAX_PARTS=10000
+## largest part accepted by upload sessions , parts are buffered in memory
+MAX_SESSION_PART_SIZE=64*1024*1024
+
+def iter_multipart(stream,boundary,chunk_size=1024*1024):
+    """Yields ('field',name,value) , ('file',name,filename) , ('data',bytes) and ('end',None) for each file."""
+    decoder=MultipartDecoder(boundary.encode('latin-1'))
+    field=None
+    value=[]
+    in_file=False
+    done=False
+    while not done:
+        chunk=stream.read(chunk_size)
+        decoder.receive_data(chunk if chunk else None)
+        while True:
+            event=decoder.next_event()
+            if isinstance(event,NeedData):
+                if not chunk:
+                    raise Exception("Incomplete multipart body")
+                break
+            if isinstance(event,Epilogue):
+                done=True
+                break
+            if isinstance(event,File):
+                in_file=True
+                yield ('file',event.name,event.filename)
+            elif isinstance(event,Field):
+                field=event.name
+                value=[]
+            elif isinstance(event,Data):
+                if in_file:
+                    if event.data:
+                        yield ('data',event.data)
+                    if not event.more_data:
+                        in_file=False
+                        yield ('end',None)
+                else:
+                    value.append(event.data)
+                    if not event.more_data:
+                        yield ('field',field,b''.join(value).decode('utf-8'))
+
+class MultipartUploadWriter:
+    """File-like sink that uploads what is written to s3://bucket_name/key.
+    Objects smaller than one part are sent with a single put_object on close()."""
+    def __init__(self,aws_s3,bucket_name,key,part_size=8*1024*1024,workers=4,**put_kwargs):
+        self.aws_s3=aws_s3
+        self.bucket_name=bucket_name
+        self.key=key
+        self.part_size=max(MIN_PART_SIZE,int(part_size))
+        self.workers=workers
+        self.put_kwargs=put_kwargs
+        self.buffer=bytearray()
+        self.upload_id=None
+        self.futures=[]
+        self.size=0
+        self.sha256=hashlib.sha256()
+        self.pool=None
+        self.slots=threading.BoundedSemaphore(2*workers)
+
+    def write(self,data):
+        self.buffer+=data
+        self.size+=len(data)
+        self.sha256.update(data)
+        while len(self.buffer)>=self.part_size:
+            part=bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self.submitPart(part)
+        return len(data)
+
+    def submitPart(self,data):
+        if self.upload_id is None:
+            self.upload_id=self.aws_s3.create_multipart_upload(Bucket=self.bucket_name,Key=self.key,**self.put_kwargs)['UploadId']
+            self.pool=ThreadPoolExecutor(max_workers=self.workers)
+        ## blocks the reader when the uploads fall behind
+        self.slots.acquire()
+        part_number=len(self.futures)+1
+        future=self.pool.submit(self.uploadPart,part_number,data)
+        future.add_done_callback(lambda f:self.slots.release())
+        self.futures.append(future)
+
+    def uploadPart(self,part_number,data):
+        res=self.aws_s3.upload_part(Bucket=self.bucket_name,Key=self.key,UploadId=self.upload_id,
+                                    PartNumber=part_number,Body=data)
+        return {'PartNumber':part_number,'ETag':res['ETag']}
+
+    def close(self):
+        """Completes the upload and returns the object's ETag."""
+        try:
+            if self.upload_id is None:
+                res=self.aws_s3.put_object(Bucket=self.bucket_name,Key=self.key,Body=bytes(self.buffer),**self.put_kwargs)
+                return res['ETag'].strip('"')
+            if self.buffer:
+                self.submitPart(bytes(self.buffer))
+                self.buffer=bytearray()
+            parts=[f.result() for f in self.futures]
+            res=self.aws_s3.complete_multipart_upload(Bucket=self.bucket_name,Key=self.key,UploadId=self.upload_id,
+                                                      MultipartUpload={'Parts':parts})
+            return res['ETag'].strip('"')
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+
+    def abort(self):
+        if self.upload_id is not None:
+            ## parts still uploading would otherwise be stored after the abort
+            self.pool.shutdown(wait=True,cancel_futures=True)
+            self.aws_s3.abort_multipart_upload(Bucket=self.bucket_name,Key=self.key,UploadId=self.upload_id)
+            self.upload_id=None
+
+class HashingSink:
+    """Same interface as MultipartUploadWriter , but the bytes are only hashed and dropped."""
+    def __init__(self):
+        self.size=0
+        self.sha256=hashlib.sha256()
+
+    def write(self,data):
+        self.size+=len(data)
+        self.sha256.update(data)
+        return len(data)
+
+    def close(self):
+        return None
+
+    def abort(self):
+        pass
+
+class UploadSessions:
+    """Resumable upload sessions backed by S3 multipart uploads , state kept in a Mongo table."""
+    def __init__(self,aws_s3,table,part_size=64*1024*1024,max_part_size=MAX_SESSION_PART_SIZE):
+        self.aws_s3=aws_s3
+        self.table=table
+        self.max_part_size=max(MIN_PART_SIZE,min(MAX_PART_SIZE,int(max_part_size)))
+        self.part_size=min(int(part_size),self.max_part_size)
+
+    def sessionPartSize(self,size,part_size=None):
+        part_size=int(part_size or self.part_size)
+        ## S3 allows at most 10000 parts , large objects get larger parts
+        part_size=max(part_size,math.ceil(size/MAX_PARTS))
+        return min(self.max_part_size,max(MIN_PART_SIZE,part_size))
+
+    def create(self,bucket_name,key,size,username,part_size=None):
+        size=int(size)
+        if size<0:
+            raise Exception("Invalid size : {}".format(size))
+        part_size=self.sessionPartSize(size,part_size)
+        if size>part_size*MAX_PARTS:
+            raise Exception("The file is too large : {} bytes".format(size))
+        upload_id=self.aws_s3.create_multipart_upload(Bucket=bucket_name,Key=key)['UploadId']
+        now=datetime.datetime.utcnow().isoformat()
+        session={'_id':str(uuid.uuid4()),
+                 'upload_id':upload_id,
+                 'bucket_name':bucket_name,
+                 'key':key,
+                 'size':size,
+                 'part_size':part_size,
+                 'part_count':max(1,math.ceil(size/part_size)),
+                 'status':'open',
+                 'created_by':username,
+                 'created_at':now,
+                 'updated_at':now,
+                 'parts':{}}
+        self.table.insert_one(session)
+        return self.describe(session)
+
+    def get(self,session_id,status='open'):
+        session=self.table.find_one({'_id':session_id})
+        if session is None:
+            raise Exception("Upload session doesn't exist : {}".format(session_id))
+        if status is not None and session['status']!=status:
+            raise Exception("Upload session is {}".format(session['status']))
+        return session
+
+    def partLength(self,session,part_number):
+        if part_number<1 or part_number>session['part_count']:
+            raise Exception("Part number out of range : {} (1-{})".format(part_number,session['part_count']))
+        if part_number<session['part_count']:
+            return session['part_size']
+        return session['size']-(session['part_count']-1)*session['part_size']
+
+    def putPart(self,session_id,part_number,stream):
+        """Uploads one part read from stream , which must hold exactly the part's bytes."""
+        session=self.get(session_id)
+        length=self.partLength(session,part_number)
+        if length>self.max_part_size:
+            ## sessions created with a larger part size before the cap
+            raise Exception("Part {} is {} bytes , above the {} bytes accepted , start a new upload session".format(part_number,length,self.max_part_size))
+        data,md5=self.readPart(stream,length)
+        if len(data)!=length:
+            raise Exception("Part {} should be {} bytes , got {}".format(part_number,length,len(data)))
+        res=self.aws_s3.upload_part(Bucket=session['bucket_name'],Key=session['key'],UploadId=session['upload_id'],
+                                    PartNumber=part_number,Body=data,
+                                    ContentMD5=base64.b64encode(md5.digest()).decode('ascii'))
+        part={'PartNumber':part_number,'ETag':res['ETag'].strip('"'),'Size':length}
+        ## parts are set field by field so parallel uploads don't overwrite each other
+        self.table.update_one({'_id':session_id},{'$set':{'parts.{}'.format(part_number):part,
+                                                          'updated_at':datetime.datetime.utcnow().isoformat()}})
+        return part
+
+    def readPart(self,stream,length,chunk_size=1024*1024):
+        ## reads at most length+1 bytes , the extra byte tells a too long body apart
+        data=bytearray()
+        md5=hashlib.md5()
+        while len(data)<=length:
+            chunk=stream.read(min(chunk_size,length+1-len(data)))
+            if not chunk:
+                break
+            data+=chunk
+            md5.update(chunk)
+        return bytes(data),md5
+
+    def uploadedParts(self,session):
+        ## S3 is the source of truth , a part may be stored although the request recording it failed
+        parts={}
+        kwargs={'Bucket':session['bucket_name'],'Key':session['key'],'UploadId':session['upload_id']}
+        while True:
+            res=self.aws_s3.list_parts(**kwargs)
+            for p in res.get('Parts',[]):
+                parts[p['PartNumber']]={'PartNumber':p['PartNumber'],'ETag':p['ETag'].strip('"'),'Size':p['Size']}
+            if not res.get('IsTruncated'):
+                break
+            kwargs['PartNumberMarker']=res['NextPartNumberMarker']
+        return parts
+
+    def validParts(self,session,parts):
+        ## a part of the wrong length (e.g. an older part size) is uploaded again ; S3 would also
+        ## refuse to complete with a part below MIN_PART_SIZE that isn't the last one (EntityTooSmall)
+        return {n:p for n,p in parts.items() if n<=session['part_count'] and p['Size']==self.partLength(session,n)}
+
+    def listParts(self,session_id):
+        session=self.get(session_id,status=None)
+        if session['status']=='open':
+            parts=self.validParts(session,self.uploadedParts(session))
+            session['parts']={str(n):p for n,p in parts.items()}
+            self.table.update_one({'_id':session_id},{'$set':{'parts':session['parts']}})
+        return self.describe(session)
+
+    def complete(self,session_id):
+        session=self.get(session_id)
+        parts=self.validParts(session,self.uploadedParts(session))
+        missing=[n for n in range(1,session['part_count']+1) if n not in parts]
+        if missing:
+            ## checked before CompleteMultipartUpload , the client uploads these again and retries
+            raise ValueError("Missing or wrong sized parts : {}".format(missing[:100]))
+        res=self.aws_s3.complete_multipart_upload(Bucket=session['bucket_name'],Key=session['key'],UploadId=session['upload_id'],
+                                                  MultipartUpload={'Parts':[{'PartNumber':n,'ETag':'"{}"'.format(parts[n]['ETag'])}
+                                                                            for n in range(1,session['part_count']+1)]})
+        session['status']='completed'
+        session['etag']=res['ETag'].strip('"')
+        self.table.update_one({'_id':session_id},{'$set':{'status':'completed','etag':session['etag'],
+                                                          'updated_at':datetime.datetime.utcnow().isoformat()}})
+        return self.describe(session)
+
+    def abort(self,session_id):
+        session=self.get(session_id)
+        try:
+            self.aws_s3.abort_multipart_upload(Bucket=session['bucket_name'],Key=session['key'],UploadId=session['upload_id'])
+        except ClientError as e:
+            ## already aborted (or expired) on the S3 side
+            if e.response.get('Error',{}).get('Code')!='NoSuchUpload':
+                raise
+        session['status']='aborted'
+        self.table.update_one({'_id':session_id},{'$set':{'status':'aborted',
+                                                          'updated_at':datetime.datetime.utcnow().isoformat()}})
+        return self.describe(session)
+
+    def describe(self,session):
+        res={k:v for k,v in session.items() if k not in ['_id','upload_id','parts']}
+        res['session_id']=session['_id']
+        res['parts']=sorted(session.get('parts',{}).values(),key=lambda p:p['PartNumber'])
+        done=set(p['PartNumber'] for p in res['parts'])
+        res['missing_parts']=[n for n in range(1,session['part_count']+1) if n not in done] if session['status']=='open' else []
+        return res
@@ -10,7 +10,8 @@
 
 
 import json
-from flask import request 
+import itertools
+from flask import request, Response
 from flask_jwt_extended import current_user
 
 import hmac
@@ -100,6 +101,121 @@ def datetime_handler(x):
         return x.isoformat()
     raise TypeError("Unknown type")
 
+## streaming json
+## the payload is encoded a batch of items at a time , so memory stays bounded by the batch
+## and the first bytes leave before the source (sql cursor , mongo cursor , csv reader) is exhausted
+
+def close_iterator(it):
+    ## releases what a generator holds (cursors , connections) when the response stops early
+    close=getattr(it,'close',None)
+    if close is not None:
+        close()
+
+def stream_json_list(items,default=None,batch_size=500):
+    it=iter(items)
+    try:
+        opening='['
+        while True:
+            batch=list(itertools.islice(it,batch_size))
+            if not batch: break
+            yield opening+','.join(json.dumps(x,default=default) for x in batch)
+            opening=','
+        yield ']' if opening==',' else '[]'
+    finally:
+        close_iterator(it)
+
+def json_key(k):
+    ## dict keys the way json.dumps writes them : None -> "null" , True -> "true" , numbers as text
+    if isinstance(k,str):
+        return k
+    if k is None:
+        return 'null'
+    if k is True:
+        return 'true'
+    if k is False:
+        return 'false'
+    if isinstance(k,float):
+        return json.dumps(k)
+    if isinstance(k,int):
+        return int.__repr__(k)
+    raise TypeError("keys must be str, int, float, bool or None, not {}".format(type(k).__name__))
+
+def stream_json_dict(pairs,default=None):
+    ## pairs : iterable of (key , value) ; iterator values (generators , cursors) are streamed as lists
+    pairs=iter(pairs)
+    try:
+        opening='{'
+        for k,v in pairs:
+            prefix=opening+json.dumps(json_key(k))+':'
+            if hasattr(v,'__next__'):
+                for chunk in stream_json_list(v,default=default):
+                    yield prefix+chunk
+                    prefix=''
+            else:
+                yield prefix+json.dumps(v,default=default)
+            opening=','
+        yield '}' if opening==',' else '{}'
+    finally:
+        close_iterator(pairs)
+
+def json_stream_response(chunks,status=200):
+    ## the first chunk is produced here , so errors from running the query still reach the caller's except
+    chunks=iter(chunks)
+    head=[next(chunks,'')]
+    resp=Response(itertools.chain(head,chunks),status=status)
+    resp.call_on_close(lambda: close_iterator(chunks))
+    resp.headers['Content-Type']='application/json'
+    return resp
+
+## conditional requests
+## ETag / Last-Modified validators , answered with 304 when the client already holds the version
+
+def not_modified(etag=None,last_modified=None,cache_control=None):
+    ## returns the 304 response when the request's validators match , None otherwise
+    if request.if_none_match:
+        matched=etag is not None and request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        matched=int(last_modified.timestamp())<=int(request.if_modified_since.timestamp())
+    else:
+        matched=False
+    if not matched:
+        return None
+    resp=Response(status=304)
+    set_validators(resp,etag,last_modified,cache_control)
+    return resp
+
+def set_validators(resp,etag=None,last_modified=None,cache_control=None,weak=False):
+    if etag is not None:
+        resp.set_etag(etag,weak=weak)
+    if last_modified is not None:
+        resp.last_modified=last_modified
+    if cache_control:
+        resp.headers['Cache-Control']=cache_control
+    return resp
+
+## data versions , counters bumped by every API write to a data source and kept in the
+## application_data table so all workers see them
+
+DATA_VERSIONS_ID='data_versions'
+
+def data_version(table,name):
+    doc=table.find_one({'id':DATA_VERSIONS_ID},{name:1})
+    return (doc or {}).get(name,0)
+
+def bump_data_version(table,name):
+    table.update_one({'id':DATA_VERSIONS_ID},{'$inc':{name:1}},upsert=True)
+
+def versioned_response(make_chunks,validators,cache_control=None,status=200):
+    ## weak ETag from cheap validators (data version , row count , the caller's scope) ;
+    ## the query only runs when the client's copy is stale and the body is streamed , never hashed
+    etag=hashlib.sha1(json.dumps(validators,default=str,sort_keys=True).encode('utf-8')).hexdigest()
+    resp=not_modified(etag,cache_control=cache_control)
+    if resp is not None:
+        resp.set_etag(etag,weak=True)
+        return resp
+    resp=json_stream_response(make_chunks(),status)
+    return set_validators(resp,etag,cache_control=cache_control,weak=True)
+
 ## uuid and datetime
 def get_uuid():
     return str(uuid.uuid4())
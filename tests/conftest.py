@@ -38,6 +38,11 @@ def testing_storage_api(testing_app):
     storage = testing_app.config["SUBMODULES"]["StorageAPI"]
     return storage
 
+@pytest.fixture()
+def testing_object_cache(testing_app):
+    cache = testing_app.config["SUBMODULES"]["ObjectCache"]
+    return cache
+
 @pytest.fixture()
 def run_db_api(testing_app):
     rundb = testing_app.config["SUBMODULES"]["RelationalDatabaseAPI"]
@@ -0,0 +1,198 @@
+import datetime
+import time
+import threading
+from unittest.mock import patch
+import pytest
+
+def fake_download(content):
+    def _download(bucket, key, f):
+        f.write(content)
+    return _download
+
+def fake_head(etag, size):
+    return {'exists': True, 'etag': etag, 'size': size, 'last_modified': datetime.datetime(2023, 1, 1)}
+
+def test_init_object_cache(testing_object_cache):
+    assert testing_object_cache is not None
+    assert testing_object_cache.max_bytes > 0
+
+def test_cache_hit_and_etag_refresh(testing_object_cache):
+    key = 'tests/object_cache/hit.txt'
+    testing_object_cache.invalidate('bucket1', key)
+    with patch.object(testing_object_cache, 'headObject', return_value=fake_head('etag1', 5)), \
+         patch.object(testing_object_cache.aws_s3, 'download_fileobj', side_effect=fake_download(b'first')) as mock_download:
+        first = testing_object_cache.getObject('bucket1', key)
+        second = testing_object_cache.getObject('bucket1', key)
+        assert mock_download.call_count == 1
+        assert first['path'] == second['path']
+        assert open(second['path'], 'rb').read() == b'first'
+
+    with patch.object(testing_object_cache, 'headObject', return_value=fake_head('etag2', 6)), \
+         patch.object(testing_object_cache.aws_s3, 'download_fileobj', side_effect=fake_download(b'second')) as mock_download:
+        third = testing_object_cache.getObject('bucket1', key)
+        assert mock_download.call_count == 1
+        assert third['etag'] == 'etag2'
+        assert open(third['path'], 'rb').read() == b'second'
+
+def test_truncated_download_not_cached(testing_object_cache):
+    key = 'tests/object_cache/truncated.txt'
+    testing_object_cache.invalidate('bucket1', key)
+    with patch.object(testing_object_cache, 'headObject', return_value=fake_head('etag1', 10)), \
+         patch.object(testing_object_cache.aws_s3, 'download_fileobj', side_effect=fake_download(b'01234')):
+        with pytest.raises(Exception):
+            testing_object_cache.getObject('bucket1', key)
+    path = testing_object_cache.getLocalPath('bucket1', key)
+    assert not path.exists() and testing_object_cache.getEntry(path) is None
+
+def test_cache_missing_object(testing_object_cache):
+    missing = {'exists': False, 'etag': None, 'size': None, 'last_modified': None}
+    with patch.object(testing_object_cache, 'headObject', return_value=missing):
+        assert testing_object_cache.getObject('bucket1', 'tests/object_cache/missing.txt') is None
+
+def test_cache_eviction(testing_object_cache):
+    keys = ['tests/object_cache/evict_{}.bin'.format(i) for i in range(3)]
+    for k in keys:
+        testing_object_cache.invalidate('bucket1', k)
+    before = testing_object_cache.getStats()
+    with patch.object(testing_object_cache, 'headObject', return_value=fake_head('etag', 10)), \
+         patch.object(testing_object_cache.aws_s3, 'download_fileobj', side_effect=fake_download(b'0123456789')), \
+         patch.object(testing_object_cache, 'max_bytes', 20):
+        paths = [testing_object_cache.getObject('bucket1', k)['path'] for k in keys]
+    after = testing_object_cache.getStats()
+    assert not paths[0].exists()
+    assert paths[2].exists()
+    assert after['evictions'] >= before['evictions'] + 1
+
+def test_lock_files_removed_with_entries(testing_object_cache):
+    key = 'tests/object_cache/locked.txt'
+    testing_object_cache.invalidate('bucket1', key)
+    with patch.object(testing_object_cache, 'headObject', return_value=fake_head('etag1', 5)), \
+         patch.object(testing_object_cache.aws_s3, 'download_fileobj', side_effect=fake_download(b'first')):
+        testing_object_cache.getObject('bucket1', key)
+    with testing_object_cache.lockObject('bucket1', key, 'rows'):
+        pass
+    lock_path = testing_object_cache.lockPath('bucket1', key)
+    assert lock_path.exists() and testing_object_cache.lockPath('bucket1', key, 'rows').exists()
+    ## a held lock is left alone
+    with testing_object_cache.lockObject('bucket1', key):
+        testing_object_cache.removeLocks('bucket1', key)
+        assert lock_path.exists()
+    testing_object_cache.invalidate('bucket1', key)
+    assert list(testing_object_cache.lockDirectory.glob(lock_path.stem.split('.')[0] + '*')) == []
+
+def test_cache_key_outside_root(testing_object_cache):
+    for key in ['/../../etc/passwd', '../', 'a/../../b']:
+        with pytest.raises(ValueError):
+            testing_object_cache.getLocalPath('bucket1', key)
+    with pytest.raises(ValueError):
+        testing_object_cache.derivedPath('bucket1', 'a/b', 'etag1', '../../a/b')
+
+@pytest.mark.parametrize('key', ['a//b', 'a/./b', '/a/b', 'a/b/'])
+def test_cache_key_never_shares_a_path(testing_object_cache, key):
+    ## distinct S3 keys , normalizing them would download into the same file as 'a/b'
+    assert testing_object_cache.getLocalPath('bucket1', 'a/b').parts[-2:] == ('a', 'b')
+    with pytest.raises(ValueError):
+        testing_object_cache.getLocalPath('bucket1', key)
+    testing_object_cache.invalidate('bucket1', key)
+
+def test_cache_path_per_bucket(testing_object_cache):
+    key = 'tests/object_cache/shared.txt'
+    assert testing_object_cache.getLocalPath('bucket1', key) != testing_object_cache.getLocalPath('bucket2', key)
+    with pytest.raises(Exception):
+        testing_object_cache.getLocalPath('../bucket1', key)
+
+def test_head_object_caches_only_missing(testing_object_cache):
+    from botocore.exceptions import ClientError
+    key = 'tests/object_cache/head.txt'
+    testing_object_cache.invalidate('bucket1', key)
+    denied = ClientError({'Error': {'Code': '403', 'Message': 'Forbidden'}}, 'HeadObject')
+    with patch.object(testing_object_cache.aws_s3, 'head_object', side_effect=denied):
+        with pytest.raises(ClientError):
+            testing_object_cache.headObject('bucket1', key)
+    assert testing_object_cache.getMetadata('bucket1', key) is None
+    missing = ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, 'HeadObject')
+    with patch.object(testing_object_cache.aws_s3, 'head_object', side_effect=missing):
+        assert not testing_object_cache.headObject('bucket1', key)['exists']
+    assert testing_object_cache.getMetadata('bucket1', key)['exists'] is False
+    testing_object_cache.invalidate('bucket1', key)
+
+def test_manifest_outside_served_tree(testing_object_cache):
+    cache = testing_object_cache
+    assert cache.tempDirectory not in cache.manifest_path.parents
+    assert cache.tempDirectory not in cache.lockDirectory.parents
+    with cache._connect() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+def test_hits_are_batched(testing_object_cache):
+    key = 'tests/object_cache/batched.txt'
+    cache = testing_object_cache
+    cache.invalidate('bucket1', key)
+    with patch.object(cache, 'headObject', return_value=fake_head('etag1', 5)), \
+         patch.object(cache.aws_s3, 'download_fileobj', side_effect=fake_download(b'first')), \
+         patch.object(cache, 'flush_seconds', 3600):
+        path = cache.getObject('bucket1', key)['path']
+        cache.flush()
+        for _ in range(3):
+            cache.getObject('bucket1', key)
+        ## nothing written until the next flush
+        assert cache.getEntry(path)['hits'] == 0
+        cache.flush()
+        assert cache.getEntry(path)['hits'] == 3
+
+def test_metadata_cache_skips_head(testing_object_cache):
+    key = 'tests/object_cache/meta.txt'
+    testing_object_cache.invalidate('bucket1', key)
+    head = {'ETag': '"etag1"', 'ContentLength': 3, 'LastModified': datetime.datetime(2023, 1, 1)}
+    with patch.object(testing_object_cache.aws_s3, 'head_object', return_value=head) as mock_head:
+        first = testing_object_cache.headObject('bucket1', key)
+        second = testing_object_cache.headObject('bucket1', key)
+        assert mock_head.call_count == 1
+        assert first == second
+        assert second['etag'] == 'etag1'
+        testing_object_cache.invalidate('bucket1', key)
+        testing_object_cache.headObject('bucket1', key)
+        assert mock_head.call_count == 2
+
+def test_single_flight_download(testing_object_cache):
+    key = 'tests/object_cache/single_flight.bin'
+    testing_object_cache.invalidate('bucket1', key)
+    def slow_download(bucket, k, f):
+        time.sleep(0.2)
+        f.write(b'payload')
+    results = []
+    with patch.object(testing_object_cache, 'headObject', return_value=fake_head('etag1', 7)), \
+         patch.object(testing_object_cache.aws_s3, 'download_fileobj', side_effect=slow_download) as mock_download:
+        threads = [threading.Thread(target=lambda: results.append(testing_object_cache.getObject('bucket1', key))) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert mock_download.call_count == 1
+    assert len(results) == 4
+    assert all(open(r['path'], 'rb').read() == b'payload' for r in results)
+    assert list(results[0]['path'].parent.glob('.single_flight.bin.*.part')) == []
+
+def test_derived_files(testing_object_cache):
+    key = 'tests/object_cache/derived.png'
+    testing_object_cache.invalidate('bucket1', key)
+    assert testing_object_cache.getDerived('bucket1', key, 'etag1', 'tiles/0/0_0.jpg') is None
+    paths = testing_object_cache.putDerivedFiles('bucket1', key, 'etag1', [('tiles/0/0_0.jpg', b'a'), ('tiles/info.json', b'{}')])
+    assert testing_object_cache.getDerived('bucket1', key, 'etag1', 'tiles/0/0_0.jpg') == paths[0]
+    assert testing_object_cache.getDerived('bucket1', key, 'etag2', 'tiles/0/0_0.jpg') is None
+    testing_object_cache.invalidate('bucket1', key)
+    assert not paths[1].exists()
+    assert testing_object_cache.getDerived('bucket1', key, 'etag1', 'tiles/info.json') is None
+
+def test_derived_files_keep_dirs(testing_object_cache):
+    cache = testing_object_cache
+    key = 'tests/object_cache/pyramid.png'
+    cache.invalidate('bucket1', key)
+    tiles_dir = cache.derivedPath('bucket1', key, 'etag1', 'tiles')
+    with patch.object(cache, 'max_bytes', 0):
+        first = cache.putDerivedFiles('bucket1', key, 'etag1', [('tiles/1/0_0.jpg', b'aaaa')], keep_dirs=[tiles_dir])
+        cache.putDerivedFiles('bucket1', key, 'etag1', [('tiles/0/0_0.jpg', b'bb')], keep_dirs=[tiles_dir])
+        ## without the protection the previous level goes
+        assert first[0].exists()
+        cache.putDerived('bucket1', key, 'etag1', 'other.jpg', b'c')
+        assert not first[0].exists()
+    cache.invalidate('bucket1', key)
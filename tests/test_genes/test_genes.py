@@ -12,4 +12,14 @@ def test_get_spatialData_gz(mock_getFileObject, file_path,testing_gene_api):
     assert res == [ ['C1', '10', '10', '20', '20', '30', '30'],
     ['C2', '11', '14', '20', '25', '31', '30'],
     ['C1', '12', '15', '20', '25', '32', '34'],
-    ['C3', '13', '15', '20', '26', '33', '30'],]
\ No newline at end of file
+    ['C3', '13', '15', '20', '26', '33', '30'],]
+def test_columnar_response_uses_storage_file_response(testing_app, testing_gene_api, testing_storage_api, tmp_path):
+    path = tmp_path / 'columnar.npy'
+    path.write_bytes(b'0123456789')
+    obj = {'path': path, 'size': 10, 'etag': 'etag1-columnar', 'last_modified': None}
+    with testing_app.test_request_context('/api/v1/genes/spatial', headers={'Range': 'bytes=2-5'}), \
+         patch.object(testing_storage_api, 'fileResponse', wraps=testing_storage_api.fileResponse) as mock_response:
+        resp = testing_gene_api.spatialDataResponse(obj)
+        assert mock_response.call_args.kwargs['mimetype'] == 'application/octet-stream'
+        assert resp.status_code == 206 and resp.headers['Cache-Control'] == testing_storage_api.cache_control
+        resp.close()
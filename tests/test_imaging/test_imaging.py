@@ -0,0 +1,85 @@
+import cv2
+import numpy as np
+from src import imaging
+import pytest
+
+def gradient(height, width):
+    y, x = np.mgrid[0:height, 0:width]
+    return np.dstack([x % 255, y % 255, (x + y) % 255]).astype(np.uint8)
+
+@pytest.mark.parametrize('degree,code', [(90, cv2.ROTATE_90_COUNTERCLOCKWISE), (180, cv2.ROTATE_180),
+                                          (270, cv2.ROTATE_90_CLOCKWISE), (-90, cv2.ROTATE_90_CLOCKWISE)])
+def test_right_angle_rotation_is_lossless(degree, code):
+    img = gradient(30, 50)
+    assert np.array_equal(imaging.rotate_no_cropping(img, degree), cv2.rotate(img, code))
+
+def test_channel_extracted_before_rotation():
+    img = gradient(30, 50)
+    out = imaging.apply_ops(img, [('channel', 0), ('rotate', 90), ('crop', 0, 10, 0, 20)])
+    assert out.shape == (20, 10)
+    assert np.array_equal(out, cv2.rotate(img[:, :, 0], cv2.ROTATE_90_COUNTERCLOCKWISE)[0:20, 0:10])
+
+def test_reduction_factor():
+    assert imaging.reduction_factor(1600, 1000, [('rotate', 90), ('resize', 300, 300)]) == 4
+    assert imaging.reduction_factor(1600, 1000, [('resize', 1600, 1600)]) == 1
+    assert imaging.reduction_factor(1600, 1000, [('rotate', 45), ('resize', 100, 100)]) == 1
+    assert imaging.reduction_factor(1600, 1000, [('crop', 0, 5, 0, 5), ('resize', 10, 10)]) == 1
+
+def test_reduced_jpeg_decode(tmp_path):
+    path = tmp_path / 'hires.jpg'
+    cv2.imwrite(str(path), gradient(1000, 1600))
+    ops = [('resize', 300, 300)]
+    img = imaging.read_image(path, ops)
+    assert img.shape == (250, 400, 3)
+    assert imaging.apply_ops(img, ops).shape == (188, 300, 3)
+
+def test_render_tile_matches_pyramid():
+    img = gradient(70, 100)
+    levels = dict(imaging.build_pyramid(img, 32))
+    for level in [imaging.top_level(100, 70), 3, 0]:
+        for col, row, tile in levels[level]:
+            assert imaging.render_tile(img, level, col, row, 32).shape == tile.shape
+    top = imaging.top_level(100, 70)
+    assert np.array_equal(imaging.render_tile(img, top, 1, 2, 32), img[64:70, 32:64])
+
+def test_assemble_crop_from_pyramid():
+    img = gradient(70, 100)
+    levels = dict(imaging.build_pyramid(img, 32))
+    top = imaging.top_level(100, 70)
+    tiles = {(c, r): t for c, r, t in levels[top]}
+    crop = imaging.assemble_crop(lambda c, r: tiles[(c, r)], 100, 70, 32, 10, 75, 5, 60)
+    assert np.array_equal(crop, img[5:60, 10:75])
+
+def test_negotiate_format():
+    assert imaging.negotiate_format(None, None, 'png') == ('png', '.png', 'image/png')
+    assert imaging.negotiate_format('jpeg', None) == ('jpg', '.jpg', 'image/jpeg')
+    assert imaging.negotiate_format('auto', 'text/html,image/webp,*/*')[0] in ('webp', 'avif')
+    assert imaging.negotiate_format('auto', 'image/png,*/*') == ('jpg', '.jpg', 'image/jpeg')
+    with pytest.raises(ValueError):
+        imaging.negotiate_format('bmp', None)
+
+def test_snap_value():
+    assert imaging.snap_value(None, (256, 512), 'max_width') is None
+    assert imaging.snap_value(300, (256, 512), 'max_width') == 512
+    assert imaging.snap_value(5000, (256, 512), 'max_width') == 512
+    assert imaging.snap_value(256, (256, 512), 'max_width', strict=True) == 256
+    with pytest.raises(ValueError):
+        imaging.snap_value(300, (256, 512), 'max_width', strict=True)
+
+def test_encode_quality():
+    img = gradient(200, 200)
+    assert len(imaging.encode_image(img, '.jpg', 30)) < len(imaging.encode_image(img, '.jpg', 95))
+    assert imaging.decode_image(imaging.encode_image(img, '.webp', 50)).shape == img.shape
+
+def test_build_thumbnails():
+    data = imaging.encode_image(gradient(300, 600), '.png')
+    thumbs = imaging.build_thumbnails(data, sizes=(100, 400), formats=('png',))
+    assert [(size, fmt) for size, fmt, _ in thumbs] == [(100, 'png'), (400, 'png')]
+    assert imaging.decode_image(thumbs[0][2]).shape == (50, 100, 3)
+    assert imaging.decode_image(thumbs[1][2]).shape == (200, 400, 3)
+    ## never upscaled
+    small = imaging.build_thumbnails(imaging.encode_image(gradient(30, 60), '.png'), sizes=(400,), formats=('png',))
+    assert imaging.decode_image(small[0][2]).shape == (30, 60, 3)
+    name = imaging.thumbnail_name('frontPage_R1', 100, 'png', thumbs[0][2])
+    assert name.startswith('frontPage_R1.100.') and name.endswith('.png')
+    assert name != imaging.thumbnail_name('frontPage_R1', 100, 'png', thumbs[1][2])
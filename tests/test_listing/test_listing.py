@@ -0,0 +1,95 @@
+import datetime
+from unittest.mock import patch
+from src.listing import BucketIndex, ContentHashIndex
+
+def make_objects(keys):
+    return [{'Key': k, 'Size': len(k), 'ETag': '"{}"'.format(k), 'LastModified': datetime.datetime(2023, 1, 1)} for k in sorted(keys)]
+
+KEYS = ['data/D1/a.csv', 'data/D1/spatial/b.png', 'data/D2/c.csv', 'data/top.txt', 'other/x.csv']
+
+def test_bucket_index_span():
+    index = BucketIndex()
+    index.replace('', make_objects(KEYS))
+    start, stop = index.span('data/D1/')
+    assert index.keys[start:stop] == ['data/D1/a.csv', 'data/D1/spatial/b.png']
+    index.replace('data/D1/', make_objects(['data/D1/new.csv']))
+    assert index.keys == sorted(['data/D1/new.csv', 'data/D2/c.csv', 'data/top.txt', 'other/x.csv'])
+    index.remove('data/top.txt')
+    assert 'data/top.txt' not in index.keys
+    assert len(index.keys) == len(index.sizes) == len(index.etags) == len(index.mtimes)
+
+def test_listing_queries(testing_storage_api):
+    listing = testing_storage_api.listing
+    bucket = 'listing-test-bucket'
+    listing.buckets.pop(bucket, None)
+    listing.loaded.pop(bucket, None)
+    with patch.object(listing, 'listAll', return_value=make_objects(KEYS)):
+        assert listing.listKeys(bucket, '') == sorted(KEYS)
+        assert listing.listKeys(bucket, 'data/') == ['data/D1/a.csv', 'data/D1/spatial/b.png', 'data/D2/c.csv', 'data/top.txt']
+        assert listing.listKeys(bucket, 'data/', '/') == ['data/top.txt']
+        assert listing.listFolders(bucket, 'data/', '/') == ['D1', 'D2']
+        assert listing.searchKeys(bucket, 'data/', ['.CSV']) == ['data/D1/a.csv', 'data/D2/c.csv']
+
+def test_listing_loads_by_prefix(testing_storage_api):
+    listing = testing_storage_api.listing
+    bucket = 'listing-test-bucket'
+    listing.buckets.pop(bucket, None)
+    listing.loaded.pop(bucket, None)
+    def list_all(bucket_name, prefix):
+        return make_objects([k for k in KEYS if k.startswith(prefix)])
+    with patch.object(listing, 'listAll', side_effect=list_all) as list_all_mock:
+        assert listing.listKeys(bucket, 'data/D1/') == ['data/D1/a.csv', 'data/D1/spatial/b.png']
+        assert listing.listKeys(bucket, 'data/D1/spatial/') == ['data/D1/spatial/b.png']
+        assert [c.args[1] for c in list_all_mock.call_args_list] == ['data/D1/']
+        ## our own writes are visible without a listing , keys outside the listed prefixes aren't indexed
+        listing.put(bucket, 'data/D1/new.csv', 3, 'etag')
+        listing.put(bucket, 'other/y.csv', 3, 'etag')
+        assert listing.listKeys(bucket, 'data/D1/', '/') == ['data/D1/a.csv', 'data/D1/new.csv']
+        assert list_all_mock.call_count == 1
+        assert 'other/y.csv' not in listing.buckets[bucket].keys
+        ## a prefix invalidated by our own write is re-listed before answering
+        listing.invalidate(bucket, 'data/D1/a.csv')
+        assert listing.listKeys(bucket, 'data/D1/') == ['data/D1/a.csv', 'data/D1/spatial/b.png']
+        assert [c.args[1] for c in list_all_mock.call_args_list] == ['data/D1/', 'data/D1/']
+
+def test_listing_refreshes_stale_prefix_in_background(testing_storage_api):
+    listing = testing_storage_api.listing
+    bucket = 'listing-test-bucket'
+    listing.buckets.pop(bucket, None)
+    listing.loaded.pop(bucket, None)
+    listed = [KEYS]
+    with patch.object(listing, 'listAll', side_effect=lambda b, p: make_objects(k for k in listed[0] if k.startswith(p))) as list_all_mock, \
+         patch('src.listing.threading.Thread') as thread_mock:
+        assert listing.listKeys(bucket, 'data/D2/') == ['data/D2/c.csv']
+        listed[0] = KEYS + ['data/D2/d.csv']
+        listing.loaded[bucket]['data/D2/'] -= listing.refresh_seconds + 1
+        ## the stale snapshot is served while the re-listing runs , and only one is started
+        assert listing.listKeys(bucket, 'data/D2/') == ['data/D2/c.csv']
+        assert listing.listKeys(bucket, 'data/D2/') == ['data/D2/c.csv']
+        assert list_all_mock.call_count == 1 and thread_mock.call_count == 1
+        thread_mock.call_args.kwargs['target']()
+        assert listing.listKeys(bucket, 'data/D2/') == ['data/D2/c.csv', 'data/D2/d.csv']
+        assert list_all_mock.call_count == 2 and not listing.refreshing
+
+class FakeHashTable:
+    def __init__(self):
+        self.docs = {}
+    def create_index(self, keys):
+        pass
+    def replace_one(self, query, doc, upsert=False):
+        self.docs[query['_id']] = doc
+    def find(self, query):
+        return [d for d in self.docs.values() if all(d[k] == v for k, v in query.items())]
+    def delete_one(self, query):
+        self.docs.pop(query['_id'], None)
+
+def test_content_hash_index():
+    index = ContentHashIndex(FakeHashTable())
+    index.record('bucket1', 'run1/Summary.csv', 'abc', 10, 'etag1')
+    index.record('bucket2', 'run2/Summary.csv', 'abc', 10, 'etag2')
+    assert index.lookup('abc', 11, lambda e: True) is None
+    assert index.lookup('abc', 10, lambda e: True, 'bucket2')['key'] == 'run2/Summary.csv'
+    ## stale entries (object overwritten or deleted) are dropped
+    assert index.lookup('abc', 10, lambda e: e['etag'] == 'etag2', 'bucket1')['bucket_name'] == 'bucket2'
+    assert index.lookup('abc', 10, lambda e: e['etag'] == 'etag2', 'bucket1')['bucket_name'] == 'bucket2'
+    assert list(index.table.docs) == ['bucket2/run2/Summary.csv']
@@ -0,0 +1,67 @@
+from unittest.mock import patch, MagicMock
+import pytest
+
+ENTRY = {'id': 'D83', 'files': {'bucket': 'bucket1', 'root': 'data',
+         'meta': {'metadata': 'D83/out/Gene/raw/spatial/metadata.json'},
+         'data': {'genes': 'D83/out/Gene/raw/genes.tsv',
+                  'matrix': 'D83/out/Gene/raw/matrix.mtx',
+                  'tissue_positions_list': 'D83/out/Gene/raw/spatial/tissue_positions_list.csv'},
+         'images': {'qc-1': 'D83/out/Gene/raw/figure/qc-1.png',
+                    'tissue_hires_image': 'D83/out/Gene/raw/spatial/tissue_hires_image.png'}}}
+
+SIZES = {'data/D83/out/Gene/raw/spatial/metadata.json': 10,
+         'data/D83/out/Gene/raw/genes.tsv': 100,
+         'data/D83/out/Gene/raw/matrix.mtx': 5000,
+         'data/D83/out/Gene/raw/spatial/tissue_positions_list.csv': 200,
+         'data/D83/out/Gene/raw/spatial/tissue_hires_image.png': 500}
+
+class InlinePool:
+    def submit(self, fn, *args, **kwargs):
+        return fn(*args, **kwargs)
+
+@pytest.fixture()
+def prefetcher(testing_storage_api):
+    prefetcher = testing_storage_api.prefetcher
+    table = MagicMock()
+    table.find_one.side_effect = lambda q: ENTRY if q == {'id': 'D83'} else None
+    head = lambda b, k: {'exists': k in SIZES, 'etag': 'e', 'size': SIZES.get(k), 'last_modified': None}
+    with patch.object(prefetcher, 'qc_table', table), patch.object(prefetcher, 'pool', InlinePool()), \
+         patch.object(prefetcher, 'recent', {}), patch.object(prefetcher, 'enabled', True), \
+         patch.object(prefetcher, 'max_bytes', 1000), \
+         patch.object(prefetcher.object_cache, 'headObject', side_effect=head), \
+         patch.object(prefetcher.object_cache, 'isCached', return_value=False), \
+         patch.object(prefetcher.object_cache, 'getObject', side_effect=lambda b, k: {'size': SIZES[k]}) as mock_get:
+        yield prefetcher, mock_get
+
+def test_working_set_order(prefetcher):
+    prefetcher, _ = prefetcher
+    ## viewer files only , in PREFETCH_FILES order , no raw matrix nor QC figures
+    assert prefetcher.workingSet('data', 'D83') == ['data/D83/out/Gene/raw/spatial/metadata.json',
+                                                    'data/D83/out/Gene/raw/spatial/tissue_positions_list.csv',
+                                                    'data/D83/out/Gene/raw/genes.tsv',
+                                                    'data/D83/out/Gene/raw/spatial/tissue_hires_image.png']
+    assert prefetcher.workingSet('other', 'D83') == []
+    assert prefetcher.workingSet('data', 'D999') == []
+
+def test_notify_prefetches_run_within_budget(prefetcher):
+    prefetcher, mock_get = prefetcher
+    prefetcher.notify('bucket1', 'data/D83/out/Gene/raw/spatial/metadata.json')
+    fetched = [c.args[1] for c in mock_get.call_args_list]
+    ## the requested file is skipped
+    assert fetched == ['data/D83/out/Gene/raw/spatial/tissue_positions_list.csv',
+                       'data/D83/out/Gene/raw/genes.tsv',
+                       'data/D83/out/Gene/raw/spatial/tissue_hires_image.png']
+    ## queued once per ttl
+    prefetcher.notify('bucket1', 'data/D83/out/Gene/raw/genes.tsv')
+    assert mock_get.call_count == 3
+
+def test_budget_counts_uncached_bytes_only(prefetcher):
+    prefetcher, mock_get = prefetcher
+    cached = ['data/D83/out/Gene/raw/spatial/tissue_positions_list.csv']
+    with patch.object(prefetcher, 'max_bytes', 550), \
+         patch.object(prefetcher.object_cache, 'isCached', side_effect=lambda b, k, meta: k in cached):
+        prefetcher.notify('bucket1', 'data/D83/out/Gene/raw/spatial/metadata.json')
+    fetched = [c.args[1] for c in mock_get.call_args_list]
+    ## genes.tsv (100) leaves 450 , the hires image (500) doesn't fit
+    assert fetched == ['data/D83/out/Gene/raw/genes.tsv']
+    assert prefetcher.getStats()['skipped'] >= 1
@@ -0,0 +1,73 @@
+import datetime
+from unittest.mock import patch
+from urllib.parse import urlparse, parse_qs
+import botocore.auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import Credentials
+import pytest
+
+CREDENTIALS = Credentials('AKIDEXAMPLE', 'wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY', 'session/token+=')
+
+@pytest.fixture()
+def presigner(testing_storage_api):
+    service = testing_storage_api.presigner
+    service.regions['bucket1'] = 'us-west-2'
+    with patch.object(service.session, 'get_credentials', return_value=CREDENTIALS):
+        yield service
+
+def test_signature_matches_botocore(presigner):
+    timestamp = 1700000100
+    key = 'runs/D001/spatial/tissue hires image (1).png'
+    url = presigner.sign(CREDENTIALS.get_frozen_credentials(), 'bucket1', key, timestamp, 3900)
+    parsed = urlparse(url)
+    request = AWSRequest(method='GET', url='https://' + parsed.netloc + parsed.path)
+    auth = botocore.auth.S3SigV4QueryAuth(CREDENTIALS, 's3', 'us-west-2', expires=3900)
+    signed_at = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).replace(tzinfo=None)
+    with patch('botocore.auth.get_current_datetime', return_value=signed_at):
+        auth.add_auth(request)
+    expected = parse_qs(urlparse(request.url).query)['X-Amz-Signature']
+    assert parse_qs(parsed.query)['X-Amz-Signature'] == expected
+
+def test_urls_memoized_within_window(presigner):
+    with patch('src.presign.time.time', return_value=1700000100):
+        first = presigner.getUrls([('bucket1', 'a.csv'), ('bucket1', 'b.csv')], 3600)
+        with patch.object(presigner, 'sign') as mock_sign:
+            assert presigner.getUrls([('bucket1', 'a.csv')], 3600) == first[:1]
+            assert mock_sign.call_count == 0
+    expires = int(parse_qs(urlparse(first[0]).query)['X-Amz-Expires'][0])
+    assert expires == 3600 + presigner.window
+    with patch('src.presign.time.time', return_value=1700000100 + presigner.window):
+        assert presigner.getUrl('bucket1', 'a.csv', 3600) != first[0]
+
+def client_error(code, region=None):
+    from botocore.exceptions import ClientError
+    headers = {'x-amz-bucket-region': region} if region else {}
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPHeaders': headers}}, 'GetBucketLocation')
+
+@pytest.mark.parametrize('error,region,cached', [(client_error('AccessDenied'), None, True),
+                                                 (client_error('AccessDenied', 'eu-west-1'), 'eu-west-1', True),
+                                                 (client_error('NoSuchBucket'), None, False),
+                                                 (client_error('SlowDown'), None, False)])
+def test_region_fallback(presigner, error, region, cached):
+    presigner.regions.pop('bucket2', None)
+    with patch.object(presigner.aws_s3, 'get_bucket_location', side_effect=error):
+        assert presigner.getRegion('bucket2') == (region or presigner.default_region)
+    assert ('bucket2' in presigner.regions) == cached
+    presigner.regions.pop('bucket2', None)
+
+def test_legacy_eu_region(presigner):
+    presigner.regions.pop('bucket2', None)
+    with patch.object(presigner.aws_s3, 'get_bucket_location', return_value={'LocationConstraint': 'EU'}):
+        assert presigner.getRegion('bucket2') == 'eu-west-1'
+    presigner.regions.pop('bucket2', None)
+
+def test_long_expiry_signed_now(presigner):
+    from src.presign import MAX_EXPIRY
+    now = 1700000100
+    with patch('src.presign.time.time', return_value=now):
+        url = presigner.getUrl('bucket1', 'a.csv', MAX_EXPIRY)
+        with pytest.raises(ValueError):
+            presigner.getUrl('bucket1', 'a.csv', MAX_EXPIRY + 1)
+    query = parse_qs(urlparse(url).query)
+    assert query['X-Amz-Expires'] == [str(MAX_EXPIRY)]
+    assert query['X-Amz-Date'] == [datetime.datetime.fromtimestamp(now, tz=datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')]
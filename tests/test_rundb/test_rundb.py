@@ -432,4 +432,29 @@ def test_get_file_paths(mock_connection, mock_engine, run_db_api):
     assert len(res2) == 2
     
     
-    
\ No newline at end of file
+    
+@patch("src.rundb.MariaDB.get_streaming_connection")
+def test_get_all_downloadable_files_run_id_stream(streaming_connection_mock, run_db_api):
+    rows = [{"run_id": "D1", "file_id": 1}, {"run_id": "D1", "file_id": 2}, {"run_id": "D2", "file_id": 3}]
+    with patch.object(run_db_api, "iter_sql_dicts", return_value=iter(rows)):
+        runs = run_db_api.get_all_downloadable_files_run_id(["admin"], stream=True)
+        res = {run_id: list(files) for run_id, files in runs}
+    sql = streaming_connection_mock.return_value.execute.call_args.args[0]
+    assert sql.endswith("ORDER BY `run_id`")
+    assert list(res) == ["D1", "D2"]
+    assert [f["file_id"] for f in res["D1"]] == [1, 2]
+    assert all(f["presigned_url"] is None for f in res["D1"] + res["D2"])
+
+@patch("src.rundb.MariaDB.get_connection")
+def test_list_validators_cached_per_data_version(connection_mock, run_db_api):
+    conn = connection_mock.return_value.__enter__.return_value
+    conn.execute.return_value.fetchone.return_value = [3]
+    run_db_api.validator_cache.clear()
+    with patch("src.utils.data_version", return_value=1):
+        first = run_db_api.list_validators("study_view", ["admin"])
+        assert run_db_api.list_validators("study_view", ["admin"]) == first
+        assert connection_mock.call_count == 1
+    ## an API write bumps the data version , the count is read again
+    with patch("src.utils.data_version", return_value=2):
+        run_db_api.list_validators("study_view", ["admin"])
+        assert connection_mock.call_count == 2
@@ -1,7 +1,16 @@
+import os
+import io
 import json
+import gzip
+import hashlib
+import zipfile
+import datetime
 import unittest
+import cv2
+import numpy as np
 from unittest.mock import patch
 from unittest.mock import MagicMock
+from flask import Response
 from src.storage import StorageAPI
 from src.auth import Auth
 from src.database import MongoDB
@@ -37,4 +46,511 @@ def testing_presigned_url_errors(testing_storage_api):
     path2 = None
     
     with pytest.raises(Exception):
-        testing_storage_api.generatePresignedUrl(path2, bucket)
\ No newline at end of file
+        testing_storage_api.generatePresignedUrl(path2, bucket)
+
+def write_cached_file(tmp_path, content):
+    path = tmp_path / 'data.bin'
+    path.write_bytes(content)
+    return {'path': path, 'size': len(content), 'etag': 'etag1', 'last_modified': None}
+
+def test_file_response_full(testing_app, testing_storage_api, tmp_path):
+    obj = write_cached_file(tmp_path, b'0123456789')
+    with testing_app.test_request_context('/api/v1/storage'):
+        resp = testing_storage_api.fileResponse(obj)
+        assert resp.status_code == 200
+        assert b''.join(resp.response) == b'0123456789'
+        assert resp.headers['Accept-Ranges'] == 'bytes'
+
+@pytest.mark.parametrize('headers,status,body', [
+    ({'Range': 'bytes=2-5'}, 206, b'2345'),
+    ({'Range': 'bytes=7-'}, 206, b'789'),
+    ({'Range': 'bytes=2-5', 'If-Range': '"etag1"'}, 206, b'2345'),
+    ({'Range': 'bytes=2-5', 'If-Range': '"stale"'}, 200, b'0123456789'),
+])
+def test_file_response_range(testing_app, testing_storage_api, tmp_path, headers, status, body):
+    obj = write_cached_file(tmp_path, b'0123456789')
+    with testing_app.test_request_context('/api/v1/storage', headers=headers):
+        resp = testing_storage_api.fileResponse(obj)
+        assert resp.status_code == status
+        assert b''.join(resp.response) == body
+
+def test_file_response_survives_eviction(testing_app, testing_storage_api, tmp_path):
+    obj = write_cached_file(tmp_path, b'0123456789')
+    with testing_app.test_request_context('/api/v1/storage', headers={'Range': 'bytes=2-5'}):
+        resp = testing_storage_api.fileResponse(obj)
+        ## evicted after the headers were built , the open file still serves the whole range
+        obj['path'].unlink()
+        assert resp.status_code == 206 and resp.headers['Content-Length'] == '4'
+        assert b''.join(resp.response) == b'2345'
+        resp.close()
+
+def test_file_response_full_after_partial(testing_app, testing_storage_api):
+    cache = testing_storage_api.object_cache
+    key = 'tests/ranges/data.bin'
+    cache.invalidate('bucket1', key)
+    head = {'exists': True, 'etag': 'etag1', 'size': 10, 'last_modified': datetime.datetime(2023, 1, 1)}
+    with patch.object(cache, 'headObject', return_value=head), \
+         patch.object(cache.aws_s3, 'download_fileobj', side_effect=lambda b, k, f: f.write(b'0123456789')) as mock_download:
+        with testing_app.test_request_context('/api/v1/storage', headers={'Range': 'bytes=2-5'}):
+            resp = testing_storage_api.fileResponse(cache.getObject('bucket1', key))
+            assert resp.status_code == 206 and b''.join(resp.response) == b'2345'
+        ## the validator changed on the client side , the whole object comes back from the cache
+        with testing_app.test_request_context('/api/v1/storage', headers={'Range': 'bytes=6-', 'If-Range': '"etag0"'}):
+            resp = testing_storage_api.fileResponse(cache.getObject('bucket1', key))
+            assert resp.status_code == 200 and b''.join(resp.response) == b'0123456789'
+            assert resp.headers['Content-Length'] == '10' and 'Content-Range' not in resp.headers
+        assert mock_download.call_count == 1
+        assert 'Range' not in mock_download.call_args.kwargs.get('ExtraArgs', {})
+    cache.invalidate('bucket1', key)
+
+def test_file_response_unsatisfiable(testing_app, testing_storage_api, tmp_path):
+    obj = write_cached_file(tmp_path, b'0123456789')
+    with testing_app.test_request_context('/api/v1/storage', headers={'Range': 'bytes=20-'}):
+        resp = testing_storage_api.fileResponse(obj)
+        assert resp.status_code == 416
+        assert resp.headers['Content-Range'] == 'bytes */10'
+
+def test_file_response_x_accel(testing_app, testing_storage_api):
+    path = testing_storage_api.tempDirectory / 'tests' / 'x_accel.bin'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b'0123456789')
+    obj = {'path': path, 'size': 10, 'etag': 'etag1', 'last_modified': None}
+    with patch.object(testing_storage_api, 'serve_mode', 'x-accel'), patch.object(testing_storage_api, 'x_accel_prefix', '/protected_cache/'):
+        with testing_app.test_request_context('/api/v1/storage'):
+            resp = testing_storage_api.fileResponse(obj)
+            assert resp.headers['X-Accel-Redirect'] == '/protected_cache/tests/x_accel.bin'
+            assert resp.headers['ETag'] == '"etag1"'
+
+def test_file_response_x_accel_outside_cache(testing_app, testing_storage_api, tmp_path):
+    outside = tmp_path / 'secret.bin'
+    outside.write_bytes(b'0123456789')
+    ## a path that only reaches outside TEMP_DIRECTORY through '..' is streamed by the app , never redirected
+    path = testing_storage_api.tempDirectory / '..' / os.path.relpath(outside, testing_storage_api.tempDirectory.parent)
+    obj = {'path': path, 'size': 10, 'etag': 'etag1', 'last_modified': None}
+    with patch.object(testing_storage_api, 'serve_mode', 'x-accel'):
+        with testing_app.test_request_context('/api/v1/storage'):
+            resp = testing_storage_api.fileResponse(obj)
+            assert 'X-Accel-Redirect' not in resp.headers
+            resp.close()
+    assert testing_storage_api.serverPath('../secret.bin') is None
+    assert testing_storage_api.serverPath('/etc/passwd') is None
+    with patch.object(testing_storage_api.object_cache, 'getObject', return_value=None):
+        assert testing_storage_api.getCachedObject('bucket1', '../' * 10 + str(outside)) is None
+
+def test_files_zipped_stream(testing_storage_api, tmp_path):
+    contents = {'run/a.csv': b'a,b,c\n' * 100, 'run/b.png': b'\x89PNG' * 50}
+    def fake_get(bucket, key):
+        path = tmp_path / key.replace('/', '_')
+        path.write_bytes(contents[key])
+        return {'path': path, 'size': len(contents[key]), 'etag': 'e', 'last_modified': datetime.datetime(2023, 1, 1)}
+    with patch.object(testing_storage_api, 'getFileList', return_value=list(contents.keys())), \
+         patch.object(testing_storage_api.object_cache, 'getObject', side_effect=fake_get):
+        chunks = testing_storage_api.getFilesZipped('bucket1', 'run')
+        first = next(chunks)
+        ## prefetched copies evicted before they are zipped are still read from their open files
+        for path in tmp_path.glob('run_*'):
+            path.unlink()
+        data = first + b''.join(chunks)
+    zf = zipfile.ZipFile(io.BytesIO(data))
+    assert zf.read('run/a.csv') == contents['run/a.csv']
+    assert zf.read('run/b.png') == contents['run/b.png']
+    assert zf.getinfo('run/a.csv').compress_type == zipfile.ZIP_DEFLATED
+    assert zf.getinfo('run/b.png').compress_type == zipfile.ZIP_STORED
+
+def test_files_zipped_stream_failures(testing_storage_api, tmp_path):
+    path = tmp_path / 'a.csv'
+    path.write_bytes(b'a,b,c\n' * 100)
+    def fake_open(bucket, key):
+        if key == 'run/b.csv':
+            raise Exception('read failed')
+        return {'path': path, 'size': 600, 'etag': 'e', 'last_modified': datetime.datetime(2023, 1, 1), 'file': open(path, 'rb')}
+    ## the first member fails before any byte is produced , the endpoint can still answer with an error
+    with patch.object(testing_storage_api, 'getFileList', return_value=['run/b.csv', 'run/a.csv']), \
+         patch.object(testing_storage_api.object_cache, 'openObject', side_effect=fake_open):
+        with pytest.raises(Exception, match='read failed'):
+            next(testing_storage_api.getFilesZipped('bucket1', 'run'))
+    ## a later failure is logged and raised , the archive is never ended as if it were complete
+    with patch.object(testing_storage_api, 'getFileList', return_value=['run/a.csv', 'run/b.csv']), \
+         patch.object(testing_storage_api.object_cache, 'openObject', side_effect=fake_open), \
+         patch.object(testing_storage_api.auth.app.logger, 'exception') as mock_log:
+        chunks = testing_storage_api.getFilesZipped('bucket1', 'run')
+        next(chunks)
+        with pytest.raises(Exception, match='read failed'):
+            list(chunks)
+        assert 'run/b.csv' in mock_log.call_args.args[0]
+
+def test_move_files_report(testing_storage_api):
+    objects = [{'Key': 'runs/D1/a.csv', 'Size': 10},
+               {'Key': 'runs/D1/b.csv', 'Size': 20},
+               {'Key': 'runs/D1/c.txt', 'Size': 30},
+               {'Key': 'runs/D1/', 'Size': 0}]
+    ## the copy of b.csv doesn't show up with the right size , so its source is kept
+    sizes = {'archive/D1/a.csv': 10, 'archive/D1/b.csv': 0}
+    head = lambda b, k, use_cache=True: {'exists': True, 'etag': 'e', 'size': sizes[k], 'last_modified': None}
+    with patch.object(testing_storage_api, 'listObjects', return_value=objects), \
+         patch.object(testing_storage_api.object_cache, 'headObject', side_effect=head), \
+         patch.object(testing_storage_api.aws_s3, 'copy_object') as mock_copy, \
+         patch.object(testing_storage_api.aws_s3, 'delete_objects', return_value={}) as mock_delete:
+        report = testing_storage_api.move_files('bucket1', 'runs/', '.csv', 'bucket2', 'archive/', delete_source=True)
+    assert report['total'] == 2
+    assert report['copied'] == 2
+    assert report['bytes'] == 30
+    assert report['deleted'] == 1
+    assert [f['from'] for f in report['failed']] == ['runs/D1/b.csv']
+    destinations = sorted(c.kwargs['Key'] for c in mock_copy.call_args_list)
+    assert destinations == ['archive/D1/a.csv', 'archive/D1/b.csv']
+    assert mock_delete.call_count == 1
+    assert mock_delete.call_args.kwargs['Delete']['Objects'] == [{'Key': 'runs/D1/a.csv'}]
+
+def test_with_retries_only_transient(testing_storage_api):
+    from botocore.exceptions import ClientError
+    denied = ClientError({'Error': {'Code': 'AccessDenied'}, 'ResponseMetadata': {'HTTPStatusCode': 403}}, 'CopyObject')
+    slow_down = ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'CopyObject')
+    func = MagicMock(side_effect=denied)
+    with patch('src.storage.time.sleep') as mock_sleep:
+        with pytest.raises(ClientError):
+            testing_storage_api.withRetries(func)
+        assert func.call_count == 1 and mock_sleep.call_count == 0
+        func = MagicMock(side_effect=[slow_down, 'done'])
+        assert testing_storage_api.withRetries(func) == 'done'
+        assert func.call_count == 2
+
+def test_move_files_delete_source_requires_admin(client_testing, testing_storage_api):
+    user = MagicMock()
+    user.username = 'user1'
+    payload = {'from_bucket': 'bucket1', 'from_path': 'runs/', 'from_filter': '', 'to_bucket': 'bucket2',
+               'to_path': 'archive/', 'delete_source': True}
+    with patch('flask_jwt_extended.view_decorators.verify_jwt_in_request'), \
+         patch('src.storage.current_user', (user, ['user'])), \
+         patch('src.auth.current_user', (user, ['user'])), \
+         patch.object(testing_storage_api, 'move_files') as mock_move:
+        res = client_testing.post('/api/v1/storage/move_files', json=payload)
+    assert res.status_code == 401
+    assert mock_move.call_count == 0
+
+def test_png_rejects_unlisted_variants(client_testing, testing_storage_api):
+    with patch.object(testing_storage_api, 'renderedResponse') as mock_render:
+        res = client_testing.get('/api/v1/storage/png?filename=run1/spatial/figure.png&max_width=1000')
+        assert res.status_code == 400
+        res = client_testing.get('/api/v1/storage/png?filename=run1/spatial/figure.png&max_width=1024&quality=33')
+        assert res.status_code == 400
+        assert mock_render.call_count == 0
+
+def test_unsupported_image_format(client_testing, testing_storage_api):
+    with patch('flask_jwt_extended.view_decorators.verify_jwt_in_request'), \
+         patch.object(testing_storage_api, 'renderedResponse') as mock_render:
+        res = client_testing.get('/api/v1/storage/png?filename=run1/spatial/figure.png&format=bmp')
+        assert res.status_code == 400
+        res = client_testing.get('/api/v1/storage/image_as_jpg?filename=run1/spatial/figure.png&format=bmp')
+        assert res.status_code == 400
+        assert mock_render.call_count == 0
+
+def test_check_files_exist_batch(testing_storage_api):
+    listing = [{'Contents': [{'Key': 'run/spatial/{}.csv'.format(i), 'ETag': '"e"', 'Size': 1,
+                              'LastModified': datetime.datetime(2023, 1, 1)} for i in range(4)]}]
+    paginator = MagicMock()
+    paginator.paginate.return_value = listing
+    keys = ['run/spatial/{}.csv'.format(i) for i in range(5)] + ['run/metadata.json']
+    head = {'exists': True, 'etag': 'e', 'size': 1, 'last_modified': None}
+    with patch.object(testing_storage_api.object_cache, 'getMetadata', return_value=None), \
+         patch.object(testing_storage_api.object_cache, 'putMetadata') as mock_put, \
+         patch.object(testing_storage_api.object_cache, 'headObject', return_value=head) as mock_head, \
+         patch.object(testing_storage_api.aws_s3, 'get_paginator', return_value=paginator):
+        res = testing_storage_api.checkFilesExist('bucket1', keys)
+    assert res['run/spatial/0.csv'] is True
+    assert res['run/spatial/4.csv'] is False
+    assert res['run/metadata.json'] is True
+    assert paginator.paginate.call_count == 1
+    assert mock_head.call_count == 1
+    assert mock_put.call_count == 5
+
+@pytest.fixture
+def fake_image_object(tmp_path):
+    """Writes a random image and returns the (obj , head) entries the object cache would give for it."""
+    def _fake(shape):
+        source = tmp_path / 'source.png'
+        cv2.imwrite(str(source), np.random.randint(0, 255, shape, dtype=np.uint8))
+        obj = {'path': source, 'size': source.stat().st_size, 'etag': 'etag1', 'last_modified': datetime.datetime(2023, 1, 1)}
+        head = {'exists': True, 'etag': 'etag1', 'size': obj['size'], 'last_modified': obj['last_modified']}
+        return obj, head
+    return _fake
+
+def test_rendered_object_cached_by_etag(testing_storage_api, fake_image_object):
+    key = 'tests/rendered/source.png'
+    testing_storage_api.object_cache.invalidate('bucket1', key)
+    obj, head = fake_image_object((40, 60, 3))
+    ops = [('channel', 0), ('rotate', 90), ('crop', 0, 10, 0, 20)]
+    with patch.object(testing_storage_api.object_cache, 'headObject', return_value=head), \
+         patch.object(testing_storage_api.object_cache, 'getObject', return_value=obj) as mock_get:
+        first = testing_storage_api.getRenderedObject('bucket1', key, ops)
+        second = testing_storage_api.getRenderedObject('bucket1', key, ops)
+        other = testing_storage_api.getRenderedObject('bucket1', key, [('rotate', 180)])
+    assert mock_get.call_count == 2
+    assert first['path'] == second['path'] and first['etag'] == second['etag']
+    assert other['etag'] != first['etag']
+    assert cv2.imread(str(first['path']), cv2.IMREAD_UNCHANGED).shape == (20, 10)
+
+def test_rendered_object_deleted_after_head(testing_storage_api, fake_image_object):
+    key = 'tests/rendered/deleted.png'
+    cache = testing_storage_api.object_cache
+    cache.invalidate('bucket1', key)
+    _, head = fake_image_object((40, 60, 3))
+    with patch.object(cache, 'headObject', return_value=head), \
+         patch.object(cache, 'getObject', return_value=None):
+        assert testing_storage_api.getRenderedObject('bucket1', key, [('rotate', 90)]) is None
+
+def test_tile_rendered_when_pyramid_exceeds_quota(testing_storage_api, fake_image_object):
+    key = 'tests/tiles/source.png'
+    cache = testing_storage_api.object_cache
+    cache.invalidate('bucket1', key)
+    obj, head = fake_image_object((300, 500, 3))
+    with patch.object(cache, 'headObject', return_value=head), \
+         patch.object(cache, 'getObject', return_value=obj), \
+         patch.object(testing_storage_api, 'tile_size', 256):
+        info = testing_storage_api.getTilePyramid('bucket1', key)
+        top = info['levels'] - 1
+        ## the whole pyramid was kept while it was written
+        assert cache.getDerived('bucket1', key, 'etag1', 'tiles/{}/0_0.jpg'.format(top)) is not None
+        cache.invalidate('bucket1', key)
+        cache.putDerived('bucket1', key, 'etag1', 'tiles/info.json', json.dumps(info).encode('utf-8'))
+        with patch.object(cache, 'max_bytes', info['bytes']), \
+             patch.object(testing_storage_api, 'getTilePyramid', wraps=testing_storage_api.getTilePyramid) as mock_pyramid:
+            tile = testing_storage_api.getTile('bucket1', key, top, 1, 1)
+            assert all(c.kwargs.get('tile') is None for c in mock_pyramid.call_args_list)
+    assert cv2.imread(str(tile['path'])).shape == (44, 244, 3)
+    cache.invalidate('bucket1', key)
+
+def test_tile_pyramid_rebuilt_once(testing_storage_api, fake_image_object):
+    key = 'tests/tiles/rebuilt.png'
+    cache = testing_storage_api.object_cache
+    cache.invalidate('bucket1', key)
+    obj, head = fake_image_object((300, 500, 3))
+    with patch.object(cache, 'headObject', return_value=head), \
+         patch.object(cache, 'getObject', return_value=obj) as mock_get, \
+         patch.object(testing_storage_api, 'tile_size', 256):
+        info = testing_storage_api.getTilePyramid('bucket1', key)
+        ## a tile evicted , the next miss rebuilds and the ones queued behind it don't
+        cache.invalidate('bucket1', key)
+        cache.putDerived('bucket1', key, 'etag1', 'tiles/info.json', json.dumps(info).encode('utf-8'))
+        testing_storage_api.getTile('bucket1', key, 0, 0, 0)
+        testing_storage_api.getTilePyramid('bucket1', key, tile='tiles/0/0_0.jpg')
+    assert mock_get.call_count == 2
+    cache.invalidate('bucket1', key)
+
+def test_tile_crop_validates_parameters(client_testing, testing_storage_api):
+    info = {'width': 500, 'height': 300, 'tile_size': 256, 'levels': 10, 'etag': 'etag1'}
+    with patch('flask_jwt_extended.view_decorators.verify_jwt_in_request'), \
+         patch.object(testing_storage_api, 'getTilePyramid', return_value=info):
+        res = client_testing.get('/api/v1/storage/tiles/crop?filename=run1/spatial/tissue.png&x1=0&x2=10&y1=0&y2=10')
+        assert res.status_code == 400
+        res = client_testing.get('/api/v1/storage/tiles/crop?filename=run1/spatial/tissue.png&level=12&x1=0&x2=10&y1=0&y2=10')
+        assert res.status_code == 400
+        res = client_testing.get('/api/v1/storage/tiles/crop?filename=run1/spatial/tissue.png&level=9&x1=20&x2=10&y1=0&y2=10')
+        assert res.status_code == 400
+
+def test_tile_crop_renders_missing_tiles(testing_storage_api, fake_image_object):
+    key = 'tests/tiles/crop.png'
+    cache = testing_storage_api.object_cache
+    cache.invalidate('bucket1', key)
+    obj, head = fake_image_object((300, 500, 3))
+    with patch.object(cache, 'headObject', return_value=head), \
+         patch.object(cache, 'getObject', return_value=obj), \
+         patch.object(testing_storage_api, 'tile_size', 256), \
+         patch.object(testing_storage_api, 'getTile', return_value=None):
+        top = testing_storage_api.getTilePyramid('bucket1', key)['levels'] - 1
+        data, size = testing_storage_api.getCropFromTiles('bucket1', key, top, 200, 300, 100, 280)
+    assert cv2.imdecode(np.frombuffer(data.getvalue(), np.uint8), cv2.IMREAD_COLOR).shape == (180, 100, 3)
+    cache.invalidate('bucket1', key)
+
+def test_gzip_passthrough(testing_app, testing_storage_api, tmp_path):
+    payload = gzip.compress(b'{"a": 1}')
+    path = tmp_path / 'metadata.json.gz'
+    path.write_bytes(payload)
+    obj = {'path': path, 'size': len(payload), 'etag': 'etag1', 'last_modified': None}
+    with patch.object(testing_storage_api, 'getCachedObject', return_value=obj):
+        with testing_app.test_request_context('/api/v1/storage/json', headers={'Accept-Encoding': 'gzip, deflate'}):
+            passthrough = testing_storage_api.getGzipPassthroughObject('bucket1', 'run/metadata.json.gz')
+            resp = testing_storage_api.gzipResponse(passthrough, mimetype='application/json')
+            assert resp.headers['Content-Encoding'] == 'gzip'
+            assert resp.headers['Vary'] == 'Accept-Encoding'
+            assert b''.join(resp.response) == payload
+        ## x-accel mode streams the bytes itself , with the same validators
+        with patch.object(testing_storage_api, 'serve_mode', 'x-accel'):
+            with testing_app.test_request_context('/api/v1/storage/json', headers={'Accept-Encoding': 'gzip'}):
+                resp = testing_storage_api.gzipResponse(obj, mimetype='application/json')
+                assert 'X-Accel-Redirect' not in resp.headers
+                assert resp.headers['ETag'] == '"etag1-gzip"'
+                assert resp.headers['Cache-Control'] == testing_storage_api.cache_control
+                assert b''.join(resp.response) == payload
+                resp.close()
+            with testing_app.test_request_context('/api/v1/storage/json', headers={'Accept-Encoding': 'gzip', 'If-None-Match': '"etag1-gzip"'}):
+                resp = testing_storage_api.gzipResponse(obj, mimetype='application/json')
+                assert resp.status_code == 304 and resp.headers['Vary'] == 'Accept-Encoding'
+        with testing_app.test_request_context('/api/v1/storage/json', headers={'Accept-Encoding': 'identity'}):
+            assert testing_storage_api.getGzipPassthroughObject('bucket1', 'run/metadata.json.gz') is None
+            assert testing_storage_api.getJsonFromFile('bucket1', 'run/metadata.json.gz', True) == {'a': 1}
+
+def test_csv_gzip_decompressed_in_chunks(testing_app, testing_storage_api, tmp_path):
+    content = b'a,b,c\n' * 1000
+    path = tmp_path / 'spatial.csv.gz'
+    path.write_bytes(gzip.compress(content))
+    obj = {'path': path, 'size': path.stat().st_size, 'etag': 'etag1', 'last_modified': None}
+    with patch.object(testing_storage_api, 'getCachedObject', return_value=obj), \
+         patch.object(testing_storage_api, 'chunk_size', 1024):
+        with testing_app.test_request_context('/api/v1/storage/csv', headers={'Accept-Encoding': 'identity'}):
+            resp = testing_storage_api.getCsvFileResponse('bucket1', 'run/spatial.csv.gz')
+            chunks = list(resp.response)
+            assert len(chunks) > 1 and b''.join(chunks) == content
+            assert resp.headers['ETag'] == '"etag1-identity"' and resp.headers['Vary'] == 'Accept-Encoding'
+            resp.close()
+        with testing_app.test_request_context('/api/v1/storage/csv', headers={'If-None-Match': '"etag1-identity"'}):
+            assert testing_storage_api.getCsvFileResponse('bucket1', 'run/spatial.csv.gz').status_code == 304
+
+def test_conditional_response_varies_on_encoding(testing_app, testing_storage_api):
+    build = lambda: Response('{}', status=200)
+    with patch.object(testing_storage_api, 'transformEtag', return_value='etag1-params'):
+        with testing_app.test_request_context('/api/v1/storage/json', headers={'Accept-Encoding': 'identity'}):
+            resp = testing_storage_api.conditionalResponse('bucket1', 'run/metadata.json.gz', build)
+            assert resp.status_code == 200 and resp.headers['Vary'] == 'Accept-Encoding'
+        with testing_app.test_request_context('/api/v1/storage/json', headers={'If-None-Match': '"etag1-params"'}):
+            resp = testing_storage_api.conditionalResponse('bucket1', 'run/metadata.json.gz', build)
+            assert resp.status_code == 304 and resp.headers['Vary'] == 'Accept-Encoding'
+
+def test_file_response_not_modified(testing_app, testing_storage_api, tmp_path):
+    obj = write_cached_file(tmp_path, b'0123456789')
+    obj['last_modified'] = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    with testing_app.test_request_context('/api/v1/storage', headers={'If-None-Match': '"etag1"'}):
+        resp = testing_storage_api.fileResponse(obj)
+        assert resp.status_code == 304
+        assert resp.headers['ETag'] == '"etag1"'
+        assert resp.headers['Cache-Control'] == testing_storage_api.cache_control
+    with testing_app.test_request_context('/api/v1/storage', headers={'If-Modified-Since': 'Sun, 01 Jan 2023 00:00:00 GMT'}):
+        assert testing_storage_api.fileResponse(obj).status_code == 304
+    with testing_app.test_request_context('/api/v1/storage', headers={'If-None-Match': '"etag0"'}):
+        assert testing_storage_api.fileResponse(obj).status_code == 200
+
+def test_sync_objects_incremental(testing_storage_api, tmp_path):
+    etags = {'data/R1/frontPage_R1.png': 'e1', 'data/R2/frontPage_R2.png': 'e2', 'data/R3/frontPage_R3.png': 'e3'}
+    def head(bucket, key, use_cache=True):
+        if key in etags:
+            return {'exists': True, 'etag': etags[key], 'size': 1, 'last_modified': None}
+        return {'exists': False, 'etag': None, 'size': None, 'last_modified': None}
+    def download(bucket, key, path):
+        if key == 'data/R3/frontPage_R3.png':
+            raise Exception('connection reset')
+        open(path, 'w').write(key)
+    targets = [(k, tmp_path.joinpath(k.split('/')[-1])) for k in list(etags) + ['data/R4/frontPage_R4.png']]
+    manifest = tmp_path.joinpath('.manifest.json')
+    with patch.object(testing_storage_api.object_cache, 'headObject', side_effect=head), \
+         patch.object(testing_storage_api.aws_s3, 'download_file', side_effect=download) as mock_download, \
+         patch.object(testing_storage_api, 'transfer_retries', 0):
+        report = testing_storage_api.syncObjects('bucket1', targets, manifest)
+        assert (report['added'], report['updated'], report['skipped'], report['missing'], report['failed']) == (2, 0, 0, 1, 1)
+        etags['data/R2/frontPage_R2.png'] = 'e2-new'
+        report = testing_storage_api.syncObjects('bucket1', targets, manifest)
+        assert (report['added'], report['updated'], report['skipped'], report['missing'], report['failed']) == (0, 1, 1, 1, 1)
+    assert mock_download.call_count == 5
+    assert tmp_path.joinpath('frontPage_R1.png').read_text() == 'data/R1/frontPage_R1.png'
+    assert json.load(open(manifest))[str(tmp_path.joinpath('frontPage_R2.png'))] == 'e2-new'
+
+def test_write_thumbnails_replaces_previous_version(testing_storage_api, tmp_path):
+    with patch.object(testing_storage_api, 'webpage_dir', tmp_path):
+        first = testing_storage_api.writeThumbnails('R1', [(100, 'png', b'v1-100'), (200, 'png', b'v1-200')])
+        second = testing_storage_api.writeThumbnails('R1', [(100, 'png', b'v2-100'), (200, 'png', b'v2-200')])
+        image_dir = tmp_path.joinpath('frontpage_images')
+        assert first['100']['png'] != second['100']['png']
+        assert not image_dir.joinpath(first['100']['png']).exists()
+        assert image_dir.joinpath('frontPage_R1.png').read_bytes() == b'v2-200'
+        assert testing_storage_api.getThumbnailIndex('R1') == second
+        obj = testing_storage_api.getThumbnailObject('R1', second['200']['png'])
+        assert obj['size'] == 6 and obj['etag'] in second['200']['png']
+        assert testing_storage_api.getThumbnailObject('R2', second['200']['png']) is None
+        assert testing_storage_api.getThumbnailObject('R1', '../frontPage_R1.thumbnails.json') is None
+
+def test_write_thumbnails_legacy_from_config(testing_storage_api, tmp_path):
+    with patch.object(testing_storage_api, 'webpage_dir', tmp_path), \
+         patch.object(testing_storage_api, 'thumbnail_legacy_size', 300), \
+         patch.object(testing_storage_api, 'thumbnail_legacy_format', 'webp'):
+        testing_storage_api.writeThumbnails('R1', [(100, 'webp', b'w-100'), (400, 'webp', b'w-400'), (400, 'png', b'p-400')])
+        image_dir = tmp_path.joinpath('frontpage_images')
+        assert image_dir.joinpath('frontPage_R1.webp').read_bytes() == b'w-400'
+        assert not image_dir.joinpath('frontPage_R1.png').exists()
+
+def test_thumbnail_pool_recreated_when_broken(testing_storage_api):
+    from concurrent.futures.process import BrokenProcessPool
+    broken = MagicMock()
+    broken.submit.return_value.result.side_effect = BrokenProcessPool('worker died')
+    healthy = MagicMock()
+    healthy.submit.return_value.result.return_value = [(200, 'png', b'png')]
+    with patch.object(testing_storage_api, 'thumbnail_pool', broken), \
+         patch('src.storage.ProcessPoolExecutor', return_value=healthy):
+        assert testing_storage_api.buildThumbnails(b'data') == [(200, 'png', b'png')]
+        assert testing_storage_api.thumbnail_pool is healthy
+        broken.shutdown.assert_called_once_with(wait=False)
+
+def multipart_body(fields, filename, data, boundary='atxboundary'):
+    parts = [b'--' + boundary.encode() + b'\r\nContent-Disposition: form-data; name="' + k.encode() + b'"\r\n\r\n' + v.encode() + b'\r\n'
+             for k, v in fields.items()]
+    parts.append(b'--' + boundary.encode() + b'\r\nContent-Disposition: form-data; name="file"; filename="' + filename.encode() +
+                 b'"\r\nContent-Type: application/octet-stream\r\n\r\n' + data + b'\r\n')
+    return b''.join(parts) + b'--' + boundary.encode() + b'--\r\n', 'multipart/form-data; boundary=' + boundary
+
+def test_upload_stream_records_content_hash(testing_app, testing_storage_api):
+    data = b'spatial' * 100
+    body, content_type = multipart_body({'bucket_name': 'bucket1', 'output_filename': 'run1/Summary.csv'}, 'Summary.csv', data)
+    with testing_app.test_request_context('/api/v1/storage/upload', method='POST', data=body, content_type=content_type), \
+         patch.object(testing_storage_api.aws_s3, 'put_object', return_value={'ETag': '"etag1"'}) as mock_put, \
+         patch.object(testing_storage_api.content_hashes, 'record') as mock_record, \
+         patch.object(testing_storage_api.object_cache, 'invalidate'):
+        res = testing_storage_api.uploadStream('admin')
+    assert res['msg'] == 'run1/Summary.csv'
+    assert mock_put.call_args.kwargs['Body'] == data
+    mock_record.assert_called_once_with('bucket1', 'run1/Summary.csv', hashlib.sha256(data).hexdigest(), len(data), 'etag1')
+
+def test_upload_stream_destination_after_file(testing_app, testing_storage_api):
+    data = b'spatial' * 100
+    body, content_type = multipart_body({'destination_after_file': 'true'}, 'Summary.csv', data)
+    ## destination fields after the file part
+    body = body[:-len(b'--atxboundary--\r\n')] + b'--atxboundary\r\nContent-Disposition: form-data; name="output_filename"\r\n\r\nrun1/Summary.csv\r\n--atxboundary--\r\n'
+    with testing_app.test_request_context('/api/v1/storage/upload', method='POST', data=body, content_type=content_type), \
+         patch.object(testing_storage_api.aws_s3, 'put_object', return_value={'ETag': '"etag1"'}) as mock_put, \
+         patch.object(testing_storage_api, 'copyObject') as mock_copy, \
+         patch.object(testing_storage_api, 'deleteFile') as mock_delete, \
+         patch.object(testing_storage_api, 'finishUpload'):
+        res = testing_storage_api.uploadStream('admin')
+    assert res['msg'] == 'run1/Summary.csv'
+    ## written to a temporary key , never to the base name of the file
+    tmp_key = mock_put.call_args.kwargs['Key']
+    assert tmp_key.startswith(testing_storage_api.upload_tmp_prefix) and tmp_key != 'Summary.csv'
+    mock_copy.assert_called_once_with(testing_storage_api.bucket_name, tmp_key, testing_storage_api.bucket_name, 'run1/Summary.csv', len(data))
+    mock_delete.assert_called_once_with(testing_storage_api.bucket_name, tmp_key)
+
+def test_upload_stream_default_destination_written_once(testing_app, testing_storage_api):
+    data = b'spatial' * 100
+    body, content_type = multipart_body({}, 'Summary.csv', data)
+    with testing_app.test_request_context('/api/v1/storage/upload', method='POST', data=body, content_type=content_type), \
+         patch.object(testing_storage_api.aws_s3, 'put_object', return_value={'ETag': '"etag1"'}) as mock_put, \
+         patch.object(testing_storage_api, 'copyObject') as mock_copy, \
+         patch.object(testing_storage_api, 'deleteFile') as mock_delete, \
+         patch.object(testing_storage_api, 'finishUpload'):
+        res = testing_storage_api.uploadStream('admin')
+    ## no destination fields at all , the default key is written directly
+    assert res['msg'] == 'Summary.csv'
+    assert mock_put.call_args.kwargs['Key'] == 'Summary.csv'
+    assert mock_copy.call_count == 0 and mock_delete.call_count == 0
+
+def test_upload_stream_deduplicated(testing_app, testing_storage_api):
+    data = b'spatial' * 100
+    sha256 = hashlib.sha256(data).hexdigest()
+    source = {'bucket_name': 'bucket1', 'key': 'run0/Summary.csv', 'sha256': sha256, 'size': len(data), 'etag': 'etag0'}
+    fields = {'bucket_name': 'bucket1', 'output_filename': 'run1/Summary.csv', 'dedup': 'true', 'sha256': sha256, 'size': str(len(data))}
+    body, content_type = multipart_body(fields, 'Summary.csv', data)
+    with testing_app.test_request_context('/api/v1/storage/upload', method='POST', data=body, content_type=content_type), \
+         patch.object(testing_storage_api, 'findDuplicate', return_value=source), \
+         patch.object(testing_storage_api, 'copyObject') as mock_copy, \
+         patch.object(testing_storage_api, 'recordContentHash'), \
+         patch.object(testing_storage_api.aws_s3, 'put_object') as mock_put:
+        res = testing_storage_api.uploadStream('admin')
+    assert res['msg'] == 'run1/Summary.csv'
+    assert mock_put.call_count == 0
+    mock_copy.assert_called_once_with('bucket1', 'run0/Summary.csv', 'bucket1', 'run1/Summary.csv', len(data))
@@ -0,0 +1,121 @@
+import io
+import gzip
+import numpy as np
+from src import tabular
+import pytest
+
+def test_npy_dtype_inference(tmp_path):
+    path = tmp_path / 'tissue_positions_list.csv.gz'
+    with gzip.open(path, 'wt') as f:
+        f.write('AAAC-1,1,0,5,100.5,200.25\nAAAG-1,0,1,6,101.5,201.5\n')
+    df = tabular.read_frame(path, gz=True)
+    records = np.load(io.BytesIO(tabular.encode_npy(df)), allow_pickle=False)
+    assert records.dtype.names == ('f0', 'f1', 'f2', 'f3', 'f4', 'f5')
+    assert records.dtype['f0'].kind == 'U'
+    assert records.dtype['f1'] == np.int64
+    assert records.dtype['f4'] == np.float64
+    assert records[1]['f0'] == 'AAAG-1' and records[1]['f5'] == 201.5
+
+def test_header_detection(tmp_path):
+    path = tmp_path / 'spatial.csv'
+    path.write_text('barcode,x,y\nA,1,2.5\nB,3,4\n')
+    df = tabular.read_frame(path)
+    assert list(df.columns) == ['barcode', 'x', 'y']
+    assert list(tabular.read_frame(path, header='false').columns) == ['f0', 'f1', 'f2']
+
+def test_arrow_stream(tmp_path):
+    pa = pytest.importorskip('pyarrow')
+    path = tmp_path / 'spatial.csv'
+    path.write_text('barcode,x,y\nA,1,2.5\nB,3,4\n')
+    table = pa.ipc.open_stream(tabular.encode_arrow(tabular.read_frame(path))).read_all()
+    assert table.column('x').to_pylist() == [1, 3]
+    assert str(table.schema.field('y').type) == 'double'
+
+def cache_csv(object_cache, key, content):
+    import datetime
+    from unittest.mock import patch
+    object_cache.invalidate('bucket1', key)
+    head = {'exists': True, 'etag': 'etag1', 'size': len(content), 'last_modified': datetime.datetime(2023, 1, 1)}
+    def download(bucket, k, f):
+        f.write(content)
+    return patch.object(object_cache, 'headObject', return_value=head), \
+           patch.object(object_cache.aws_s3, 'download_fileobj', side_effect=download)
+
+@pytest.mark.parametrize('key,compress', [('tests/tabular/spatial.csv', False), ('tests/tabular/spatial.csv.gz', True)])
+def test_read_rows_slicing(testing_object_cache, key, compress):
+    lines = ['barcode,in_tissue,x'] + ['B{},{},{}'.format(i, i % 2, i * 10) for i in range(1, 101)]
+    content = ('\n'.join(lines) + '\n').encode('utf-8')
+    head_patch, download_patch = cache_csv(testing_object_cache, key, gzip.compress(content) if compress else content)
+    with head_patch, download_patch as mock_download:
+        rows, total = tabular.read_rows(testing_object_cache, 'bucket1', key, offset=40, limit=3)
+        assert total == 101
+        assert rows == [['B40', '0', '400'], ['B41', '1', '410'], ['B42', '0', '420']]
+        rows, _ = tabular.read_rows(testing_object_cache, 'bucket1', key, offset=1, limit=2, columns=['barcode', '2'], where=['in_tissue=1', 'x>=500'])
+        assert rows == [['B53', '530'], ['B55', '550']]
+        assert mock_download.call_count == 1
+
+def test_line_index_keyed_to_read_version(testing_object_cache):
+    import datetime
+    from unittest.mock import patch
+    key = 'tests/tabular/changed.csv.gz'
+    content = b'a,1\nb,2\nc,3\n'
+    head_patch, download_patch = cache_csv(testing_object_cache, key, gzip.compress(content))
+    read = {'path': None, 'size': 0, 'etag': 'etag2', 'last_modified': datetime.datetime(2023, 1, 2)}
+    with head_patch, download_patch:
+        ## the object changed between the HEAD (etag1) and the download (etag2)
+        obj = testing_object_cache.getObject('bucket1', key)
+        read['path'] = obj['path']
+        with patch.object(testing_object_cache, 'getObject', return_value=read):
+            path, offsets = tabular.line_index(testing_object_cache, 'bucket1', key)
+    assert path.read_bytes() == content and list(offsets) == [0, 4, 8, 12]
+    assert testing_object_cache.getDerived('bucket1', key, 'etag2', 'rows/offsets.npy') is not None
+    assert testing_object_cache.getDerived('bucket1', key, 'etag1', 'rows/offsets.npy') is None
+    testing_object_cache.invalidate('bucket1', key)
+
+def test_columnar_object_missing_or_unsupported(testing_object_cache):
+    from unittest.mock import patch
+    key = 'tests/tabular/gone.csv'
+    head_patch, _ = cache_csv(testing_object_cache, key, b'a,1\n')
+    with pytest.raises(ValueError):
+        tabular.columnar_object(testing_object_cache, 'bucket1', key, 'parquet')
+    ## deleted between the HEAD and the download
+    with head_patch, patch.object(testing_object_cache, 'getObject', return_value=None):
+        assert tabular.columnar_object(testing_object_cache, 'bucket1', key, 'npy') is None
+
+@pytest.mark.parametrize('header,mode', [('auto', 'auto'), ('TRUE', 'true'), ('1', 'true'), (True, 'true'), ('no', 'false'), (False, 'false')])
+def test_header_mode(header, mode):
+    assert tabular.header_mode(header) == mode
+
+@pytest.mark.parametrize('header', ['foo1', 'foo2', '2'])
+def test_columnar_object_rejects_header(testing_object_cache, header):
+    ## rejected before any lookup , an arbitrary value never creates a cache entry
+    with pytest.raises(ValueError):
+        tabular.columnar_object(testing_object_cache, 'bucket1', 'tests/tabular/header.csv', 'npy', header)
+
+@pytest.mark.parametrize('content', [b'a,1\nbb,2\nccc,3\n', b'a,1\nbb,2\nccc,3', b'\n\n'])
+def test_line_offsets_by_block(tmp_path, content):
+    path = tmp_path / 'lines.csv'
+    path.write_bytes(content)
+    expected = [0] + [i + 1 for i, c in enumerate(content) if c == ord('\n')]
+    if expected[-1] != len(content):
+        expected.append(len(content))
+    for block_size in (1, 3, 4, 1024):
+        assert list(tabular.build_line_offsets(path, block_size)) == expected
+
+def test_slicing_params():
+    params = tabular.slicing_params({'offset': 10, 'limit': '5', 'columns': [0, 'x'], 'where': 'in_tissue=1'})
+    assert params == {'offset': 10, 'limit': 5, 'columns': ['0', 'x'], 'where': ['in_tissue=1']}
+    assert not tabular.has_slicing(tabular.slicing_params({}))
+
+@pytest.mark.parametrize('args', [{'offset': -1}, {'limit': '-5'}, {'offset': 1.5}, {'limit': 'ten'}, {'offset': True}])
+def test_slicing_params_rejects_invalid(args):
+    with pytest.raises(ValueError):
+        tabular.slicing_params(args)
+
+@pytest.mark.parametrize('columns,where', [([], ['in_tissue']), ([], ['=1']), (['missing'], []), ([], ['missing=1'])])
+def test_filter_rejects_invalid(columns, where):
+    header_row = ['barcode', 'in_tissue']
+    with pytest.raises(ValueError):
+        for column in columns:
+            tabular.resolve_column(column, header_row)
+        tabular.make_filter(where, header_row)
@@ -0,0 +1,128 @@
+import io
+import hashlib
+from unittest.mock import MagicMock
+from src import uploads
+import pytest
+
+def multipart_body(boundary, fields, filename, content):
+    body = b''
+    for name, value in fields:
+        body += '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(boundary, name, value).encode()
+    body += '--{}\r\nContent-Disposition: form-data; name="file"; filename="{}"\r\nContent-Type: application/octet-stream\r\n\r\n'.format(boundary, filename).encode()
+    body += content + '\r\n--{}--\r\n'.format(boundary).encode()
+    return body
+
+def fake_s3():
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload1'}
+    s3.upload_part.side_effect = lambda **kw: {'ETag': '"part{}"'.format(kw['PartNumber'])}
+    s3.complete_multipart_upload.return_value = {'ETag': '"etag-3"'}
+    s3.put_object.return_value = {'ETag': '"small"'}
+    return s3
+
+def test_iter_multipart_streams_file_data():
+    content = bytes(range(256)) * 4000
+    body = multipart_body('xyz', [('bucket_name', 'bucket1'), ('output_filename', 'run/file.bin')], 'file.bin', content)
+    events = list(uploads.iter_multipart(io.BytesIO(body), 'xyz', chunk_size=4096))
+    assert events[0] == ('field', 'bucket_name', 'bucket1')
+    assert events[1] == ('field', 'output_filename', 'run/file.bin')
+    assert events[2] == ('file', 'file', 'file.bin')
+    assert b''.join(e[1] for e in events if e[0] == 'data') == content
+    assert events[-1] == ('end', None)
+
+def test_multipart_writer_parts():
+    s3 = fake_s3()
+    writer = uploads.MultipartUploadWriter(s3, 'bucket1', 'run/big.bin', part_size=uploads.MIN_PART_SIZE, workers=2)
+    data = b'x' * (uploads.MIN_PART_SIZE * 2 + 10)
+    for i in range(0, len(data), 1024 * 1024):
+        writer.write(data[i:i + 1024 * 1024])
+    assert writer.close() == 'etag-3'
+    parts = s3.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']
+    assert [p['PartNumber'] for p in parts] == [1, 2, 3]
+    sizes = sorted(len(c.kwargs['Body']) for c in s3.upload_part.call_args_list)
+    assert sizes == [10, uploads.MIN_PART_SIZE, uploads.MIN_PART_SIZE]
+
+def test_upload_hashing():
+    data = b'spatial' * 1000
+    sink = uploads.HashingSink()
+    sink.write(data[:100])
+    sink.write(data[100:])
+    assert sink.close() is None
+    assert (sink.sha256.hexdigest(), sink.size) == (hashlib.sha256(data).hexdigest(), len(data))
+    writer = uploads.MultipartUploadWriter(fake_s3(), 'bucket1', 'run/small.txt')
+    writer.write(data)
+    assert writer.sha256.hexdigest() == sink.sha256.hexdigest()
+
+def test_multipart_writer_small_object_and_abort():
+    s3 = fake_s3()
+    writer = uploads.MultipartUploadWriter(s3, 'bucket1', 'run/small.txt')
+    writer.write(b'hello')
+    assert writer.close() == 'small'
+    assert s3.create_multipart_upload.call_count == 0
+    s3.upload_part.side_effect = Exception('connection reset')
+    writer = uploads.MultipartUploadWriter(s3, 'bucket1', 'run/big.bin', part_size=uploads.MIN_PART_SIZE, workers=1)
+    writer.write(b'x' * uploads.MIN_PART_SIZE)
+    with pytest.raises(Exception):
+        writer.close()
+    s3.abort_multipart_upload.assert_called_once_with(Bucket='bucket1', Key='run/big.bin', UploadId='upload1')
+
+class FakeTable:
+    def __init__(self):
+        self.docs = {}
+    def insert_one(self, doc):
+        self.docs[doc['_id']] = dict(doc)
+    def find_one(self, query):
+        doc = self.docs.get(query['_id'])
+        return dict(doc) if doc is not None else None
+    def update_one(self, query, update):
+        doc = self.docs[query['_id']]
+        for k, v in update['$set'].items():
+            if k.startswith('parts.'):
+                doc['parts'] = dict(doc['parts'], **{k[6:]: v})
+            else:
+                doc[k] = v
+
+def test_upload_session_resume_and_complete():
+    s3 = fake_s3()
+    table = FakeTable()
+    sessions = uploads.UploadSessions(s3, table, part_size=uploads.MIN_PART_SIZE)
+    size = uploads.MIN_PART_SIZE * 2 + 100
+    session = sessions.create('bucket1', 'run/big.h5ad', size, 'admin')
+    assert session['part_count'] == 3
+    assert session['missing_parts'] == [1, 2, 3]
+    sid = session['session_id']
+    sessions.putPart(sid, 3, io.BytesIO(b'z' * 100))
+    with pytest.raises(Exception):
+        sessions.putPart(sid, 1, io.BytesIO(b'short'))
+    ## S3 reports the parts actually stored
+    s3.list_parts.return_value = {'Parts': [{'PartNumber': 3, 'ETag': '"part3"', 'Size': 100}], 'IsTruncated': False}
+    assert sessions.listParts(sid)['missing_parts'] == [1, 2]
+    with pytest.raises(Exception):
+        sessions.complete(sid)
+    ## parts below the part size are refused before S3 answers EntityTooSmall
+    s3.list_parts.return_value = {'Parts': [{'PartNumber': n, 'ETag': '"part{}"'.format(n), 'Size': 1} for n in [1, 2, 3]], 'IsTruncated': False}
+    with pytest.raises(ValueError):
+        sessions.complete(sid)
+    assert s3.complete_multipart_upload.call_count == 0
+    sizes = {1: uploads.MIN_PART_SIZE, 2: uploads.MIN_PART_SIZE, 3: 100}
+    s3.list_parts.return_value = {'Parts': [{'PartNumber': n, 'ETag': '"part{}"'.format(n), 'Size': sizes[n]} for n in [1, 2, 3]], 'IsTruncated': False}
+    res = sessions.complete(sid)
+    assert res['status'] == 'completed' and res['etag'] == 'etag-3'
+    parts = s3.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']
+    assert [p['PartNumber'] for p in parts] == [1, 2, 3]
+    with pytest.raises(Exception):
+        sessions.abort(sid)
+
+def test_upload_session_part_size_cap():
+    s3 = fake_s3()
+    sessions = uploads.UploadSessions(s3, FakeTable(), part_size=uploads.MAX_PART_SIZE, max_part_size=uploads.MIN_PART_SIZE * 2)
+    session = sessions.create('bucket1', 'run/big.h5ad', uploads.MIN_PART_SIZE * 3, 'admin')
+    assert session['part_size'] == uploads.MIN_PART_SIZE * 2
+    ## more than MAX_PARTS parts of the largest accepted size
+    with pytest.raises(Exception):
+        sessions.create('bucket1', 'run/huge.h5ad', uploads.MIN_PART_SIZE * 2 * uploads.MAX_PARTS + 1, 'admin')
+    ## a body longer than the part is rejected without reading all of it
+    body = io.BytesIO(b'x' * (uploads.MIN_PART_SIZE * 4))
+    with pytest.raises(Exception):
+        sessions.putPart(session['session_id'], 1, body)
+    assert body.tell() == uploads.MIN_PART_SIZE * 2 + 1
@@ -0,0 +1,77 @@
+import json
+import itertools
+from src import utils
+import pytest
+
+def test_stream_json_list_matches_dumps():
+    items = [{'run_id': 'D{}'.format(i), 'value': i} for i in range(1203)]
+    chunks = list(utils.stream_json_list(iter(items), batch_size=500))
+    assert len(chunks) == 4
+    assert json.loads(''.join(chunks)) == items
+    assert ''.join(utils.stream_json_list(iter([]))) == '[]'
+
+def test_stream_json_dict_streams_iterator_values():
+    rows = [('D1', 1), ('D1', 2), ('D2', 3)]
+    pairs = ((k, (v for _, v in grp)) for k, grp in itertools.groupby(rows, key=lambda r: r[0]))
+    assert json.loads(''.join(utils.stream_json_dict(pairs))) == {'D1': [1, 2], 'D2': [3]}
+    assert json.loads(''.join(utils.stream_json_dict([('a', {'b': 1})]))) == {'a': {'b': 1}}
+    assert ''.join(utils.stream_json_dict([])) == '{}'
+
+def test_stream_json_dict_keys_like_json_dumps():
+    keys = [None, True, False, 3, 2.5, 'D1']
+    pairs = [(k, i) for i, k in enumerate(keys)]
+    assert json.loads(''.join(utils.stream_json_dict(pairs))) == json.loads(json.dumps(dict(pairs)))
+
+def test_json_stream_response_raises_before_first_byte():
+    def failing():
+        raise Exception('query failed')
+        yield
+    with pytest.raises(Exception):
+        utils.json_stream_response(utils.stream_json_list(failing()))
+    resp = utils.json_stream_response(utils.stream_json_list(iter([1, 2])))
+    assert resp.headers['Content-Type'] == 'application/json'
+    assert resp.get_data() == b'[1,2]'
+
+def test_json_stream_response_closes_source():
+    closed = []
+    def rows():
+        try:
+            for i in range(10000):
+                yield i
+        finally:
+            closed.append(True)
+    ## the client went away after the first chunk
+    resp = utils.json_stream_response(utils.stream_json_list(rows(), batch_size=10))
+    resp.close()
+    assert closed == [True]
+
+def test_versioned_response_not_modified():
+    from flask import Flask
+    app = Flask(__name__)
+    calls = []
+    def make_chunks():
+        calls.append(1)
+        return utils.stream_json_list(iter([{'a': 1}]))
+    with app.test_request_context('/'):
+        resp = utils.versioned_response(make_chunks, [3, 10, ['admin']], 'private, no-cache')
+        etag, weak = resp.get_etag()
+        assert weak and resp.status_code == 200 and resp.headers['Cache-Control'] == 'private, no-cache'
+        assert resp.get_data() == b'[{"a": 1}]'
+    with app.test_request_context('/', headers={'If-None-Match': 'W/"{}"'.format(etag)}):
+        resp = utils.versioned_response(make_chunks, [3, 10, ['admin']], 'private, no-cache')
+        assert resp.status_code == 304
+        assert resp.get_data() == b''
+    ## the query isn't run for a 304
+    assert len(calls) == 1
+    with app.test_request_context('/', headers={'If-None-Match': 'W/"{}"'.format(etag)}):
+        assert utils.versioned_response(make_chunks, [4, 10, ['admin']]).status_code == 200
+
+def test_data_version():
+    from unittest.mock import MagicMock
+    table = MagicMock()
+    table.find_one.return_value = None
+    assert utils.data_version(table, 'run_db') == 0
+    table.find_one.return_value = {'id': utils.DATA_VERSIONS_ID, 'run_db': 5}
+    assert utils.data_version(table, 'run_db') == 5
+    utils.bump_data_version(table, 'run_db')
+    table.update_one.assert_called_once_with({'id': utils.DATA_VERSIONS_ID}, {'$inc': {'run_db': 1}}, upsert=True)